@@ -0,0 +1,457 @@
+# archive.py
+"""Холодный архив старых сообщений BigAko.
+
+Сообщения старше порога переносятся из таблицы messages в сжатые сегменты в каталоге
+archive/, и горячая таблица (вместе с ее индексами и FTS) остается маленькой. Перенос идет
+по возрастанию id непрерывным диапазоном: в архиве всегда самые старые сообщения, а все
+id <= last_id архива из базы уже удалены или будут удалены следующим запуском.
+
+Сегмент NNNNNNNNNNNN.seg (имя - первый id) - файл, в который только дописываются блоки:
+заголовок BLOCK_HEADER и сжатый zlib или lzma JSON-список строк сообщений. Рядом лежит
+NNNNNNNNNNNN.idx - по строке JSON на блок: диапазон id и времени, смещение, размер и список
+комнат, так что чтение истории распаковывает только нужные блоки. Блок сначала дописывается
+и сбрасывается на диск, потом попадает в индекс; после сбоя хвост сегмента за последней
+строкой индекса либо индексируется заново (целые блоки), либо обрезается.
+
+Запуск вручную:
+    python archive.py --older-than 30          # перенести сообщения старше 30 дней
+    python archive.py --older-than 30 --vacuum # и вернуть освободившееся место в ФС
+    python archive.py --list                   # сегменты и блоки архива
+"""
+import argparse
+import bisect
+import fcntl
+import json
+import lzma
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from database import apply_pragmas, epoch_ms, now_ms
+
+ARCHIVE_DIR = 'archive'
+BLOCK_ROWS = 1000
+SEGMENT_BYTES = 32 * 1024 * 1024
+CACHE_BLOCKS = 32
+# Сколько самых новых сообщений не переносить никогда, даже если они старше порога
+KEEP_RECENT = 1000
+MOVE_BATCH = 5000
+
+BLOCK_MAGIC = b'BAKB'
+# magic, кодек, длина сжатых данных, crc32 сжатых данных, первый id, последний id
+BLOCK_HEADER = struct.Struct('<4sBIIqq')
+
+CODECS = {
+    'zlib': (0, lambda data: zlib.compress(data, 9), zlib.decompress),
+    'lzma': (1, lzma.compress, lzma.decompress)
+}
+DECOMPRESSORS = {code: decompress for code, _, decompress in CODECS.values()}
+
+# Порядок полей в строке архива - тот же, что у MESSAGE_SELECT в main.py
+MESSAGE_FIELDS = ('id', 'username', 'message', 'message_type', 'file_name', 'file_size', 'timestamp', 'room_id')
+
+ARCHIVE_SELECT = (
+    "SELECT m.id, u.username, m.message, m.message_type, m.file_name, m.file_size, m.timestamp, m.room_id "
+    "FROM messages m JOIN users u ON u.id = m.user_id"
+)
+
+class ArchiveBusy(Exception):
+    """Архив уже пополняет другой поток или процесс"""
+
+class ArchiveMismatch(Exception):
+    """В архиве есть id, которых эта база в архив не отдавала: он от другой (например,
+    пересозданной) базы. Читать его - показывать чужую историю, пополнять - удалять новые сообщения"""
+
+class ArchiveBlock:
+    __slots__ = ('segment', 'first_id', 'last_id', 'first_ts', 'last_ts', 'offset', 'size', 'raw_size',
+                 'count', 'rooms')
+
+    def __init__(self, segment: str, entry: Dict):
+        self.segment = segment
+        self.first_id = entry['first_id']
+        self.last_id = entry['last_id']
+        # Блоки, записанные до миграции 7, хранят метки строками
+        self.first_ts = epoch_ms(entry['first_ts'])
+        self.last_ts = epoch_ms(entry['last_ts'])
+        self.offset = entry['offset']
+        self.size = entry['size']
+        self.raw_size = entry['raw_size']
+        self.count = entry['count']
+        self.rooms = frozenset(entry['rooms'])
+
+    @property
+    def end(self) -> int:
+        return self.offset + BLOCK_HEADER.size + self.size
+
+def encode_block(rows: List[Tuple], codec: str) -> Tuple[bytes, Dict]:
+    code, compress, _ = CODECS[codec]
+    raw = json.dumps([list(row) for row in rows], ensure_ascii=False, separators=(',', ':')).encode()
+    payload = compress(raw)
+    header = BLOCK_HEADER.pack(BLOCK_MAGIC, code, len(payload), zlib.crc32(payload), rows[0][0], rows[-1][0])
+    timestamps = [row[6] for row in rows]
+    entry = {
+        'first_id': rows[0][0],
+        'last_id': rows[-1][0],
+        'first_ts': min(timestamps),
+        'last_ts': max(timestamps),
+        'size': len(payload),
+        'raw_size': len(raw),
+        'count': len(rows),
+        'rooms': sorted({row[7] for row in rows})
+    }
+    return header + payload, entry
+
+def decode_payload(code: int, payload: bytes) -> List[List]:
+    return json.loads(DECOMPRESSORS[code](payload))
+
+def row_to_message(row) -> Dict:
+    message = dict(zip(MESSAGE_FIELDS, row))
+    if isinstance(message['timestamp'], str):
+        message['timestamp'] = epoch_ms(message['timestamp'])
+    return message
+
+class MessageArchive:
+    """Сегменты архива и их индексы в памяти. Читать можно из любого потока и процесса;
+    пишет только владелец блокировки writing()."""
+
+    def __init__(self, path: str = ARCHIVE_DIR, codec: str = 'zlib', block_rows: int = BLOCK_ROWS,
+                 segment_bytes: int = SEGMENT_BYTES, cache_blocks: int = CACHE_BLOCKS):
+        if codec not in CODECS:
+            raise ValueError(f'Unknown archive codec: {codec}')
+        self.path = path
+        self.codec = codec
+        self.block_rows = block_rows
+        self.segment_bytes = segment_bytes
+        self.cache_blocks = cache_blocks
+        self.lock = threading.RLock()
+        self.blocks: List[ArchiveBlock] = []
+        self.first_ids: List[int] = []
+        # Сегменты и размер индекса последнего из них: по ним видно, что архив пополнил другой процесс
+        self.signature: Optional[Tuple] = None
+        self.cache: 'OrderedDict[Tuple[str, int], List[List]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def last_id(self) -> int:
+        return self.blocks[-1].last_id if self.blocks else 0
+
+    def segment_names(self) -> List[str]:
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-4] for name in names if name.endswith('.seg'))
+
+    def file(self, segment: str, ext: str) -> str:
+        return os.path.join(self.path, f'{segment}.{ext}')
+
+    def read_index(self, segment: str) -> List[ArchiveBlock]:
+        blocks = []
+        try:
+            with open(self.file(segment, 'idx'), 'rb') as f:
+                for line in f:
+                    # Недописанная последняя строка - запись прервалась; блок восстановит recover()
+                    if not line.endswith(b'\n'):
+                        break
+                    blocks.append(ArchiveBlock(segment, json.loads(line)))
+        except FileNotFoundError:
+            pass
+        return blocks
+
+    def current_signature(self, names: List[str]) -> Tuple:
+        size = 0
+        if names:
+            try:
+                size = os.stat(self.file(names[-1], 'idx')).st_size
+            except FileNotFoundError:
+                pass
+        return tuple(names), size
+
+    def refresh(self):
+        """Перечитывает индексы, если архив изменился с прошлого раза"""
+        names = self.segment_names()
+        signature = self.current_signature(names)
+        with self.lock:
+            if signature == self.signature:
+                return
+            blocks = []
+            for name in names:
+                blocks.extend(self.read_index(name))
+            self.blocks = blocks
+            self.first_ids = [block.first_id for block in blocks]
+            self.signature = signature
+
+    def recover(self, segment: str):
+        """Приводит последний сегмент в согласие с индексом после сбоя посреди записи"""
+        index_path = self.file(segment, 'idx')
+        try:
+            with open(index_path, 'rb') as f:
+                index = f.read()
+        except FileNotFoundError:
+            index = b''
+        if not index.endswith(b'\n'):
+            # Недописанную строку индекса отрезаем; ее блок найдется в хвосте сегмента
+            with open(index_path, 'ab') as f:
+                f.truncate(index.rfind(b'\n') + 1)
+        blocks = self.read_index(segment)
+        end = blocks[-1].end if blocks else 0
+        last_id = blocks[-1].last_id if blocks else 0
+        seg_path = self.file(segment, 'seg')
+        with open(seg_path, 'rb') as f:
+            f.seek(end)
+            tail = f.read()
+        recovered = []
+        pos = 0
+        while len(tail) - pos >= BLOCK_HEADER.size:
+            magic, code, size, crc, first_id, block_last = BLOCK_HEADER.unpack_from(tail, pos)
+            payload = tail[pos + BLOCK_HEADER.size:pos + BLOCK_HEADER.size + size]
+            if (magic != BLOCK_MAGIC or code not in DECOMPRESSORS or len(payload) < size
+                    or zlib.crc32(payload) != crc or first_id <= last_id):
+                break
+            rows = decode_payload(code, payload)
+            _, entry = encode_block(rows, self.codec)
+            entry['offset'] = end + pos
+            entry['size'] = size
+            recovered.append(entry)
+            last_id = block_last
+            pos += BLOCK_HEADER.size + size
+        if recovered:
+            with open(index_path, 'ab') as f:
+                for entry in recovered:
+                    f.write(json.dumps(entry).encode() + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+        if pos < len(tail):
+            print(f"Archive segment {segment}: dropped {len(tail) - pos} bytes of an unfinished block")
+            os.truncate(seg_path, end + pos)
+
+    @contextmanager
+    def writing(self) -> Iterator['MessageArchive']:
+        """Эксклюзивная запись в архив: flock на archive/.lock, затем восстановление хвоста.
+        Занятая блокировка - ArchiveBusy, а не ожидание: перенос просто повторится позже."""
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise ArchiveBusy(self.path)
+            try:
+                names = self.segment_names()
+                if names:
+                    self.recover(names[-1])
+                self.refresh()
+                yield self
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, rows: List[Tuple]):
+        """Дописывает строки (по возрастанию id, новее last_id) блоками по block_rows"""
+        if rows[0][0] <= self.last_id:
+            raise ValueError(f'Archive already contains id {rows[0][0]}')
+        for start in range(0, len(rows), self.block_rows):
+            chunk = rows[start:start + self.block_rows]
+            names = self.segment_names()
+            segment = names[-1] if names else None
+            if segment is None or os.path.getsize(self.file(segment, 'seg')) >= self.segment_bytes:
+                segment = f'{chunk[0][0]:012d}'
+            data, entry = encode_block(chunk, self.codec)
+            with open(self.file(segment, 'seg'), 'ab') as f:
+                entry['offset'] = f.tell()
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.file(segment, 'idx'), 'ab') as f:
+                f.write(json.dumps(entry).encode() + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.refresh()
+
+    def read_block(self, block: ArchiveBlock) -> List[List]:
+        key = (block.segment, block.offset)
+        with self.lock:
+            rows = self.cache.get(key)
+            if rows is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return rows
+            self.misses += 1
+        with open(self.file(block.segment, 'seg'), 'rb') as f:
+            f.seek(block.offset)
+            data = f.read(BLOCK_HEADER.size + block.size)
+        code = BLOCK_HEADER.unpack_from(data)[1]
+        rows = decode_payload(code, data[BLOCK_HEADER.size:])
+        with self.lock:
+            self.cache[key] = rows
+            while len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last=False)
+        return rows
+
+    def read_before(self, before_id: int, limit: int, room_id: Optional[int] = None) -> List[Dict]:
+        """До limit сообщений с id < before_id, по возрастанию id - как get_messages_before"""
+        self.refresh()
+        with self.lock:
+            blocks = self.blocks[:bisect.bisect_left(self.first_ids, before_id)]
+        found: List[List] = []
+        for block in reversed(blocks):
+            if len(found) >= limit:
+                break
+            if room_id is not None and room_id not in block.rooms:
+                continue
+            for row in reversed(self.read_block(block)):
+                if row[0] < before_id and (room_id is None or row[7] == room_id):
+                    found.append(row)
+                    if len(found) >= limit:
+                        break
+        return [row_to_message(row) for row in reversed(found)]
+
+    def read_after(self, after_id: int, limit: int, room_id: Optional[int] = None) -> List[Dict]:
+        """До limit сообщений с id > after_id, по возрастанию id"""
+        self.refresh()
+        with self.lock:
+            if after_id >= self.last_id:
+                return []
+            blocks = self.blocks[max(bisect.bisect_right(self.first_ids, after_id) - 1, 0):]
+        found: List[List] = []
+        for block in blocks:
+            if len(found) >= limit:
+                break
+            if room_id is not None and room_id not in block.rooms:
+                continue
+            for row in self.read_block(block):
+                if row[0] > after_id and (room_id is None or row[7] == room_id):
+                    found.append(row)
+                    if len(found) >= limit:
+                        break
+        return [row_to_message(row) for row in found]
+
+    def stats(self) -> Dict:
+        with self.lock:
+            blocks = list(self.blocks)
+            hits, misses = self.hits, self.misses
+        size = sum(block.size + BLOCK_HEADER.size for block in blocks)
+        raw_size = sum(block.raw_size for block in blocks)
+        return {
+            'segments': len({block.segment for block in blocks}),
+            'blocks': len(blocks),
+            'messages': sum(block.count for block in blocks),
+            'first_id': blocks[0].first_id if blocks else None,
+            'last_id': blocks[-1].last_id if blocks else None,
+            'oldest': blocks[0].first_ts if blocks else None,
+            'newest': blocks[-1].last_ts if blocks else None,
+            'bytes': size,
+            'ratio': round(raw_size / size, 2) if size else None,
+            'cache_hits': hits,
+            'cache_misses': misses
+        }
+
+def format_ms(moment: int) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(moment / 1000))
+
+def drop_archived(conn: sqlite3.Connection, last_id: int):
+    """Удаляет из messages все, что уже лежит в архиве (id <= last_id).
+    Файлы перенесенных сообщений запоминаются в archived_files - для проверки доступа к ним"""
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO archived_files (file_name, room_id) "
+            "SELECT file_name, room_id FROM messages WHERE id <= ? AND file_name IS NOT NULL",
+            (last_id,)
+        )
+        conn.execute("DELETE FROM messages WHERE id <= ?", (last_id,))
+
+def archived_up_to(conn: sqlite3.Connection) -> int:
+    """Граница из archive_state - не больше id, которые база вообще выдавала"""
+    row = conn.execute("SELECT last_id FROM archive_state").fetchone()
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+    return min(row[0] if row else 0, seq[0] if seq else 0)
+
+def check_archive(conn: sqlite3.Connection, archive: 'MessageArchive'):
+    archive.refresh()
+    limit = archived_up_to(conn)
+    if archive.last_id > limit:
+        raise ArchiveMismatch(f"Archive {archive.path} ends at message {archive.last_id}, but the database "
+                              f"has archived messages only up to {limit}: the archive belongs to another database")
+
+def archive_cutoff(conn: sqlite3.Connection, before: int, keep_recent: int) -> int:
+    """Первый id, который остается в базе: самое старое сообщение не старше before,
+    но не дальше keep_recent-го с конца"""
+    row = conn.execute(
+        "SELECT id FROM messages WHERE timestamp >= ? ORDER BY timestamp LIMIT 1", (before,)
+    ).fetchone()
+    cutoff = row[0] if row else conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM messages").fetchone()[0]
+    row = conn.execute(
+        "SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?", (max(keep_recent, 1) - 1,)
+    ).fetchone()
+    return min(cutoff, row[0]) if row else 0
+
+def archive_messages(conn: sqlite3.Connection, archive: MessageArchive, older_than: float,
+                     keep_recent: int = KEEP_RECENT, batch: int = MOVE_BATCH,
+                     log: Callable[[str], None] = print) -> int:
+    """Переносит в архив сообщения старше older_than секунд и возвращает их число.
+
+    Каждая пачка сначала надежно записывается в архив и только потом удаляется из базы:
+    если процесс упадет между этими шагами, следующий запуск просто доудалит ее.
+    """
+    before = now_ms() - int(older_than * 1000)
+    moved = 0
+    with archive.writing():
+        check_archive(conn, archive)
+        drop_archived(conn, archive.last_id)
+        cutoff = archive_cutoff(conn, before, keep_recent)
+        while True:
+            rows = conn.execute(
+                f"{ARCHIVE_SELECT} WHERE m.id > ? AND m.id < ? ORDER BY m.id LIMIT ?",
+                (archive.last_id, cutoff, batch)
+            ).fetchall()
+            if not rows:
+                break
+            # Граница поднимается до записи в архив: после сбоя архив может от нее отстать, но не обогнать
+            with conn:
+                conn.execute("UPDATE archive_state SET last_id = MAX(last_id, ?)", (rows[-1][0],))
+            archive.append(rows)
+            drop_archived(conn, archive.last_id)
+            moved += len(rows)
+    if moved:
+        log(f"Archived {moved} messages older than {format_ms(before)} (archive last id {archive.last_id})")
+    return moved
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BigAko message archive')
+    parser.add_argument('--db', default='users.db')
+    parser.add_argument('--dir', default=ARCHIVE_DIR, help='каталог сегментов архива')
+    parser.add_argument('--older-than', type=float, help='перенести сообщения старше стольких дней')
+    parser.add_argument('--keep-recent', type=int, default=KEEP_RECENT, help='сколько последних сообщений не переносить')
+    parser.add_argument('--codec', choices=list(CODECS), default='zlib')
+    parser.add_argument('--vacuum', action='store_true', help='после переноса сжать файл базы (VACUUM)')
+    parser.add_argument('--list', action='store_true', help='показать сегменты и блоки')
+    args = parser.parse_args()
+
+    archive = MessageArchive(args.dir, codec=args.codec)
+    if args.older_than is not None:
+        conn = sqlite3.connect(args.db)
+        apply_pragmas(conn)
+        try:
+            archive_messages(conn, archive, args.older_than * 86400, args.keep_recent)
+            if args.vacuum:
+                # Удаленные строки освобождают страницы внутри файла; вернуть их ФС может только VACUUM
+                conn.execute("VACUUM")
+        except ArchiveBusy:
+            print(f"Archive {args.dir} is being written by another process")
+            raise SystemExit(1)
+        except ArchiveMismatch as e:
+            print(e)
+            raise SystemExit(1)
+        finally:
+            conn.close()
+    archive.refresh()
+    if args.list:
+        for block in archive.blocks:
+            print(f"{block.segment}  {block.first_id}-{block.last_id}  {format_ms(block.first_ts)} .. {format_ms(block.last_ts)}  "
+                  f"{block.count} messages, {block.size} bytes, rooms {sorted(block.rooms)}")
+    print(json.dumps(archive.stats(), indent=2))
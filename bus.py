@@ -0,0 +1,384 @@
+# bus.py
+"""Шина сообщений между рабочими процессами BigAko.
+
+LocalBus - для одного процесса: publish сразу отдает сообщения подписчикам.
+SocketBus - клиент брокера BusBroker, который слушает Unix-сокет и пересылает
+пачки сообщений от одного процесса всем остальным.
+
+Брокер можно запустить отдельно: python bus.py --socket /tmp/bigako.sock
+"""
+import argparse
+import json
+import os
+import queue
+import selectors
+import signal
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+def encode_frame(payload: Dict) -> bytes:
+    body = json.dumps(payload).encode()
+    return FRAME_HEADER.pack(len(body)) + body
+
+def read_exact(sock: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Bus connection closed')
+        data += chunk
+    return data
+
+def read_frame(sock: socket.socket) -> Dict:
+    size = FRAME_HEADER.unpack(read_exact(sock, FRAME_HEADER.size))[0]
+    if size > MAX_FRAME_SIZE:
+        raise ConnectionError(f'Bus frame too large: {size}')
+    return json.loads(read_exact(sock, size))
+
+class LagStats:
+    """Задержка доставки: от отправки пачки в одном процессе до приема в другом"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, lag: float, count: int = 1):
+        lag = max(lag, 0.0)
+        self.count += count
+        self.total += lag * count
+        self.max = max(self.max, lag)
+        self.last = lag
+
+    def as_dict(self) -> Dict:
+        return {
+            'messages': self.count,
+            'avg_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            'max_ms': round(self.max * 1000, 3),
+            'last_ms': round(self.last * 1000, 3)
+        }
+
+class LocalBus:
+    """Шина одного процесса"""
+    def __init__(self):
+        self.deliver: Optional[Callable[[List[Dict]], None]] = None
+        self.published = 0
+
+    def start(self, deliver: Callable[[List[Dict]], None]):
+        self.deliver = deliver
+
+    def publish(self, messages: List[Dict]):
+        self.published += len(messages)
+        self.deliver(messages)
+
+    def stop(self):
+        pass
+
+    def stats(self) -> Dict:
+        return {'type': 'local', 'published': self.published}
+
+class SocketBus:
+    """Клиент брокера. Свои сообщения отдаются подписчикам сразу, а в брокер уходят пачками
+    (до batch_size сообщений или batch_delay секунд). При обрыве клиент переподключается
+    сам и вызывает on_reconnect, чтобы процесс догрузил пропущенное из базы.
+    """
+    batch_size = 64
+    batch_delay = 0.005
+    outbox_size = 10000
+    reconnect_delay = 0.1
+    max_reconnect_delay = 2.0
+
+    def __init__(self, path: str, on_reconnect: Optional[Callable[[], None]] = None):
+        self.path = path
+        self.on_reconnect = on_reconnect
+        self.origin = f'{socket.gethostname()}:{os.getpid()}'
+        self.deliver: Optional[Callable[[List[Dict]], None]] = None
+        self.outbox: queue.Queue = queue.Queue(maxsize=self.outbox_size)
+        self.sock: Optional[socket.socket] = None
+        self.sock_lock = threading.Lock()
+        self.connected = threading.Event()
+        self.stopped = False
+        self.threads: List[threading.Thread] = []
+        self.lag = LagStats()
+        self.published = 0
+        self.sent_batches = 0
+        self.sent_messages = 0
+        self.received_messages = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    def start(self, deliver: Callable[[List[Dict]], None]):
+        self.deliver = deliver
+        for target, name in ((self.receive_loop, 'bigako-bus-recv'), (self.send_loop, 'bigako-bus-send')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def publish(self, messages: List[Dict]):
+        self.published += len(messages)
+        self.deliver(messages)
+        try:
+            self.outbox.put_nowait(messages)
+        except queue.Full:
+            # Брокер недоступен слишком долго; остальные процессы догрузят это из базы
+            self.dropped += len(messages)
+
+    def connect(self) -> Optional[socket.socket]:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            return None
+        with self.sock_lock:
+            self.sock = sock
+        self.connected.set()
+        return sock
+
+    def disconnect(self):
+        self.connected.clear()
+        with self.sock_lock:
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def receive_loop(self):
+        delay = self.reconnect_delay
+        first = True
+        while not self.stopped:
+            sock = self.connect()
+            if sock is None:
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            delay = self.reconnect_delay
+            if not first:
+                self.reconnects += 1
+            first = False
+            if self.on_reconnect is not None:
+                # Пока соединения не было, сообщения других процессов могли пройти мимо
+                self.on_reconnect()
+            try:
+                while not self.stopped:
+                    frame = read_frame(sock)
+                    messages = frame.get('messages', [])
+                    if not messages:
+                        continue
+                    self.lag.add(time.time() - frame.get('sent_at', time.time()), len(messages))
+                    self.received_messages += len(messages)
+                    self.deliver(messages)
+            except (OSError, ConnectionError, ValueError) as e:
+                if not self.stopped:
+                    print(f"Bus connection lost: {e}")
+            self.disconnect()
+
+    def next_batch(self) -> Optional[List[Dict]]:
+        messages = self.outbox.get()
+        if messages is None:
+            return None
+        batch = list(messages)
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                messages = self.outbox.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if messages is None:
+                self.outbox.put(None)
+                break
+            batch.extend(messages)
+        return batch
+
+    def send_loop(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            frame = encode_frame({'origin': self.origin, 'sent_at': time.time(), 'messages': batch})
+            with self.sock_lock:
+                sock = self.sock
+            if sock is None:
+                self.dropped += len(batch)
+                continue
+            try:
+                sock.sendall(frame)
+                self.sent_batches += 1
+                self.sent_messages += len(batch)
+            except OSError:
+                self.dropped += len(batch)
+                self.disconnect()
+
+    def stop(self):
+        self.stopped = True
+        self.outbox.put(None)
+        self.disconnect()
+        for thread in self.threads:
+            thread.join(1.0)
+
+    def stats(self) -> Dict:
+        return {
+            'type': 'socket',
+            'path': self.path,
+            'connected': self.connected.is_set(),
+            'published': self.published,
+            'sent_batches': self.sent_batches,
+            'sent_messages': self.sent_messages,
+            'received_messages': self.received_messages,
+            'dropped': self.dropped,
+            'reconnects': self.reconnects,
+            'queued': self.outbox.qsize(),
+            'lag': self.lag.as_dict()
+        }
+
+class BusBroker:
+    """Брокер на Unix-сокете: каждый кадр клиента пересылается всем остальным клиентам.
+
+    Работает в одном потоке на selectors. Клиент, который не успевает читать
+    (больше max_buffer байт в очереди на отправку), отключается - после переподключения
+    его процесс догрузит пропущенное из базы.
+    """
+    max_buffer = 8 * 1024 * 1024
+
+    def __init__(self, path: str):
+        self.path = path
+        self.selector = selectors.DefaultSelector()
+        self.clients: Dict[socket.socket, Dict] = {}
+        self.running = False
+        self.frames = 0
+        self.sock: Optional[socket.socket] = None
+
+    def bind(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(64)
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def serve_forever(self):
+        if self.sock is None:
+            self.bind()
+        self.running = True
+        while self.running:
+            for key, mask in self.selector.select(timeout=0.5):
+                if key.fileobj is self.sock:
+                    self.accept()
+                    continue
+                if mask & selectors.EVENT_READ and key.fileobj in self.clients:
+                    self.read(key.fileobj)
+                if mask & selectors.EVENT_WRITE and key.fileobj in self.clients:
+                    self.flush(key.fileobj)
+
+    def accept(self):
+        try:
+            client, _ = self.sock.accept()
+        except BlockingIOError:
+            return
+        client.setblocking(False)
+        self.clients[client] = {'inbuf': bytearray(), 'outbuf': bytearray()}
+        self.selector.register(client, selectors.EVENT_READ)
+
+    def drop(self, client: socket.socket):
+        if self.clients.pop(client, None) is None:
+            return
+        self.selector.unregister(client)
+        client.close()
+
+    def read(self, client: socket.socket):
+        try:
+            data = client.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(client)
+            return
+        inbuf = self.clients[client]['inbuf']
+        inbuf.extend(data)
+        while len(inbuf) >= FRAME_HEADER.size:
+            size = FRAME_HEADER.unpack_from(inbuf)[0]
+            if size > MAX_FRAME_SIZE:
+                self.drop(client)
+                return
+            end = FRAME_HEADER.size + size
+            if len(inbuf) < end:
+                break
+            frame = bytes(inbuf[:end])
+            del inbuf[:end]
+            self.frames += 1
+            for other in list(self.clients):
+                if other is not client:
+                    self.send(other, frame)
+
+    def send(self, client: socket.socket, frame: bytes):
+        outbuf = self.clients[client]['outbuf']
+        if len(outbuf) + len(frame) > self.max_buffer:
+            self.drop(client)
+            return
+        was_empty = not outbuf
+        outbuf.extend(frame)
+        if was_empty:
+            self.flush(client)
+
+    def flush(self, client: socket.socket):
+        outbuf = self.clients[client]['outbuf']
+        try:
+            sent = client.send(outbuf)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.drop(client)
+            return
+        del outbuf[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if outbuf else 0)
+        self.selector.modify(client, events)
+
+    def close(self):
+        self.running = False
+        for client in list(self.clients):
+            self.drop(client)
+        if self.sock is not None:
+            self.selector.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        self.selector.close()
+
+def run_broker(path: str):
+    broker = BusBroker(path)
+    broker.bind()
+
+    def stop(signum, frame):
+        broker.running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        broker.serve_forever()
+    finally:
+        broker.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BigAko message bus broker')
+    parser.add_argument('--socket', required=True, help='путь к Unix-сокету брокера')
+    args = parser.parse_args()
+    print(f"BigAko bus broker listening on {args.socket}")
+    run_broker(args.socket)
@@ -3,6 +3,11 @@ import sqlite3
 import hashlib
 import secrets
 import os
+import shutil
+import sys
+from archive import ARCHIVE_DIR
+from database import DEFAULT_PROFILE, PRAGMA_PROFILES, apply_pragmas, describe_pragmas, format_pragmas
+from migrations import MIGRATIONS, current_version, migrate
 
 def generate_salt():
     return secrets.token_hex(16)
@@ -10,46 +15,33 @@ def generate_salt():
 def hash_password(password, salt):
     return hashlib.sha256((password + salt).encode()).hexdigest()
 
-def init_database():
-    # Удаляем старую базу если существует
+def init_database(profile=DEFAULT_PROFILE):
+    # Удаляем старую базу если существует (вместе с файлами журнала WAL)
     if os.path.exists('users.db'):
         try:
             os.remove('users.db')
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists('users.db' + suffix):
+                    os.remove('users.db' + suffix)
             print("Старая база данных удалена")
         except Exception as e:
             print(f"Ошибка при удалении старой базы: {e}")
             return False
+    # Архив старых сообщений принадлежит удаленной базе: его id совпали бы с id новых сообщений
+    if os.path.isdir(ARCHIVE_DIR) and os.listdir(ARCHIVE_DIR):
+        shutil.rmtree(ARCHIVE_DIR)
+        print("Старый архив сообщений удален")
     
     try:
         # Создаем подключение к базе
         conn = sqlite3.connect('users.db')
+        apply_pragmas(conn, profile)
+        print(format_pragmas(profile, describe_pragmas(conn)))
         cursor = conn.cursor()
         
-        print("Создаем таблицу users...")
-        # Создаем таблицу пользователей
-        cursor.execute('''
-            CREATE TABLE users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                salt TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        print("Создаем таблицу messages...")
-        # Создаем таблицу сообщений
-        cursor.execute('''
-            CREATE TABLE messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                message TEXT NOT NULL,
-                message_type TEXT DEFAULT 'text',
-                file_name TEXT,
-                file_size INTEGER,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        print("Создаем таблицы...")
+        # Схема общая с сервером: ее создают миграции из migrations.py
+        migrate(conn)
         
         print("Добавляем тестовых пользователей...")
         # Добавляем тестовых пользователей
@@ -86,8 +78,9 @@ def init_database():
         
         for username, message, message_type, file_name, file_size in test_messages:
             cursor.execute(
-                "INSERT INTO messages (username, message, message_type, file_name, file_size) VALUES (?, ?, ?, ?, ?)",
-                (username, message, message_type, file_name, file_size)
+                "INSERT INTO messages (user_id, message, message_type, file_name, file_size) "
+                "SELECT id, ?, ?, ?, ? FROM users WHERE username = ?",
+                (message, message_type, file_name, file_size, username)
             )
             print(f"✓ Сообщение от {username} добавлено")
         
@@ -115,7 +108,8 @@ def init_database():
         
         # Показываем сообщения
         print("\nПоследние сообщения:")
-        cursor.execute("SELECT username, message, timestamp FROM messages ORDER BY id DESC LIMIT 5")
+        cursor.execute("SELECT u.username, m.message, datetime(m.timestamp / 1000, 'unixepoch') FROM messages m "
+                       "JOIN users u ON u.id = m.user_id ORDER BY m.id DESC LIMIT 5")
         messages = cursor.fetchall()
         for msg in messages:
             print(f"  {msg[2]} - {msg[0]}: {msg[1]}")
@@ -156,7 +150,7 @@ def verify_database():
         # Проверяем структуру таблицы messages
         cursor.execute("PRAGMA table_info(messages)")
         messages_columns = cursor.fetchall()
-        expected_messages_columns = ['id', 'username', 'message', 'message_type', 'file_name', 'file_size', 'timestamp']
+        expected_messages_columns = ['id', 'user_id', 'message', 'message_type', 'file_name', 'file_size', 'timestamp', 'room_id']
         actual_messages_columns = [col[1] for col in messages_columns]
         
         print("\nПроверка структуры таблицы messages:")
@@ -166,6 +160,9 @@ def verify_database():
             else:
                 print(f"  ✗ {col} - отсутствует")
         
+        version = current_version(conn)
+        print(f"\nВерсия схемы: {version} (последняя миграция: {MIGRATIONS[-1].version})")
+        
         conn.close()
         return all(col in actual_users_columns for col in expected_users_columns) and \
                all(col in actual_messages_columns for col in expected_messages_columns)
@@ -205,12 +202,18 @@ if __name__ == "__main__":
     print("СОЗДАНИЕ БАЗЫ ДАННЫХ BIGAKO MESSENGER")
     print("=" * 50)
     
+    # Профиль SQLite можно передать первым аргументом: python create_database.py durable
+    profile = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PROFILE
+    if profile not in PRAGMA_PROFILES:
+        print(f"Неизвестный профиль {profile}, доступны: {', '.join(PRAGMA_PROFILES)}")
+        sys.exit(1)
+    
     # Проверяем, существует ли база
     if os.path.exists('users.db'):
         print("Обнаружена существующая база данных.")
         choice = input("Пересоздать базу? (y/n): ").lower()
         if choice == 'y':
-            success = init_database()
+            success = init_database(profile)
         else:
             print("Проверяем структуру существующей базы...")
             verify_database()
@@ -222,7 +225,7 @@ if __name__ == "__main__":
                 password = input("Пароль: ")
                 add_test_user(username, password)
     else:
-        success = init_database()
+        success = init_database(profile)
     
     print("\n" + "=" * 50)
     print("ИНСТРУКЦИЯ ПО ЗАПУСКУ:")
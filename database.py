@@ -0,0 +1,395 @@
+# database.py
+"""Доступ к SQLite для сервера BigAko.
+
+ConnectionPool держит открытые соединения вместо sqlite3.connect на каждый вызов:
+читающие соединения открываются только на чтение и выдаются по одному потоку за раз,
+а все записи идут через единственное пишущее соединение.
+
+База работает в режиме WAL, остальные PRAGMA задаются именованным профилем
+(PRAGMA_PROFILES): durable, balanced или fast.
+"""
+import calendar
+import os
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+DB_PATH = 'users.db'
+
+# synchronous: FULL - fsync на каждый коммит; NORMAL в режиме WAL - fsync только на checkpoint
+# (при сбое питания можно потерять последние коммиты, но не повредить базу); OFF - без fsync вообще.
+# cache_size в отрицательных значениях - в килобайтах
+PRAGMA_PROFILES: Dict[str, Dict] = {
+    'durable': {
+        'synchronous': 'FULL',
+        'busy_timeout': 10000,
+        'cache_size': -16000,
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT'
+    },
+    'balanced': {
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -32000,
+        'mmap_size': 128 * 1024 * 1024,
+        'temp_store': 'MEMORY'
+    },
+    'fast': {
+        'synchronous': 'OFF',
+        'busy_timeout': 5000,
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY'
+    }
+}
+DEFAULT_PROFILE = 'balanced'
+
+SYNCHRONOUS_NAMES = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+TEMP_STORE_NAMES = {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'}
+
+# Время сообщений хранится и отдается клиенту целым числом миллисекунд с начала эпохи (UTC)
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+def epoch_ms(moment: Union[int, str, date, datetime]) -> int:
+    """Миллисекунды с начала эпохи. datetime и date без зоны считаются UTC; строка - в формате
+    прежних меток 'YYYY-MM-DD HH:MM:SS' (до миграции 7, в старых блоках архива и журнала)"""
+    if isinstance(moment, int):
+        return moment
+    if isinstance(moment, str):
+        moment = datetime.fromisoformat(moment)
+    elif not isinstance(moment, datetime):
+        moment = datetime.combine(moment, datetime.min.time())
+    return calendar.timegm(moment.utctimetuple()) * 1000 + moment.microsecond // 1000
+
+def apply_pragmas(conn: sqlite3.Connection, profile: str = DEFAULT_PROFILE, read_only: bool = False):
+    """Включает WAL (кроме соединений только для чтения - режим журнала хранится в самой базе)
+    и настройки профиля, которые действуют в пределах соединения"""
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError(f'Unknown SQLite profile: {profile}')
+    if not read_only:
+        mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if mode.lower() != 'wal':
+            print(f"SQLite: WAL is not available, journal_mode={mode}")
+    for name, value in PRAGMA_PROFILES[profile].items():
+        conn.execute(f"PRAGMA {name}={value}")
+
+def describe_pragmas(conn: sqlite3.Connection) -> Dict:
+    """Фактические значения настроек соединения - для вывода при запуске"""
+    settings = {'journal_mode': conn.execute("PRAGMA journal_mode").fetchone()[0]}
+    for name in PRAGMA_PROFILES[DEFAULT_PROFILE]:
+        settings[name] = conn.execute(f"PRAGMA {name}").fetchone()[0]
+    settings['synchronous'] = SYNCHRONOUS_NAMES.get(settings['synchronous'], settings['synchronous'])
+    settings['temp_store'] = TEMP_STORE_NAMES.get(settings['temp_store'], settings['temp_store'])
+    return settings
+
+def format_pragmas(profile: str, settings: Dict) -> str:
+    return f"SQLite profile '{profile}': " + ', '.join(f'{name}={value}' for name, value in settings.items())
+
+class ConnectionPool:
+    """Пул соединений SQLite.
+
+    reader() выдает читающее соединение (mode=ro) на время блока with и возвращает его в пул;
+    writer() - общее пишущее соединение под блокировкой, коммит при выходе без исключения.
+    Соединение, простоявшее в пуле дольше health_check_interval, перед выдачей проверяется
+    запросом SELECT 1 и пересоздается, если база стала недоступна.
+    """
+    def __init__(self, path: str = DB_PATH, readers: int = 8, cached_statements: int = 256,
+                 health_check_interval: float = 30.0, checkout_timeout: float = 10.0,
+                 profile: str = DEFAULT_PROFILE):
+        self.path = path
+        self.profile = profile
+        self.max_readers = readers
+        self.cached_statements = cached_statements
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        self.lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        # (соединение, время возврата в пул); LIFO - чтобы чаще работали уже прогретые соединения
+        self.idle: queue.LifoQueue = queue.LifoQueue()
+        self.readers_open = 0
+        self.writer_conn: Optional[sqlite3.Connection] = None
+        self.writer_checked = 0.0
+        self.checkouts = 0
+        self.waits = 0
+        self.opened = 0
+        self.replaced = 0
+
+    def check_fork(self):
+        # Соединения, унаследованные через fork, нельзя ни использовать, ни закрывать:
+        # close() снял бы блокировки родителя. Просто забываем их и открываем свои
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.reset()
+
+    def connect(self, read_only: bool) -> sqlite3.Connection:
+        if read_only:
+            conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False,
+                                   cached_statements=self.cached_statements)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False,
+                                   cached_statements=self.cached_statements)
+        try:
+            apply_pragmas(conn, self.profile, read_only)
+        except sqlite3.Error:
+            conn.close()
+            raise
+        self.opened += 1
+        return conn
+
+    def healthy(self, conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def checkout(self) -> sqlite3.Connection:
+        self.check_fork()
+        self.checkouts += 1
+        try:
+            conn, returned = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.readers_open < self.max_readers
+                if can_open:
+                    self.readers_open += 1
+            if can_open:
+                try:
+                    return self.connect(read_only=True)
+                except sqlite3.Error:
+                    with self.lock:
+                        self.readers_open -= 1
+                    raise
+            self.waits += 1
+            try:
+                conn, returned = self.idle.get(timeout=self.checkout_timeout)
+            except queue.Empty:
+                raise sqlite3.OperationalError('Connection pool exhausted')
+        if time.monotonic() - returned > self.health_check_interval and not self.healthy(conn):
+            self.replaced += 1
+            conn.close()
+            try:
+                return self.connect(read_only=True)
+            except sqlite3.Error:
+                with self.lock:
+                    self.readers_open -= 1
+                raise
+        return conn
+
+    def release(self, conn: sqlite3.Connection, broken: bool = False):
+        if broken:
+            conn.close()
+            with self.lock:
+                self.readers_open -= 1
+            return
+        self.idle.put((conn, time.monotonic()))
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        pid = os.getpid()
+        conn = self.checkout()
+        broken = False
+        try:
+            yield conn
+        except sqlite3.DatabaseError:
+            broken = not self.healthy(conn)
+            raise
+        finally:
+            if pid == os.getpid():
+                self.release(conn, broken)
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        self.check_fork()
+        with self.write_lock:
+            conn = self.writer_conn
+            now = time.monotonic()
+            if conn is not None and now - self.writer_checked > self.health_check_interval:
+                if not self.healthy(conn):
+                    self.replaced += 1
+                    conn.close()
+                    conn = None
+            if conn is None:
+                conn = self.writer_conn = self.connect(read_only=False)
+            self.writer_checked = now
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def close(self):
+        """Закрывает все соединения; пул можно использовать дальше - они откроются заново"""
+        with self.write_lock:
+            if self.writer_conn is not None and self.pid == os.getpid():
+                self.writer_conn.close()
+            self.writer_conn = None
+        connections: List[sqlite3.Connection] = []
+        while True:
+            try:
+                connections.append(self.idle.get_nowait()[0])
+            except queue.Empty:
+                break
+        with self.lock:
+            self.readers_open -= len(connections)
+        if self.pid == os.getpid():
+            for conn in connections:
+                conn.close()
+
+    @property
+    def durable(self) -> bool:
+        """Переживает ли закоммиченная запись сбой питания (fsync на каждый коммит)"""
+        return PRAGMA_PROFILES[self.profile]['synchronous'] in ('FULL', 'EXTRA')
+
+    def describe(self) -> str:
+        with self.writer() as conn:
+            return format_pragmas(self.profile, describe_pragmas(conn))
+
+    def stats(self) -> Dict:
+        return {
+            'profile': self.profile,
+            'readers_open': self.readers_open,
+            'readers_idle': self.idle.qsize(),
+            'max_readers': self.max_readers,
+            'writer_open': self.writer_conn is not None,
+            'cached_statements': self.cached_statements,
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'opened': self.opened,
+            'replaced': self.replaced
+        }
+
+class PendingWrite:
+    """Запись, ожидающая группового коммита"""
+    def __init__(self, sql: str, params: tuple, payload: Any = None):
+        self.sql = sql
+        self.params = params
+        self.payload = payload
+        self.done = threading.Event()
+        self.rowid: Optional[int] = None
+        self.error: Optional[Exception] = None
+
+    def wait(self) -> int:
+        """Ждет коммита и возвращает rowid вставленной строки"""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.rowid
+
+class GroupCommitWriter:
+    """Групповой коммит: один поток собирает ожидающие вставки и коммитит их одной транзакцией
+    (до max_batch штук, дожидаясь новых не дольше max_delay секунд), так что fsync делится на всю пачку.
+
+    on_commit(пачка) вызывается в этом же потоке после коммита и до того, как ожидающие
+    проснутся, - пачки приходят в него строго в порядке rowid. Поток запускается при первой
+    записи, в том числе заново после fork.
+    """
+    def __init__(self, pool: ConnectionPool, max_batch: int = 256, max_delay: float = 0.0,
+                 on_commit: Optional[Callable[[List[PendingWrite]], None]] = None):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.on_commit = on_commit
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pending: queue.Queue = queue.Queue()
+        self.batches = 0
+        self.writes = 0
+        self.largest_batch = 0
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pending = queue.Queue()
+                thread = threading.Thread(target=self.run, name='bigako-group-commit', daemon=True)
+                thread.start()
+                self.pid = os.getpid()
+
+    def submit(self, sql: str, params: tuple, payload: Any = None) -> PendingWrite:
+        self.ensure_started()
+        write = PendingWrite(sql, params, payload)
+        self.pending.put(write)
+        return write
+
+    def collect(self) -> List[PendingWrite]:
+        # При max_delay = 0 в пачку попадает все, что накопилось, пока шел предыдущий коммит:
+        # под нагрузкой пачки растут сами, а одиночная запись не ждет лишнего
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.pending.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def insert(self, batch: List[PendingWrite]):
+        with self.pool.writer() as conn:
+            for write in batch:
+                write.rowid = conn.execute(write.sql, write.params).lastrowid
+
+    def write(self, batch: List[PendingWrite]) -> List[PendingWrite]:
+        try:
+            self.insert(batch)
+            return batch
+        except sqlite3.Error as e:
+            if len(batch) == 1:
+                batch[0].error = e
+                return []
+        # Одна неудачная вставка не должна ронять всю пачку: повторяем по одной
+        committed = []
+        for write in batch:
+            try:
+                self.insert([write])
+                committed.append(write)
+            except sqlite3.Error as e:
+                write.error = e
+        return committed
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            committed = self.write(batch)
+            self.batches += 1
+            self.writes += len(committed)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            if committed and self.on_commit is not None:
+                try:
+                    self.on_commit(committed)
+                except Exception:
+                    traceback.print_exc()
+            for write in batch:
+                write.done.set()
+
+    def stats(self) -> Dict:
+        return {
+            'batches': self.batches,
+            'writes': self.writes,
+            'avg_batch': round(self.writes / self.batches, 2) if self.batches else 0.0,
+            'largest_batch': self.largest_batch,
+            'queued': self.pending.qsize(),
+            'max_batch': self.max_batch,
+            'max_delay_ms': self.max_delay * 1000
+        }
@@ -0,0 +1,240 @@
+# hub.py
+"""Рассылка новых сообщений внутри процесса BigAko: MessageHub и очереди подписчиков.
+
+Каждое сообщение кодируется один раз (HubEvent): JSON, событие SSE и кадр WebSocket
+получают все подписчики одними и теми же байтами. Подписчик, отставший сильнее своей
+очереди или вообще подключившийся со старым id, догружает пропущенное страницами по
+FETCH_LIMIT через fetch_since хаба.
+
+Проверка догрузки на хранилище в памяти:
+    python hub.py
+"""
+import argparse
+import json
+import struct
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+# Коды кадров WebSocket (RFC 6455): кадр с сообщением HubEvent кодирует сам
+WS_OP_CONTINUATION = 0x0
+WS_OP_TEXT = 0x1
+WS_OP_BINARY = 0x2
+WS_OP_CLOSE = 0x8
+WS_OP_PING = 0x9
+WS_OP_PONG = 0xA
+
+def encode_ws_frame(opcode: int, payload: bytes = b'') -> bytes:
+    # Кадры сервера не маскируются (RFC 6455, 5.1)
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+class HubEvent:
+    """Новое сообщение, закодированное один раз: те же байты получают все подписчики"""
+    __slots__ = ('message', 'id', '_json', '_sse', '_ws_frame')
+    
+    def __init__(self, message: Dict):
+        self.message = message
+        self.id = message['id']
+        self._json = None
+        self._sse = None
+        self._ws_frame = None
+    
+    @property
+    def json(self) -> bytes:
+        if self._json is None:
+            self._json = json.dumps(self.message).encode()
+        return self._json
+    
+    @property
+    def sse(self) -> bytes:
+        if self._sse is None:
+            self._sse = b'id: %d\nevent: message\ndata: %s\n\n' % (self.id, self.json)
+        return self._sse
+    
+    @property
+    def ws_frame(self) -> bytes:
+        if self._ws_frame is None:
+            self._ws_frame = encode_ws_frame(WS_OP_TEXT, self.json)
+        return self._ws_frame
+
+# Сколько сообщений за раз читает догрузка подписчика, если буфер ее уже не покрывает
+FETCH_LIMIT = 100
+
+class SlowConsumerError(Exception):
+    pass
+
+class Subscription:
+    """Ограниченная очередь одного подписчика хаба.
+
+    Переполнение обрабатывается по политике: drop_oldest выбрасывает самые старые события,
+    disconnect отключает подписчика, coalesce схлопывает очередь в одну догрузку из буфера/базы.
+    """
+    POLICIES = ('drop_oldest', 'disconnect', 'coalesce')
+    
+    def __init__(self, hub: 'MessageHub', last_id: int, maxsize: int, policy: str,
+                 waker: Optional[Callable[[], None]] = None, room_id: Optional[int] = None):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown slow consumer policy: {policy}')
+        self.hub = hub
+        self.last_id = last_id
+        # Подписка на одну комнату; None - на все сообщения
+        self.room_id = room_id
+        self.maxsize = maxsize
+        self.policy = policy
+        self.waker = waker
+        self.events: deque = deque()
+        self.cond = threading.Condition()
+        # Первая выборка догружает все, что новее last_id, уже после регистрации в хабе
+        self.needs_fetch = True
+        self.closed = False
+        self.dropped = 0
+    
+    def push(self, events: List[HubEvent]):
+        with self.cond:
+            if self.closed:
+                return
+            for event in events:
+                if self.room_id is not None and event.message.get('room_id') != self.room_id:
+                    continue
+                if self.needs_fetch and self.policy == 'coalesce':
+                    # Догрузка все равно прочитает это событие из буфера
+                    continue
+                if len(self.events) >= self.maxsize:
+                    self.dropped += 1
+                    if self.policy == 'disconnect':
+                        self.closed = True
+                        break
+                    if self.policy == 'coalesce':
+                        self.events.clear()
+                        self.needs_fetch = True
+                        continue
+                    self.events.popleft()
+                self.events.append(event)
+            self.cond.notify_all()
+        if self.waker is not None:
+            self.waker()
+    
+    def take(self) -> List[HubEvent]:
+        """Забирает накопленные события без ожидания; повторы по id отбрасываются"""
+        with self.cond:
+            if self.closed:
+                raise SlowConsumerError('Subscriber queue overflow')
+            events = list(self.events)
+            self.events.clear()
+            needs_fetch, self.needs_fetch = self.needs_fetch, False
+        if needs_fetch:
+            fetched = self.hub.fetch_since(self.last_id, self.room_id)
+            if len(fetched) >= FETCH_LIMIT:
+                # Полная страница - за ней могут быть еще сообщения. События из очереди новее их:
+                # отдать их сейчас значило бы перескочить через остаток, его прочитает следующая догрузка
+                events = []
+                with self.cond:
+                    self.needs_fetch = True
+            events = [HubEvent(m) for m in fetched] + events
+        fresh = []
+        for event in events:
+            if event.id > self.last_id:
+                fresh.append(event)
+                self.last_id = event.id
+        return fresh
+    
+    def get(self, timeout: float) -> List[HubEvent]:
+        """Ждет новых событий до timeout; уже отданные (повторы по id) ожидание не прерывают"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.events or self.needs_fetch or self.closed,
+                                   deadline - time.monotonic())
+            events = self.take()
+            if events or time.monotonic() >= deadline:
+                return events
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.waker is not None:
+            self.waker()
+
+class MessageHub:
+    """Внутрипроцессная рассылка новых сообщений потокам SSE, WebSocket и long polling.
+
+    publish() никогда не блокируется на медленном подписчике: у каждого своя ограниченная очередь.
+    """
+    def __init__(self, fetch_since: Callable[[int, Optional[int]], List[Dict]], queue_size: int = 256,
+                 policy: str = 'coalesce'):
+        self.fetch_since = fetch_since
+        self.queue_size = queue_size
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.subscribers = set()
+    
+    def subscribe(self, last_id: int, waker: Optional[Callable[[], None]] = None,
+                  policy: Optional[str] = None, room_id: Optional[int] = None) -> Subscription:
+        subscription = Subscription(self, last_id, self.queue_size, policy or self.policy, waker, room_id)
+        with self.lock:
+            self.subscribers.add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+    
+    def publish(self, messages: List[Dict]):
+        events = [HubEvent(m) for m in messages]
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            subscription.push(events)
+    
+    def stats(self) -> Dict:
+        with self.lock:
+            subscribers = list(self.subscribers)
+        return {
+            'subscribers': len(subscribers),
+            'queued': sum(len(s.events) for s in subscribers),
+            'dropped': sum(s.dropped for s in subscribers)
+        }
+
+def check_catch_up(count: int = 1500, log: Callable[[str], None] = print) -> bool:
+    """Подписчик, отставший больше чем на FETCH_LIMIT сообщений (старый Last-Event-ID,
+    переполнение coalesce), получает все пропущенные сообщения по порядку, даже если
+    до догрузки пришло новое событие"""
+    from storage import MemoryStorage, make_users, post
+    storage = MemoryStorage()
+    storage.init()
+    user_id, = make_users(storage, 'checker')
+    for n in range(count):
+        post(storage, user_id, 'checker', f'message {n}')
+    hub = MessageHub(lambda after_id, room_id: storage.messages_after(after_id, FETCH_LIMIT, room_id))
+    passed = True
+    for policy in Subscription.POLICIES:
+        subscription = hub.subscribe(0, policy=policy)
+        new_id = post(storage, user_id, 'checker', f'after subscribe ({policy})')
+        hub.publish(storage.messages_after(new_id - 1, 1))
+        ids = []
+        while True:
+            events = subscription.take()
+            if not events:
+                break
+            ids += [event.id for event in events]
+        hub.unsubscribe(subscription)
+        expected = list(range(1, storage.last_message_id() + 1))
+        passed = passed and ids == expected
+        log(f"  {'ok' if ids == expected else 'FAILED':7} catch-up ({policy}): "
+            f"{len(ids)} of {len(expected)} messages")
+    return passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BigAko message hub check')
+    parser.add_argument('--count', type=int, default=1500, help='сколько сообщений пропускает подписчик')
+    args = parser.parse_args()
+    raise SystemExit(0 if check_catch_up(args.count) else 1)
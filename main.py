@@ -4,23 +4,414 @@ import sqlite3
 import json
 import hashlib
 import secrets
+import struct
 import time
 import base64
 import os
 import uuid
-from urllib.parse import parse_qs, urlparse
+import queue
+import argparse
+import asyncio
+import io
+import http.client
+import signal
+import socket
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs, urlparse, unquote
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
 import threading
+import tempfile
+from collections import OrderedDict, deque
+from itertools import islice
+from bus import LocalBus, SocketBus, BusBroker
+from database import GroupCommitWriter, PendingWrite, PRAGMA_PROFILES, DEFAULT_PROFILE, apply_pragmas, now_ms
+from migrations import MigrationError
+from archive import ArchiveBusy, ArchiveMismatch, archive_messages
+from storage import GENERAL_ROOM_ID, MESSAGE_SELECT, STORAGE_BACKENDS, LogStorage, SQLiteStorage, Storage, row_to_message
+from hub import (FETCH_LIMIT, WS_OP_BINARY, WS_OP_CLOSE, WS_OP_CONTINUATION, WS_OP_PING, WS_OP_PONG, WS_OP_TEXT,
+                 HubEvent, MessageHub, SlowConsumerError, Subscription, encode_ws_frame)
+
+HISTORY_SIZE = 1000
+ROOM_HISTORY_SIZE = 100
+CACHED_ROOMS = 1000
+
+class MessageRing:
+    """Последние сообщения по возрастанию id. Кольцо содержит все подходящие ему сообщения
+    с id > floor; floor = 0 - более старых сообщений нет совсем"""
+    __slots__ = ('messages', 'floor')
+    
+    def __init__(self, size: int, floor: int, messages=()):
+        messages = list(messages)
+        if len(messages) > size:
+            floor = messages[-size - 1]['id']
+        self.messages = deque(messages, maxlen=size)
+        self.floor = floor
+    
+    def append(self, message: Dict):
+        if len(self.messages) == self.messages.maxlen:
+            self.floor = self.messages[0]['id']
+        self.messages.append(message)
+    
+    def after(self, after_id: int) -> List[Dict]:
+        # С конца: дельта обычно короче кольца
+        messages = []
+        for message in reversed(self.messages):
+            if message['id'] <= after_id:
+                break
+            messages.append(message)
+        messages.reverse()
+        return messages
+    
+    def last(self, limit: int) -> List[Dict]:
+        return list(islice(self.messages, max(len(self.messages) - limit, 0), None))
+
+class MessageCache:
+    """Кэш последних сообщений: общее кольцо на size сообщений и по кольцу на room_size
+    для последних активных комнат. Последние сообщения комнаты и дельты после id не старше
+    floor отдаются отсюда, остальное читается из хранилища.
+
+    Сообщения попадают сюда только через add (строго по возрастанию id, после записи в базу),
+    поэтому кольца не бывают дырявыми. Кольцо комнаты без записей строится из общего.
+    """
+    
+    def __init__(self, size: int = HISTORY_SIZE, room_size: int = ROOM_HISTORY_SIZE, max_rooms: int = CACHED_ROOMS):
+        self.size = size
+        self.room_size = room_size
+        self.max_rooms = max_rooms
+        self.lock = threading.Lock()
+        self.all = MessageRing(size, 0)
+        self.rooms: OrderedDict = OrderedDict()
+        self.last_id = 0
+        # Меняется при reset: заполнение комнаты, прочитанной до сброса, отбрасывается
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+    
+    def reset(self, messages: List[Dict], floor: int, last_id: int):
+        """Заполняет кэш заново: messages - все сообщения с id > floor по возрастанию"""
+        with self.lock:
+            self.all = MessageRing(self.size, floor, messages)
+            self.rooms.clear()
+            self.last_id = max(last_id, messages[-1]['id'] if messages else 0)
+            self.generation += 1
+    
+    def add(self, messages: List[Dict]):
+        with self.lock:
+            for message in messages:
+                ring = self.room_ring(message['room_id'])
+                self.all.append(message)
+                ring.append(message)
+            self.last_id = max(self.last_id, messages[-1]['id'])
+    
+    def room_ring(self, room_id: int) -> MessageRing:
+        ring = self.rooms.get(room_id)
+        if ring is not None:
+            self.rooms.move_to_end(room_id)
+            return ring
+        # Общее кольцо покрывает все комнаты с той же границей
+        ring = self.rooms[room_id] = MessageRing(
+            self.room_size, self.all.floor, (m for m in self.all.messages if m['room_id'] == room_id)
+        )
+        if len(self.rooms) > self.max_rooms:
+            self.rooms.popitem(last=False)
+        return ring
+    
+    def recent(self, limit: int, room_id: int) -> Optional[List[Dict]]:
+        """Последние limit сообщений комнаты; None - кольцо их не покрывает"""
+        with self.lock:
+            ring = self.room_ring(room_id)
+            if len(ring.messages) >= limit or ring.floor == 0:
+                self.hits += 1
+                return ring.last(limit)
+            self.misses += 1
+            return None
+    
+    def since(self, after_id: int, room_id: Optional[int] = None) -> Optional[List[Dict]]:
+        """Сообщения новее after_id; None - кэш уже не покрывает этот диапазон"""
+        with self.lock:
+            if after_id >= self.last_id:
+                self.hits += 1
+                return []
+            ring = self.rooms.get(room_id) if room_id is not None else None
+            if ring is not None and after_id >= ring.floor:
+                self.hits += 1
+                return ring.after(after_id)
+            if after_id >= self.all.floor:
+                self.hits += 1
+                messages = self.all.after(after_id)
+                if room_id is not None:
+                    messages = [m for m in messages if m['room_id'] == room_id]
+                return messages
+            self.misses += 1
+            return None
+    
+    def mark(self) -> Tuple[int, int]:
+        """Состояние кэша перед чтением из хранилища - для fill"""
+        with self.lock:
+            return self.generation, self.last_id
+    
+    def fill(self, room_id: int, messages: List[Dict], limit: int, mark: Tuple[int, int]):
+        """Дополняет кольцо комнаты последними limit сообщениями, прочитанными из хранилища.
+
+        Прочитанное покрывает сообщения комнаты до mark: если кольцо начинается не позже,
+        вместе они дают непрерывную историю.
+        """
+        generation, read_upto = mark
+        floor = messages[0]['id'] - 1 if len(messages) == limit else 0
+        with self.lock:
+            if generation != self.generation:
+                return
+            ring = self.room_ring(room_id)
+            if ring.floor > read_upto or floor >= ring.floor:
+                return
+            self.rooms[room_id] = MessageRing(
+                self.room_size, floor, [m for m in messages if m['id'] <= ring.floor] + list(ring.messages)
+            )
+            self.fills += 1
+    
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'messages': len(self.all.messages),
+                'floor': self.all.floor,
+                'rooms': len(self.rooms),
+                'hits': self.hits,
+                'misses': self.misses,
+                'fills': self.fills
+            }
 
 class BigAkoServer:
     def __init__(self):
+        # Кэш последних сообщений для истории и дельт; заполняет init_db, пополняет publish_messages
+        self.message_history = MessageCache()
+        # Открытые WebSocket по пользователям: счетчики для /api/stats и закрытие сокетов при выходе
         self.connections: Dict[str, List] = {}
-        self.message_history: List[Dict] = []
         self.lock = threading.Lock()
+        # Вставка и публикация идут под одной блокировкой, чтобы буфер пополнялся строго по id
+        self.write_lock = threading.Lock()
+        self.hub = MessageHub(self.get_messages_since)
+        self.last_message_id = 0
+        # Метка запуска входит в ETag, чтобы после перезапуска старые версии не совпали случайно
+        self.boot_id = secrets.token_hex(4)
         self.session_tokens: Dict[str, str] = {}
+        self.user_ids: Dict[str, int] = {}
+        # В режиме нескольких процессов сессии хранятся в базе, а не в памяти процесса
+        self.shared_state = False
+        self.sync_interval = 0.25
+        self.sync_wakeup = threading.Event()
+        # Сообщения других процессов могут прийти с шины раньше более старых: ждут здесь своей очереди
+        self.pending_messages: Dict[int, Dict] = {}
+        self.merge_lock = threading.Lock()
+        self.bus = LocalBus()
+        self.bus.start(self.publish_messages)
+        # Хранилище (storage.py); другое подключается через use_storage
+        self.db: Storage = SQLiteStorage('users.db')
+        # Групповой коммит add_message включается параметром --group-commit
+        self.group_commit: Optional[GroupCommitWriter] = None
+        # Перенос в архив включается параметром --archive-after (в днях)
+        self.archive_after: Optional[float] = None
+        self.archive_interval = 3600.0
         self.init_db()
-        
+    
+    def enable_shared_state(self):
+        self.shared_state = True
+        # Поток синхронизации публикует чужие сообщения, поэтому свои тоже идут через слияние по id
+        self.bus.start(self.merge_messages)
+    
+    def use_storage(self, storage: Storage):
+        self.db.close()
+        self.db = storage
+        self.user_ids.clear()
+        self.init_db()
+    
+    def enable_group_commit(self, max_batch: int = 256, max_delay: float = 0.0):
+        # Групповой коммит, синхронизация процессов и архив работают только с SQLiteStorage
+        self.group_commit = GroupCommitWriter(self.db.pool, max_batch, max_delay, on_commit=self.publish_committed)
+    
+    def publish_committed(self, writes: List[PendingWrite]):
+        """Вызывается потоком группового коммита: пачки идут по возрастанию id"""
+        entries = []
+        for write in writes:
+            write.payload['id'] = write.rowid
+            entries.append(write.payload)
+        with self.write_lock:
+            self.bus.publish(entries)
+    
+    def use_bus(self, bus):
+        """Подключает межпроцессную шину; сообщения с нее публикуются через merge_messages"""
+        self.bus.stop()
+        self.bus = bus
+        bus.start(self.merge_messages)
+    
+    def create_session(self, username: str) -> str:
+        token = secrets.token_hex(32)
+        if self.shared_state:
+            self.db.add_session(token, username)
+            return token
+        with self.lock:
+            self.session_tokens[token] = username
+        return token
+    
+    def get_session_user(self, token: Optional[str]) -> Optional[str]:
+        if not token:
+            return None
+        if self.shared_state:
+            return self.db.session_user(token)
+        with self.lock:
+            return self.session_tokens.get(token)
+    
+    def end_session(self, token: Optional[str]):
+        if self.shared_state:
+            self.db.delete_session(token)
+        else:
+            with self.lock:
+                self.session_tokens.pop(token, None)
+        # Сокеты этой сессии иначе получали бы сообщения и после выхода. В режиме нескольких
+        # процессов закрываются только сокеты текущего процесса
+        with self.lock:
+            closing = [connection for connections in self.connections.values()
+                       for connection in connections if token and connection.session == token]
+        for connection in closing:
+            connection.disconnect()
+    
+    def start_archiver(self):
+        """Фоновый перенос сообщений старше archive_after дней в архив раз в archive_interval секунд.
+
+        Его можно запускать в каждом процессе: писать в архив за раз будет только один,
+        остальные получат ArchiveBusy и попробуют в следующий раз.
+        """
+        if self.archive_after is None:
+            return
+        thread = threading.Thread(target=self.archive_loop, args=(self.archive_after * 86400, self.archive_interval),
+                                  name='bigako-archiver', daemon=True)
+        thread.start()
+    
+    def archive_loop(self, older_than: float, interval: float):
+        # Отдельное соединение: перенос читает и удаляет тысячи строк, пишущее соединение пула ему не нужно
+        conn = sqlite3.connect(self.db.path)
+        apply_pragmas(conn, self.db.pool.profile)
+        while True:
+            try:
+                archive_messages(conn, self.db.archive, older_than)
+            except ArchiveBusy:
+                pass
+            except (sqlite3.Error, OSError, ValueError, ArchiveMismatch) as e:
+                print(f"Archive error: {e}")
+            time.sleep(interval)
+    
+    def start_sync(self):
+        """Запускает фоновый поток, который подтягивает в message_history сообщения всех процессов.
+
+        Записи разных процессов коммитятся в порядке id, поэтому буфер заполняет только этот поток:
+        так в нем не бывает дыр, которые позже заполнились бы более старыми сообщениями.
+        """
+        thread = threading.Thread(target=self.sync_foreign_messages, name='bigako-sync', daemon=True)
+        thread.start()
+    
+    def sync_foreign_messages(self):
+        # Отдельное соединение, а не из пула: data_version считается для конкретного соединения
+        conn = sqlite3.connect(self.db.path)
+        apply_pragmas(conn, self.db.pool.profile, read_only=True)
+        # После fork база могла уйти вперед от кэша, заполненного родителем
+        with self.merge_lock:
+            self.fill_history()
+        last_version = None
+        while True:
+            try:
+                # data_version меняется, только когда в базу коммитит другое соединение;
+                # дыра в pending_messages значит, что шина что-то потеряла - читаем базу в любом случае
+                version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if version != last_version or self.pending_messages:
+                    last_version = version
+                    rows = conn.execute(
+                        f"{MESSAGE_SELECT} WHERE m.id > ? ORDER BY m.id",
+                        (self.last_message_id,)
+                    ).fetchall()
+                    if rows or self.pending_messages:
+                        self.merge_messages([row_to_message(row) for row in rows], from_db=True)
+            except sqlite3.Error as e:
+                print(f"Sync error: {e}")
+            self.sync_wakeup.wait(self.sync_interval)
+            self.sync_wakeup.clear()
+    
+    def merge_messages(self, messages: List[Dict], from_db: bool = False):
+        """Публикует сообщения с шины или из базы строго по возрастанию id.
+
+        Коммиты разных процессов идут в порядке id, но по шине сообщения приходят в порядке
+        доставки. Поэтому с шины публикуется только непрерывное продолжение буфера; если
+        впереди дыра, поток синхронизации закрывает ее чтением из базы (from_db=True).
+        """
+        with self.merge_lock:
+            last_id = self.last_message_id
+            ready = []
+            if from_db:
+                ready = [m for m in messages if m['id'] > last_id]
+                if ready:
+                    last_id = ready[-1]['id']
+            else:
+                for message in messages:
+                    if message['id'] > last_id:
+                        self.pending_messages[message['id']] = message
+            for message_id in [i for i in self.pending_messages if i <= last_id]:
+                del self.pending_messages[message_id]
+            while last_id + 1 in self.pending_messages:
+                last_id += 1
+                ready.append(self.pending_messages.pop(last_id))
+            if ready:
+                self.publish_messages(ready)
+            if self.pending_messages:
+                self.sync_wakeup.set()
+    
+    def publish_messages(self, messages: List[Dict]):
+        """Добавляет новые сообщения (строго по возрастанию id) в буфер и будит всех подписчиков"""
+        with self.lock:
+            self.message_history.add(messages)
+            self.last_message_id = max(self.last_message_id, messages[-1]['id'])
+        self.hub.publish(messages)
+    
+    def register_connection(self, username: str, connection):
+        with self.lock:
+            self.connections.setdefault(username, []).append(connection)
+    
+    def unregister_connection(self, username: str, connection):
+        with self.lock:
+            conns = self.connections.get(username, [])
+            if connection in conns:
+                conns.remove(connection)
+            if not conns:
+                self.connections.pop(username, None)
+    
+    def connection_stats(self) -> Dict:
+        with self.lock:
+            return {
+                'websockets': sum(len(conns) for conns in self.connections.values()),
+                'users': {username: len(conns) for username, conns in self.connections.items()}
+            }
+    
+    def wait_for_messages(self, after_id: int, timeout: float, room_id: Optional[int] = None) -> List[Dict]:
+        # Long polling забирает одну пачку, отключать его за переполнение незачем
+        subscription = self.hub.subscribe(after_id, policy='coalesce', room_id=room_id)
+        try:
+            events = subscription.take()
+            if not events and timeout > 0:
+                events = subscription.get(timeout)
+            return [event.message for event in events]
+        finally:
+            self.hub.unsubscribe(subscription)
+    
+    def messages_etag(self) -> str:
+        return f'"{self.boot_id}-{self.last_message_id}"'
+    
+    def get_messages_since(self, after_id: int, room_id: Optional[int] = None) -> List[Dict]:
+        messages = self.message_history.since(after_id, room_id)
+        if messages is None:
+            messages = self.get_messages_after(after_id, FETCH_LIMIT, room_id)
+        return messages
+    
     def generate_salt(self) -> str:
         return secrets.token_hex(16)
     
@@ -28,199 +419,710 @@ class BigAkoServer:
         return hashlib.sha256((password + salt).encode()).hexdigest()
     
     def init_db(self):
-        if os.path.exists('users.db'):
-            try:
-                conn = sqlite3.connect('users.db')
-                cursor = conn.cursor()
-                
-                # Проверяем существование таблиц и обновляем структуру если нужно
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
-                if not cursor.fetchone():
-                    cursor.execute('''
-                        CREATE TABLE users (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            username TEXT UNIQUE NOT NULL,
-                            password_hash TEXT NOT NULL,
-                            salt TEXT NOT NULL,
-                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                        )
-                    ''')
-                
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'")
-                if not cursor.fetchone():
-                    cursor.execute('''
-                        CREATE TABLE messages (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            username TEXT NOT NULL,
-                            message TEXT NOT NULL,
-                            message_type TEXT DEFAULT 'text',
-                            file_name TEXT,
-                            file_size INTEGER,
-                            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                        )
-                    ''')
-                
-                conn.commit()
-                conn.close()
-            except Exception as e:
-                print(f"Database error: {e}")
-                os.remove('users.db')
+        # Схему SQLite создают и обновляют миграции; при ошибке база остается как есть
+        try:
+            self.db.init()
+            self.fill_history()
+        except (sqlite3.Error, MigrationError) as e:
+            print(f"Database error: {e}")
+        except ArchiveMismatch as e:
+            # С чужим архивом история показала бы старые сообщения, а перенос удалил бы новые
+            print(f"Archive error: {e}")
+            raise SystemExit(1)
         
         # Создаем папку для файлов
         os.makedirs('uploads', exist_ok=True)
     
+    def fill_history(self):
+        """Заполняет message_history последними сообщениями хранилища"""
+        last_id = self.db.last_message_id()
+        floor = max(last_id - self.message_history.size, 0)
+        # В (floor, last_id] не больше size id, поэтому сюда попадают все сообщения после floor
+        messages = self.db.messages_after(floor, self.message_history.size)
+        self.message_history.reset(messages, floor, last_id)
+        with self.lock:
+            self.last_message_id = self.message_history.last_id
+    
     def register_user(self, username: str, password: str) -> bool:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        
-        try:
-            salt = self.generate_salt()
-            password_hash = self.hash_password(password, salt)
-            
-            cursor.execute(
-                "INSERT INTO users (username, password_hash, salt) VALUES (?, ?, ?)",
-                (username, password_hash, salt)
-            )
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
-        finally:
-            conn.close()
+        salt = self.generate_salt()
+        return self.db.add_user(username, self.hash_password(password, salt), salt)
+    
+    def get_user_id(self, username: str) -> Optional[int]:
+        # Имена пользователей не меняются, поэтому соответствие можно кэшировать навсегда
+        user_id = self.user_ids.get(username)
+        if user_id is None:
+            user = self.db.find_user(username)
+            if user:
+                user_id = self.user_ids[username] = user[0]
+        return user_id
     
     def verify_user(self, username: str, password: str) -> bool:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT password_hash, salt FROM users WHERE username = ?",
-            (username,)
-        )
-        result = cursor.fetchone()
-        conn.close()
-        
-        if result:
-            stored_hash, salt = result
+        user = self.db.find_user(username)
+        if user:
+            _, stored_hash, salt = user
             return self.hash_password(password, salt) == stored_hash
         return False
     
     def add_message(self, username: str, message: str, message_type: str = 'text', 
-                   file_name: str = None, file_size: int = None):
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
+                   file_name: str = None, file_size: int = None, room_id: int = GENERAL_ROOM_ID) -> Dict:
+        # Доступ к комнате проверяет вызывающий (can_access_room) - один раз на запрос или соединение
+        # Миллисекунды UTC: в памяти, в базе и у клиента одно и то же число
+        timestamp = now_ms()
+        user_id = self.get_user_id(username)
+        entry = {
+            'id': None,
+            'username': username,
+            'message': message,
+            'message_type': message_type,
+            'file_name': file_name,
+            'file_size': file_size,
+            'timestamp': timestamp,
+            'room_id': room_id
+        }
+        if self.group_commit is not None:
+            # id проставит и сообщение опубликует поток группового коммита (publish_committed)
+            sql, params = self.db.message_insert(user_id, entry)
+            self.group_commit.submit(sql, params, entry).wait()
+            return entry
         
-        cursor.execute(
-            "INSERT INTO messages (username, message, message_type, file_name, file_size) VALUES (?, ?, ?, ?, ?)",
-            (username, message, message_type, file_name, file_size)
-        )
-        conn.commit()
-        conn.close()
-        
-        with self.lock:
-            self.message_history.append({
-                'username': username,
-                'message': message,
-                'message_type': message_type,
-                'file_name': file_name,
-                'file_size': file_size,
-                'timestamp': datetime.now().isoformat()
-            })
-            if len(self.message_history) > 100:
-                self.message_history = self.message_history[-100:]
-    
-    def get_recent_messages(self, limit: int = 50) -> List[Dict]:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT username, message, message_type, file_name, file_size, timestamp FROM messages ORDER BY id DESC LIMIT ?",
-            (limit,)
+        with self.write_lock:
+            entry['id'] = self.db.add_message(user_id, entry)
+            self.bus.publish([entry])
+        return entry
+    
+    def get_recent_messages(self, limit: int = 50, room_id: int = GENERAL_ROOM_ID) -> List[Dict]:
+        if self.shared_state:
+            # Сообщение другого процесса может еще идти по шине, а отправитель уже открывает историю:
+            # дочитываем из базы то, что новее кэша (обычно пустой ответ по первичному ключу)
+            newer = self.db.messages_after(self.last_message_id, self.message_history.size)
+            if newer:
+                self.merge_messages(newer, from_db=True)
+        messages = self.message_history.recent(limit, room_id)
+        if messages is None:
+            mark = self.message_history.mark()
+            messages = self.db.recent_messages(room_id, limit)
+            self.message_history.fill(room_id, messages, limit, mark)
+        return messages
+    
+    def get_messages_before(self, before_id: int, limit: int = 50, room_id: int = GENERAL_ROOM_ID) -> List[Dict]:
+        """Страница истории перед before_id (keyset-пагинация, без OFFSET)"""
+        return self.db.messages_before(room_id, before_id, limit)
+    
+    def get_messages_after(self, after_id: int, limit: int = 100, room_id: Optional[int] = None) -> List[Dict]:
+        return self.db.messages_after(after_id, limit, room_id)
+    
+    def search(self, username: str, text: str, room_id: Optional[int] = None, sender: Optional[str] = None,
+               date_from=None, date_to=None, sort: str = 'rank', cursor: Optional[str] = None,
+               limit: int = 20) -> Dict:
+        """Полнотекстовый поиск; без room_id - по всем комнатам, доступным пользователю"""
+        sender_id = None
+        if sender:
+            sender_id = self.get_user_id(sender)
+            if sender_id is None:
+                return {'results': [], 'next_cursor': None}
+        results, next_cursor = self.db.search(
+            self.get_user_id(username), text, room_id, sender_id, date_from, date_to, sort, cursor, limit
         )
-        messages = [
-            {
-                'username': row[0],
-                'message': row[1],
-                'message_type': row[2],
-                'file_name': row[3],
-                'file_size': row[4],
-                'timestamp': row[5]
-            }
-            for row in cursor.fetchall()
-        ]
-        conn.close()
-        return messages[::-1]
+        return {'results': results, 'next_cursor': next_cursor}
+    
+    def can_access_room(self, username: str, room_id: int) -> bool:
+        user_id = self.get_user_id(username)
+        return user_id is not None and self.db.room_access(user_id, room_id)
+    
+    def can_access_file(self, username: str, file_name: str) -> bool:
+        room_id = self.db.file_room(file_name)
+        return room_id is not None and self.can_access_room(username, room_id)
+    
+    def list_rooms(self, username: str) -> List[Dict]:
+        """Открытые комнаты и те, где пользователь участник; у личных диалогов имя - собеседник"""
+        rooms = self.db.list_rooms(self.get_user_id(username))
+        for room in rooms:
+            room['name'] = room['name'] or username
+        return rooms
+    
+    def create_room(self, username: str, name: str, members: List[str]) -> Optional[Dict]:
+        """Групповая комната; None - если кого-то из участников не существует"""
+        member_ids = {self.get_user_id(member) for member in [username] + members}
+        if None in member_ids:
+            return None
+        room_id = self.db.add_group_room(name, self.get_user_id(username), sorted(member_ids))
+        return {'id': room_id, 'kind': 'group', 'name': name}
+    
+    def get_direct_room(self, username: str, other: str) -> Optional[Dict]:
+        """Личный диалог двух пользователей: находит существующий или создает"""
+        user_id, other_id = self.get_user_id(username), self.get_user_id(other)
+        if user_id is None or other_id is None or user_id == other_id:
+            return None
+        return {'id': self.db.direct_room(user_id, other_id), 'kind': 'dm', 'name': other}
+    
+    def add_room_member(self, room_id: int, username: str) -> bool:
+        # В личный диалог третьего не добавить, а в открытую комнату добавлять незачем
+        user_id = self.get_user_id(username)
+        return user_id is not None and self.db.add_room_member(room_id, user_id)
+
+def session_token_from_cookie(cookie: str) -> Optional[str]:
+    for part in cookie.split(';'):
+        if 'session=' in part:
+            return part.split('session=')[1].strip()
+    return None
+
+MAX_LONG_POLL_TIMEOUT = 30
+
+def long_poll_params(query: Dict[str, List[str]]) -> Optional[Tuple[int, float]]:
+    """Разбирает ?since=<id>&timeout=<сек> для long polling; None - обычный запрос истории"""
+    since = query.get('since', [''])[0]
+    if not since.isdigit():
+        return None
+    try:
+        timeout = float(query.get('timeout', ['25'])[0])
+    except ValueError:
+        timeout = 25.0
+    return int(since), max(0.0, min(timeout, MAX_LONG_POLL_TIMEOUT))
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def page_limit(query: Dict[str, List[str]]) -> int:
+    """?limit= для страниц истории, ограниченный сверху MAX_PAGE_SIZE"""
+    limit = query.get('limit', [''])[0]
+    if not limit.isdigit():
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+    'Connection': 'close'
+}
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+def websocket_accept_key(key: str) -> str:
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+
+def unmask_ws_payload(payload: bytes, mask: bytes) -> bytes:
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+def parse_ws_header(head: bytes) -> Tuple[bool, int, bool, int]:
+    fin = bool(head[0] & 0x80)
+    opcode = head[0] & 0x0F
+    masked = bool(head[1] & 0x80)
+    return fin, opcode, masked, head[1] & 0x7F
+
+def is_websocket_upgrade(headers) -> bool:
+    return (headers.get('Upgrade', '').lower() == 'websocket'
+            and 'upgrade' in headers.get('Connection', '').lower()
+            and headers.get('Sec-WebSocket-Version') == '13'
+            and bool(headers.get('Sec-WebSocket-Key')))
+
+def websocket_handshake_response(key: str) -> bytes:
+    return (
+        'HTTP/1.1 101 Switching Protocols\r\n'
+        'Upgrade: websocket\r\n'
+        'Connection: Upgrade\r\n'
+        f'Sec-WebSocket-Accept: {websocket_accept_key(key)}\r\n\r\n'
+    ).encode()
+
+def ws_close_payload(code: int) -> bytes:
+    return struct.pack('!H', code)
+
+class WebSocketProtocolError(Exception):
+    def __init__(self, code: int, reason: str):
+        super().__init__(reason)
+        self.code = code
+
+class WebSocketMessageAssembler:
+    """Собирает фрагментированные сообщения и проверяет правила RFC 6455 для входящих кадров"""
+    max_message_size = 64 * 1024
+    
+    def __init__(self):
+        self.opcode = None
+        self.parts: List[bytes] = []
+        self.size = 0
+    
+    def check_header(self, fin: bool, opcode: int, masked: bool, length: int):
+        if not masked:
+            raise WebSocketProtocolError(1002, 'Client frames must be masked')
+        if opcode >= WS_OP_CLOSE and (not fin or length > 125):
+            raise WebSocketProtocolError(1002, 'Invalid control frame')
+        if length > self.max_message_size:
+            raise WebSocketProtocolError(1009, 'Message too big')
+    
+    def feed(self, fin: bool, opcode: int, payload: bytes) -> Optional[Tuple[int, bytes]]:
+        if opcode >= WS_OP_CLOSE:
+            return opcode, payload
+        if opcode == WS_OP_CONTINUATION:
+            if self.opcode is None:
+                raise WebSocketProtocolError(1002, 'Unexpected continuation frame')
+        elif self.opcode is not None:
+            raise WebSocketProtocolError(1002, 'Expected continuation frame')
+        else:
+            self.opcode = opcode
+        self.size += len(payload)
+        if self.size > self.max_message_size:
+            raise WebSocketProtocolError(1009, 'Message too big')
+        self.parts.append(payload)
+        if not fin:
+            return None
+        message = (self.opcode, b''.join(self.parts))
+        self.opcode, self.parts, self.size = None, [], 0
+        return message
+
+def parse_ws_chat_message(payload: bytes) -> str:
+    try:
+        data = json.loads(payload.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        raise WebSocketProtocolError(1007, 'Invalid JSON')
+    message = data.get('message') if isinstance(data, dict) else None
+    return message.strip() if isinstance(message, str) else ''
+
+class WebSocketConnection:
+    """WebSocket поверх соединения BigAkoHandler.
+
+    Поток обработчика читает кадры клиента, а отдельный поток отправляет новые сообщения
+    из подписки на хаб. Само соединение регистрируется в реестре BigAkoServer.connections.
+    """
+    ping_interval = 20
+    
+    def __init__(self, handler: 'BigAkoHandler', username: str, room_id: int = GENERAL_ROOM_ID):
+        self.handler = handler
+        self.username = username
+        self.room_id = room_id
+        self.session = handler.get_session_token()
+        self.subscription: Optional[Subscription] = None
+        self.write_lock = threading.Lock()
+        self.closed = False
+    
+    def abort(self):
+        self.closed = True
+        try:
+            self.handler.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def disconnect(self, code: int = 1000):
+        """Закрывает соединение из чужого потока (например, при выходе пользователя)"""
+        self.close(code)
+        self.abort()
+    
+    def send_frame(self, opcode: int, payload: bytes = b''):
+        self.send_raw(encode_ws_frame(opcode, payload))
+    
+    def send_raw(self, data: bytes):
+        with self.write_lock:
+            self.handler.wfile.write(data)
+    
+    def read_exact(self, size: int) -> bytes:
+        data = self.handler.rfile.read(size)
+        if len(data) < size:
+            raise ConnectionResetError('WebSocket closed by peer')
+        return data
+    
+    def read_frame(self) -> Tuple[bool, int, bytes]:
+        fin, opcode, masked, length = parse_ws_header(self.read_exact(2))
+        if length == 126:
+            length = struct.unpack('!H', self.read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.read_exact(8))[0]
+        self.assembler.check_header(fin, opcode, masked, length)
+        mask = self.read_exact(4)
+        return fin, opcode, unmask_ws_payload(self.read_exact(length), mask)
+    
+    def run(self, last_id: int):
+        # Клиент отвечает на ping каждые ping_interval секунд; тишина вдвое дольше - соединение мертво
+        self.handler.connection.settimeout(self.ping_interval * 2)
+        self.assembler = WebSocketMessageAssembler()
+        server_instance = self.handler.server_instance
+        server_instance.register_connection(self.username, self)
+        self.subscription = server_instance.hub.subscribe(last_id, room_id=self.room_id)
+        sender = threading.Thread(target=self.send_loop, daemon=True)
+        sender.start()
+        try:
+            self.receive_loop()
+        except WebSocketProtocolError as e:
+            self.close(e.code)
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            self.closed = True
+            server_instance.unregister_connection(self.username, self)
+            server_instance.hub.unsubscribe(self.subscription)
+            self.subscription.close()
+            sender.join(self.ping_interval)
+    
+    def receive_loop(self):
+        while not self.closed:
+            fin, opcode, payload = self.read_frame()
+            message = self.assembler.feed(fin, opcode, payload)
+            if message is None:
+                continue
+            opcode, payload = message
+            if opcode == WS_OP_CLOSE:
+                self.close(1000)
+                return
+            if opcode == WS_OP_PING:
+                self.send_frame(WS_OP_PONG, payload)
+            elif opcode == WS_OP_TEXT:
+                text = parse_ws_chat_message(payload)
+                if text:
+                    self.handler.server_instance.add_message(self.username, text, room_id=self.room_id)
+            elif opcode == WS_OP_BINARY:
+                raise WebSocketProtocolError(1003, 'Binary messages are not supported')
+    
+    def send_loop(self):
+        try:
+            # Первая выборка подписки содержит все пропущенные сообщения
+            events = self.subscription.take()
+            while not self.closed:
+                if events:
+                    self.send_raw(b''.join(event.ws_frame for event in events))
+                events = self.subscription.get(self.ping_interval)
+                if not events and not self.closed:
+                    self.send_frame(WS_OP_PING)
+        except SlowConsumerError:
+            if not self.closed:
+                self.close(1008)
+                self.abort()
+        except OSError:
+            self.abort()
+    
+    def close(self, code: int):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.send_frame(WS_OP_CLOSE, ws_close_payload(code))
+        except OSError:
+            pass
+
+class Router:
+    """Таблица маршрутов. Точные пути ищутся в словаре за O(1), а шаблоны вида
+    '/download/<filename>' - по префиксу (длинные префиксы проверяются первыми).
+    """
+    def __init__(self, routes: List[Tuple[str, str, str, Dict]]):
+        self.exact: Dict[Tuple[str, str], Tuple[str, Dict]] = {}
+        self.patterns: Dict[str, List[Tuple[str, List[str], str, Dict]]] = {}
+        self.methods = set()
+        for method, pattern, handler_name, kwargs in routes:
+            self.add(method, pattern, handler_name, kwargs)
+    
+    def add(self, method: str, pattern: str, handler_name: str, kwargs: Optional[Dict] = None):
+        kwargs = kwargs or {}
+        self.methods.add(method)
+        if '<' not in pattern:
+            self.exact[(method, pattern)] = (handler_name, kwargs)
+            return
+        prefix = pattern[:pattern.index('<')]
+        params = [part[1:-1] for part in pattern[len(prefix):].split('/')]
+        patterns = self.patterns.setdefault(method, [])
+        patterns.append((prefix, params, handler_name, kwargs))
+        patterns.sort(key=lambda item: len(item[0]), reverse=True)
+    
+    def resolve(self, method: str, path: str) -> Optional[Tuple[str, Dict]]:
+        route = self.exact.get((method, path))
+        if route is not None:
+            return route
+        for prefix, params, handler_name, kwargs in self.patterns.get(method, ()):
+            if not path.startswith(prefix):
+                continue
+            values = path[len(prefix):].split('/')
+            if len(values) != len(params) or not all(values):
+                continue
+            route_kwargs = dict(kwargs)
+            route_kwargs.update(zip(params, (unquote(value) for value in values)))
+            return handler_name, route_kwargs
+        return None
+    
+    def allowed_methods(self, path: str) -> List[str]:
+        """Методы, для которых у пути есть маршрут - для заголовка Allow в ответе 405"""
+        return sorted(method for method in self.methods if self.resolve(method, path) is not None)
+
+ROUTES = [
+    ('GET', '/', 'serve_html', {'page_type': 'index'}),
+    ('GET', '/login', 'serve_html', {'page_type': 'login'}),
+    ('GET', '/register', 'serve_html', {'page_type': 'register'}),
+    ('GET', '/messenger', 'handle_messenger', {}),
+    ('GET', '/api/messages', 'handle_get_messages', {}),
+    ('GET', '/api/userinfo', 'handle_userinfo', {}),
+    ('GET', '/api/stats', 'handle_stats', {}),
+    ('GET', '/api/rooms', 'handle_rooms', {}),
+    ('GET', '/api/search', 'handle_search', {}),
+    ('GET', '/api/stream', 'handle_stream', {}),
+    ('GET', '/ws', 'handle_websocket', {}),
+    ('GET', '/download/<filename>', 'handle_download', {}),
+    ('GET', '/style.css', 'serve_css', {}),
+    ('GET', '/script.js', 'serve_js', {}),
+    ('POST', '/api/register', 'handle_register', {}),
+    ('POST', '/api/login', 'handle_login', {}),
+    ('POST', '/api/message', 'handle_message', {}),
+    ('POST', '/api/logout', 'handle_logout', {}),
+    ('POST', '/api/rooms', 'handle_create_room', {}),
+    ('POST', '/api/rooms/dm', 'handle_direct_room', {}),
+    ('POST', '/api/rooms/members', 'handle_add_room_member', {}),
+]
 
 class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
     server_instance = BigAkoServer()
+    router = Router(ROUTES)
+    # HTTP/1.1: соединение переиспользуется, пока клиент не молчит дольше timeout секунд
+    # и не исчерпан лимит запросов на одно соединение
+    protocol_version = 'HTTP/1.1'
+    timeout = 15
+    max_keepalive_requests = 100
+    # Заголовки и тело уходят отдельными write(); без TCP_NODELAY на живом соединении
+    # каждый ответ ждет delayed ACK клиента
+    disable_nagle_algorithm = True
+    # SSE-поток занимает поток обработчика целиком; None - без ограничения
+    max_streams: Optional[int] = None
+    stream_heartbeat = 15
+    active_streams = 0
+    streams_lock = threading.Lock()
+    handled_requests = 0
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
     
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.handled_requests += 1
+        if code != 101 and self.handled_requests >= self.max_keepalive_requests and not self.close_connection:
+            self.send_header('Connection', 'close')
+    
     def do_GET(self):
-        try:
-            if self.path == '/':
-                self.serve_html('index')
-            elif self.path == '/login':
-                self.serve_html('login')
-            elif self.path == '/register':
-                self.serve_html('register')
-            elif self.path == '/messenger':
-                if self.verify_session():
-                    self.serve_html('messenger')
-                else:
-                    self.redirect('/login')
-            elif self.path == '/api/messages':
-                if self.verify_session():
-                    self.serve_json({'messages': self.server_instance.get_recent_messages()})
-                else:
-                    self.send_error(401)
-            elif self.path.startswith('/download/'):
-                self.handle_download()
-            elif self.path == '/style.css':
-                self.serve_css()
-            elif self.path == '/script.js':
-                self.serve_js()
-            elif self.path == '/api/userinfo':
-                if self.verify_session():
-                    username = self.get_username_from_session()
-                    self.serve_json({'username': username})
-                else:
-                    self.send_error(401)
-            else:
-                self.send_error(404)
-        except Exception as e:
-            print(f"GET error: {e}")
-            self.send_error(500)
+        self.dispatch('GET')
     
     def do_POST(self):
+        self.dispatch('POST')
+    
+    def dispatch(self, method: str):
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            if content_length > 0:
-                post_data = self.rfile.read(content_length)
-            else:
-                post_data = b''
+            url = urlparse(self.path)
+            self.query = parse_qs(url.query)
+            self.form: Dict[str, List[str]] = {}
+            self.body = b''
+            if method == 'POST':
+                content_length = int(self.headers.get('Content-Length', 0))
+                if content_length > 0:
+                    self.body = self.rfile.read(content_length)
+                if 'multipart/form-data' not in self.headers.get('Content-Type', ''):
+                    self.form = parse_qs(self.body.decode('utf-8'))
             
-            content_type = self.headers.get('Content-Type', '')
-            
-            if 'multipart/form-data' in content_type:
-                self.handle_multipart(post_data, content_type)
-            else:
-                data = parse_qs(post_data.decode('utf-8'))
-                
-                if self.path == '/api/register':
-                    self.handle_register(data)
-                elif self.path == '/api/login':
-                    self.handle_login(data)
-                elif self.path == '/api/message':
-                    self.handle_message(data)
-                elif self.path == '/api/logout':
-                    self.handle_logout()
+            route = self.router.resolve(method, url.path)
+            if route is None:
+                allowed = self.router.allowed_methods(url.path)
+                if allowed:
+                    self.send_method_not_allowed(allowed)
                 else:
                     self.send_error(404)
+                return
+            handler_name, kwargs = route
+            getattr(self, handler_name)(**kwargs)
         except Exception as e:
-            print(f"POST error: {e}")
+            print(f"{method} error: {e}")
             self.send_error(500)
     
+    def handle_messenger(self):
+        if self.verify_session():
+            self.serve_html('messenger')
+        else:
+            self.redirect('/login')
+    
+    def handle_get_messages(self):
+        username = self.get_username_from_session()
+        if not username:
+            self.send_error(401)
+            return
+        room_id = self.require_room(username)
+        if room_id is None:
+            return
+        
+        before_id = self.query.get('before_id', [''])[0]
+        if before_id.isdigit():
+            # Сообщения не редактируются и не удаляются, а id растут: страница перед
+            # известным id не меняется, и браузер может держать ее в кэше
+            limit = page_limit(self.query)
+            messages = self.server_instance.get_messages_before(int(before_id), limit, room_id)
+            self.serve_json({'messages': messages, 'has_more': len(messages) == limit},
+                            headers={'Cache-Control': 'private, max-age=3600'})
+            return
+        
+        poll = long_poll_params(self.query)
+        if poll is None:
+            # Версия берется до чтения данных: если сообщение придет между ними, следующий запрос его получит
+            etag = self.server_instance.messages_etag()
+            if self.etag_matches(etag):
+                self.send_not_modified(etag)
+                return
+            cache_headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            after_id = self.query.get('after_id', [''])[0]
+            if after_id.isdigit():
+                # Дельта: только сообщения новее after_id, по первичному ключу
+                messages = self.server_instance.get_messages_since(int(after_id), room_id)
+                self.serve_json({'messages': messages, 'last_id': messages[-1]['id'] if messages else int(after_id)},
+                                headers=cache_headers)
+            else:
+                limit = page_limit(self.query)
+                messages = self.server_instance.get_recent_messages(limit, room_id)
+                self.serve_json({'messages': messages, 'has_more': len(messages) == limit}, headers=cache_headers)
+            return
+        
+        since, timeout = poll
+        # Без свободного места под ожидание отвечаем сразу - клиент повторит запрос позже
+        if self.acquire_stream():
+            try:
+                messages = self.server_instance.wait_for_messages(since, timeout, room_id)
+            finally:
+                self.release_stream()
+        else:
+            messages = self.server_instance.wait_for_messages(since, 0, room_id)
+        self.serve_json({'messages': messages, 'last_id': messages[-1]['id'] if messages else since})
+    
+    def etag_matches(self, etag: str) -> bool:
+        if_none_match = self.headers.get('If-None-Match', '')
+        return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+    
+    def send_method_not_allowed(self, allowed: List[str]):
+        # send_error не дает добавить заголовок, а Allow в ответе 405 обязателен (RFC 9110)
+        self.send_response(405)
+        self.send_header('Allow', ', '.join(allowed))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def send_not_modified(self, etag: str):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+    
+    def handle_stream(self):
+        username = self.get_username_from_session()
+        if not username:
+            self.send_error(401)
+            return
+        room_id = self.require_room(username)
+        if room_id is None:
+            return
+        
+        if not self.acquire_stream():
+            # 204 говорит EventSource не переподключаться - клиент перейдет на опрос
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        try:
+            self.stream_messages(self.get_stream_start_id(), room_id)
+        finally:
+            self.release_stream()
+    
+    def acquire_stream(self) -> bool:
+        with self.streams_lock:
+            if self.max_streams is not None and BigAkoHandler.active_streams >= self.max_streams:
+                return False
+            BigAkoHandler.active_streams += 1
+            return True
+    
+    def release_stream(self):
+        with self.streams_lock:
+            BigAkoHandler.active_streams -= 1
+    
+    def handle_websocket(self):
+        if not is_websocket_upgrade(self.headers):
+            self.send_error(400, 'Expected WebSocket upgrade')
+            return
+        username = self.get_username_from_session()
+        if not username:
+            self.send_error(401)
+            return
+        room_id = self.require_room(username)
+        if room_id is None:
+            return
+        if not self.acquire_stream():
+            self.send_error(503)
+            return
+        
+        try:
+            self.close_connection = True
+            self.send_response(101, 'Switching Protocols')
+            self.send_header('Upgrade', 'websocket')
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Sec-WebSocket-Accept', websocket_accept_key(self.headers['Sec-WebSocket-Key']))
+            self.end_headers()
+            self.wfile.flush()
+            WebSocketConnection(self, username, room_id).run(self.get_stream_start_id())
+        finally:
+            self.release_stream()
+    
+    def get_room_id(self) -> int:
+        room = self.query.get('room', [''])[0] or self.form.get('room', [''])[0]
+        return int(room) if room.isdigit() else GENERAL_ROOM_ID
+    
+    def require_room(self, username: Optional[str]) -> Optional[int]:
+        """Комната из ?room= (или поля формы room); без доступа отвечает 401/403 и возвращает None"""
+        if not username:
+            self.send_error(401)
+            return None
+        room_id = self.get_room_id()
+        if not self.server_instance.can_access_room(username, room_id):
+            self.send_error(403)
+            return None
+        return room_id
+    
+    def get_stream_start_id(self) -> int:
+        last_event_id = self.headers.get('Last-Event-ID') or self.query.get('last_id', [''])[0]
+        if last_event_id.isdigit():
+            return int(last_event_id)
+        return self.server_instance.last_message_id
+    
+    def stream_messages(self, last_id: int, room_id: int = GENERAL_ROOM_ID):
+        self.close_connection = True
+        self.send_response(200)
+        for name, value in SSE_HEADERS.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(b'retry: 3000\n\n')
+        self.wfile.flush()
+        
+        hub = self.server_instance.hub
+        subscription = hub.subscribe(last_id, room_id=room_id)
+        try:
+            events = subscription.take()
+            while True:
+                if events:
+                    self.wfile.write(b''.join(event.sse for event in events))
+                else:
+                    # Комментарий-пульс держит соединение и позволяет заметить ушедшего клиента
+                    self.wfile.write(b': ping\n\n')
+                self.wfile.flush()
+                events = subscription.get(self.stream_heartbeat)
+        except (BrokenPipeError, ConnectionResetError, socket.timeout, SlowConsumerError):
+            pass
+        finally:
+            hub.unsubscribe(subscription)
+    
+    def handle_userinfo(self):
+        if self.verify_session():
+            self.serve_json({'username': self.get_username_from_session()})
+        else:
+            self.send_error(401)
+    
+    def handle_stats(self):
+        if not self.verify_session():
+            self.send_error(401)
+            return
+        server_instance = self.server_instance
+        self.serve_json({
+            'pid': os.getpid(),
+            'hub': server_instance.hub.stats(),
+            'bus': server_instance.bus.stats(),
+            'db': server_instance.db.stats(),
+            'history': server_instance.message_history.stats(),
+            'connections': server_instance.connection_stats(),
+            'group_commit': server_instance.group_commit.stats() if server_instance.group_commit else None
+        })
+    
     def handle_multipart(self, data, content_type):
         try:
             # Простой парсинг multipart данных
@@ -253,6 +1155,14 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
                     self.serve_json({'success': False, 'error': 'File too large'})
                     return
                 
+                username = self.get_username_from_session()
+                if not username:
+                    self.send_error(401)
+                    return
+                room_id = self.require_room(username)
+                if room_id is None:
+                    return
+                
                 # Сохраняем файл
                 file_id = str(uuid.uuid4())
                 filename = f"{file_id}_{filename}"
@@ -261,29 +1171,33 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
                 with open(filepath, 'wb') as f:
                     f.write(file_data)
                 
-                username = self.get_username_from_session()
-                if username:
-                    self.server_instance.add_message(
-                        username, 
-                        message_text or 'Shared a file', 
-                        'file', 
-                        filename, 
-                        file_size
-                    )
-                    self.serve_json({'success': True})
-                else:
-                    self.send_error(401)
+                entry = self.server_instance.add_message(
+                    username, 
+                    message_text or 'Shared a file', 
+                    'file', 
+                    filename, 
+                    file_size,
+                    room_id
+                )
+                self.serve_json({'success': True, 'id': entry['id'], 'durable': self.server_instance.db.durable})
+            else:
+                self.serve_json({'success': False, 'error': 'No file'})
             
         except Exception as e:
             print(f"Multipart error: {e}")
             self.serve_json({'success': False, 'error': 'File upload failed'})
     
-    def handle_download(self):
+    def handle_download(self, filename: str):
+        username = self.get_username_from_session()
+        if not username:
+            self.send_error(401)
+            return
         try:
-            filename = self.path.split('/')[-1]
+            filename = os.path.basename(filename)
             filepath = os.path.join('uploads', filename)
             
-            if os.path.exists(filepath):
+            # Файл доступен только участникам комнаты, где его отправили
+            if os.path.exists(filepath) and self.server_instance.can_access_file(username, filename):
                 self.send_response(200)
                 self.send_header('Content-Type', 'application/octet-stream')
                 self.send_header('Content-Disposition', f'attachment; filename="{filename.split("_", 1)[1]}"')
@@ -300,7 +1214,8 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
             print(f"Download error: {e}")
             self.send_error(500)
     
-    def handle_register(self, data):
+    def handle_register(self):
+        data = self.form
         username = data.get('username', [''])[0]
         password = data.get('password', [''])[0]
         
@@ -312,72 +1227,140 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
         else:
             self.serve_json({'success': False, 'error': 'Invalid data'})
     
-    def handle_login(self, data):
+    def handle_login(self):
+        data = self.form
         username = data.get('username', [''])[0]
         password = data.get('password', [''])[0]
         
         if username and password:
             if self.server_instance.verify_user(username, password):
-                token = secrets.token_hex(32)
-                self.server_instance.session_tokens[token] = username
-                
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Set-Cookie', f'session={token}; Path=/; HttpOnly')
-                self.end_headers()
-                self.wfile.write(json.dumps({'success': True}).encode())
+                token = self.server_instance.create_session(username)
+                self.serve_json({'success': True}, headers={'Set-Cookie': f'session={token}; Path=/; HttpOnly'})
             else:
                 self.serve_json({'success': False, 'error': 'Invalid credentials'})
         else:
             self.serve_json({'success': False, 'error': 'Invalid data'})
     
-    def handle_message(self, data):
-        if not self.verify_session():
-            self.send_error(401)
+    def handle_message(self):
+        content_type = self.headers.get('Content-Type', '')
+        if 'multipart/form-data' in content_type:
+            self.handle_multipart(self.body, content_type)
             return
         
-        message = data.get('message', [''])[0]
         username = self.get_username_from_session()
+        room_id = self.require_room(username)
+        if room_id is None:
+            return
         
-        if message and username:
-            self.server_instance.add_message(username, message)
-            self.serve_json({'success': True})
+        message = self.form.get('message', [''])[0]
+        if message:
+            entry = self.server_instance.add_message(username, message, room_id=room_id)
+            self.serve_json({'success': True, 'id': entry['id'], 'durable': self.server_instance.db.durable})
         else:
             self.serve_json({'success': False, 'error': 'Invalid message'})
     
+    def handle_rooms(self):
+        username = self.get_username_from_session()
+        if not username:
+            self.send_error(401)
+            return
+        self.serve_json({'rooms': self.server_instance.list_rooms(username)})
+    
+    def handle_search(self):
+        username = self.get_username_from_session()
+        if not username:
+            self.send_error(401)
+            return
+        # Без ?room= ищем по всем доступным комнатам, с ним - только в этой (если есть доступ)
+        room_id = None
+        if 'room' in self.query:
+            room_id = self.require_room(username)
+            if room_id is None:
+                return
+        param = lambda name: self.query.get(name, [''])[0]
+        try:
+            date_from, date_to = (datetime.strptime(param(name), '%Y-%m-%d').date() if param(name) else None
+                                  for name in ('from', 'to'))
+            result = self.server_instance.search(
+                username, param('q'), room_id, param('sender') or None, date_from, date_to,
+                param('sort') or 'rank', param('cursor') or None,
+                int(param('limit')) if param('limit').isdigit() else 20
+            )
+        except ValueError as e:
+            self.serve_json({'success': False, 'error': str(e)})
+            return
+        self.serve_json(dict(result, success=True))
+    
+    def handle_create_room(self):
+        username = self.get_username_from_session()
+        if not username:
+            self.send_error(401)
+            return
+        name = self.form.get('name', [''])[0].strip()
+        members = [m.strip() for m in self.form.get('members', [''])[0].split(',') if m.strip()]
+        if not name:
+            self.serve_json({'success': False, 'error': 'Room name is required'})
+            return
+        room = self.server_instance.create_room(username, name[:64], members)
+        if room:
+            self.serve_json({'success': True, 'room': room})
+        else:
+            self.serve_json({'success': False, 'error': 'Unknown user'})
+    
+    def handle_direct_room(self):
+        username = self.get_username_from_session()
+        if not username:
+            self.send_error(401)
+            return
+        room = self.server_instance.get_direct_room(username, self.form.get('username', [''])[0].strip())
+        if room:
+            self.serve_json({'success': True, 'room': room})
+        else:
+            self.serve_json({'success': False, 'error': 'Unknown user'})
+    
+    def handle_add_room_member(self):
+        username = self.get_username_from_session()
+        # Приглашать могут только участники комнаты
+        room_id = self.require_room(username)
+        if room_id is None:
+            return
+        if self.server_instance.add_room_member(room_id, self.form.get('username', [''])[0].strip()):
+            self.serve_json({'success': True})
+        else:
+            self.serve_json({'success': False, 'error': 'Cannot add this user to the room'})
+    
     def handle_logout(self):
-        token = self.get_session_token()
-        if token in self.server_instance.session_tokens:
-            del self.server_instance.session_tokens[token]
+        self.server_instance.end_session(self.get_session_token())
         self.send_response(200)
         self.send_header('Set-Cookie', 'session=; Path=/; Expires=Thu, 01 Jan 1970 00:00:00 GMT')
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
     def verify_session(self) -> bool:
-        token = self.get_session_token()
-        return token in self.server_instance.session_tokens
+        return self.get_username_from_session() is not None
     
     def get_session_token(self) -> Optional[str]:
-        cookie = self.headers.get('Cookie', '')
-        for part in cookie.split(';'):
-            if 'session=' in part:
-                return part.split('session=')[1].strip()
-        return None
+        return session_token_from_cookie(self.headers.get('Cookie', ''))
     
     def get_username_from_session(self) -> Optional[str]:
-        token = self.get_session_token()
-        return self.server_instance.session_tokens.get(token)
+        return self.server_instance.get_session_user(self.get_session_token())
     
     def redirect(self, location):
         self.send_response(302)
         self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
-    def serve_html(self, page_type):
+    def send_body(self, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None):
         self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        
+        self.wfile.write(body)
+    
+    def serve_html(self, page_type):
         if page_type == 'index':
             html = self.get_index_html()
         elif page_type == 'login':
@@ -387,25 +1370,16 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
         elif page_type == 'messenger':
             html = self.get_messenger_html()
         
-        self.wfile.write(html.encode())
+        self.send_body(html.encode(), 'text/html')
     
-    def serve_json(self, data):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+    def serve_json(self, data, headers: Optional[Dict[str, str]] = None):
+        self.send_body(json.dumps(data).encode(), 'application/json', headers)
     
     def serve_css(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/css')
-        self.end_headers()
-        self.wfile.write(self.get_css().encode())
+        self.send_body(self.get_css().encode(), 'text/css')
     
     def serve_js(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/javascript')
-        self.end_headers()
-        self.wfile.write(self.get_js().encode())
+        self.send_body(self.get_js().encode(), 'application/javascript')
     
     def get_index_html(self):
         return '''<!DOCTYPE html><html lang="ru"><head>
@@ -459,6 +1433,14 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
             <div class="user-info"><span id="usernameDisplay"></span>
             <button id="logoutBtn" class="btn btn-secondary">Выйти</button></div></header>
             
+            <div class="messenger-layout"><aside class="rooms-panel">
+                <form id="searchForm" class="search-form"><input type="search" id="searchInput" placeholder="Поиск по сообщениям">
+                </form><div id="searchResults" class="search-results"></div>
+                <ul id="roomList" class="room-list"></ul>
+                <div class="room-actions"><button type="button" id="newRoomBtn" class="btn btn-small">+ Комната</button>
+                <button type="button" id="newDmBtn" class="btn btn-small">+ Личный диалог</button>
+                <button type="button" id="inviteBtn" class="btn btn-small">Пригласить</button></div></aside>
+            
             <main class="messenger-container"><div class="messages-container" id="messagesContainer">
                 <div class="messages" id="messages"></div></div>
                 
@@ -468,7 +1450,7 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
                     <input type="file" id="fileInput" style="display: none" accept="*/*">
                     <button type="submit" class="btn btn-primary">Отправить</button>
                 </form><div id="fileInfo" class="file-info"></div></div>
-            </main>
+            </main></div>
         </div><script src="/script.js"></script></body></html>'''
     
     def get_css(self):
@@ -498,12 +1480,25 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
         .file-link:hover{text-decoration:underline}.file-size{font-size:0.8rem;color:#666}.message-input{padding:20px;background:#f8f9fa;
         border-top:1px solid #e9ecef}.message-form{display:flex;gap:10px;align-items:center}.message-form input[type="text"]{flex:1;
         padding:15px;border:2px solid #ddd;border-radius:25px;font-size:1rem}.message-form input:focus{outline:none;border-color:#667eea}
-        .file-info{margin-top:10px;font-size:0.9rem;color:#666}@media (max-width:768px){.container{padding:10px}.header h1{font-size:2rem}
+        .file-info{margin-top:10px;font-size:0.9rem;color:#666}.messenger-layout{display:flex;gap:20px}.messenger-layout .messenger-container{
+        flex:1}.rooms-panel{width:220px;background:rgba(255,255,255,0.95);border-radius:20px;padding:20px;height:80vh;display:flex;
+        flex-direction:column;gap:15px;box-shadow:0 20px 40px rgba(0,0,0,0.1)}.room-list{list-style:none;flex:1;overflow-y:auto;
+        display:flex;flex-direction:column;gap:5px}.room-item{padding:10px 15px;border-radius:10px;cursor:pointer;overflow:hidden;
+        text-overflow:ellipsis;white-space:nowrap}.room-item:hover{background:#f1f3f4}.room-item.active{
+        background:linear-gradient(45deg,#667eea,#764ba2);color:white}.room-actions{display:flex;flex-direction:column;gap:8px}
+        .btn-small{padding:8px 15px;font-size:0.9rem;background:#f1f3f4;color:#333}.search-form input{width:100%;padding:10px 15px;
+        border:2px solid #ddd;border-radius:20px;font-size:0.9rem}.search-form input:focus{outline:none;border-color:#667eea}
+        .search-results{max-height:40vh;overflow-y:auto;display:flex;flex-direction:column;gap:8px}.search-result{padding:8px 10px;
+        border-radius:10px;background:#f8f9fa;cursor:pointer;font-size:0.85rem}.search-result:hover{background:#e3f2fd}
+        .search-result mark{background:#ffe082;color:inherit}@media (max-width:768px){.messenger-layout{
+        flex-direction:column}.rooms-panel{width:auto;height:auto}.container{padding:10px}.header h1{font-size:2rem}
         .buttons{flex-direction:column;align-items:center}.btn{width:200px}.auth-card{padding:30px 20px}.message{max-width:85%}
         .message-form{flex-direction:column}}'''
     
     def get_js(self):
-        return '''class BigAkoClient{constructor(){this.currentUser=null;this.selectedFile=null;this.init()}
+        return '''class BigAkoClient{constructor(){this.currentUser=null;this.selectedFile=null;this.messages=[];
+        this.messageIds=new Set();this.stream=null;this.socket=null;this.pollTimer=null;this.currentRoom=1;this.rooms=[];
+        this.generation=0;this.hasMore=true;this.loadingOlder=false;this.init()}
         init(){this.setupEventListeners();this.checkAuth()}
         setupEventListeners(){const loginForm=document.getElementById('loginForm');
         if(loginForm){loginForm.addEventListener('submit',(e)=>this.handleLogin(e))}
@@ -516,7 +1511,21 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
         const fileBtn=document.getElementById('fileBtn');
         const fileInput=document.getElementById('fileInput');
         if(fileBtn&&fileInput){fileBtn.addEventListener('click',()=>fileInput.click());
-        fileInput.addEventListener('change',(e)=>this.handleFileSelect(e))}}
+        fileInput.addEventListener('change',(e)=>this.handleFileSelect(e))}
+        const messagesContainer=document.getElementById('messagesContainer');
+        if(messagesContainer){messagesContainer.addEventListener('scroll',()=>{
+        if(messagesContainer.scrollTop<100){this.loadOlderMessages()}})}
+        const searchForm=document.getElementById('searchForm');
+        if(searchForm){searchForm.addEventListener('submit',(e)=>{e.preventDefault();this.search(false)})}
+        const searchResults=document.getElementById('searchResults');
+        if(searchResults){searchResults.addEventListener('click',(e)=>{if(e.target.closest('#searchMore')){this.search(true);return}
+        const item=e.target.closest('[data-room]');if(item){this.switchRoom(Number(item.dataset.room))}})}
+        const roomList=document.getElementById('roomList');
+        if(roomList){roomList.addEventListener('click',(e)=>{const item=e.target.closest('[data-room]');
+        if(item){this.switchRoom(Number(item.dataset.room))}})}
+        const actions={newRoomBtn:()=>this.createRoom(),newDmBtn:()=>this.openDirect(),inviteBtn:()=>this.inviteMember()};
+        Object.entries(actions).forEach(([id,action])=>{const btn=document.getElementById(id);
+        if(btn){btn.addEventListener('click',action)}})}
         async handleLogin(e){e.preventDefault();const formData=new FormData(e.target);const data={
         username:formData.get('username'),password:formData.get('password')};
         try{const response=await fetch('/api/login',{method:'POST',headers:{
@@ -532,15 +1541,17 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
         async handleMessage(e){e.preventDefault();const input=document.getElementById('messageInput');
         const message=input.value.trim();const fileInput=document.getElementById('fileInput');
         if(this.selectedFile){await this.uploadFile(message);this.selectedFile=null;
-        document.getElementById('fileInfo').textContent='';fileInput.value=''}else if(message){
-        try{const response=await fetch('/api/message',{method:'POST',headers:{
+        document.getElementById('fileInfo').textContent='';fileInput.value=''}
+        else if(message&&this.socket&&this.socket.readyState===WebSocket.OPEN){
+        this.socket.send(JSON.stringify({message}));input.value=''}else if(message){
+        try{const response=await fetch(`/api/message?${this.roomQuery()}`,{method:'POST',headers:{
         'Content-Type':'application/x-www-form-urlencoded'},body:new URLSearchParams({message})});
-        const result=await response.json();if(result.success){input.value='';this.loadMessages()}}
+        const result=await response.json();if(result.success){input.value='';this.refresh()}}
         catch(error){console.error('Ошибка отправки сообщения:',error)}}}
         async uploadFile(message){const formData=new FormData();formData.append('file',this.selectedFile);
-        if(message){formData.append('message',message)}try{const response=await fetch('/api/message',{
+        if(message){formData.append('message',message)}try{const response=await fetch(`/api/message?${this.roomQuery()}`,{
         method:'POST',body:formData});const result=await response.json();if(result.success){
-        this.loadMessages()}}catch(error){console.error('Ошибка загрузки файла:',error)}}
+        this.refresh()}}catch(error){console.error('Ошибка загрузки файла:',error)}}
         handleFileSelect(e){const file=e.target.files[0];if(file){if(file.size>50*1024*1024){
         this.showError('Файл слишком большой (макс. 50MB)');return}this.selectedFile=file;
         document.getElementById('fileInfo').textContent=`Файл: ${file.name} (${this.formatFileSize(file.size)})`}}
@@ -548,38 +1559,791 @@ class BigAkoHandler(http.server.SimpleHTTPRequestHandler):
         const i=Math.floor(Math.log(bytes)/Math.log(k));return parseFloat((bytes/Math.pow(k,i)).toFixed(2))+' '+sizes[i]}
         async handleLogout(){try{await fetch('/api/logout',{method:'POST'});window.location.href='/'}
         catch(error){console.error('Ошибка выхода:',error)}}
-        async loadMessages(){try{const response=await fetch('/api/messages');const data=await response.json();
-        this.displayMessages(data.messages)}catch(error){console.error('Ошибка загрузки сообщений:',error)}}
+        async loadMessages(){try{const after=this.lastMessageId();
+        const response=await fetch(`/api/messages?${this.roomQuery()}`+(after?`&after_id=${after}`:''));const data=await response.json();
+        if(after){this.addMessages(data.messages)}else{this.messages=data.messages;this.hasMore=data.has_more;
+        this.messageIds=new Set(data.messages.map(m=>m.id));this.displayMessages(this.messages)}}
+        catch(error){console.error('Ошибка загрузки сообщений:',error)}}
+        async loadOlderMessages(){if(this.loadingOlder||!this.hasMore||!this.messages.length)return;
+        this.loadingOlder=true;const room=this.currentRoom;
+        try{const response=await fetch(`/api/messages?${this.roomQuery()}&before_id=${this.messages[0].id}&limit=50`);
+        if(!response.ok||room!==this.currentRoom)return;const data=await response.json();this.hasMore=data.has_more;
+        const older=data.messages.filter(m=>!this.messageIds.has(m.id));if(!older.length)return;
+        older.forEach(m=>this.messageIds.add(m.id));this.messages=older.concat(this.messages);
+        const container=document.getElementById('messages');const scroller=document.getElementById('messagesContainer');
+        if(!container||!scroller)return;const height=scroller.scrollHeight;
+        container.insertAdjacentHTML('afterbegin',older.map(msg=>this.renderMessage(msg)).join(''));
+        scroller.scrollTop+=scroller.scrollHeight-height}
+        catch(error){console.error('Ошибка загрузки истории:',error)}finally{this.loadingOlder=false}}
+        refresh(){if(!this.stream&&!this.socket&&!this.pollTimer){this.loadMessages()}}
+        roomQuery(){return `room=${this.currentRoom}`}
+        async loadRooms(){try{const response=await fetch('/api/rooms');if(response.ok){
+        this.rooms=(await response.json()).rooms;this.displayRooms()}}catch(error){console.error('Ошибка загрузки комнат:',error)}}
+        displayRooms(){const list=document.getElementById('roomList');if(!list)return;
+        list.innerHTML=this.rooms.map(r=>`<li class="room-item ${r.id===this.currentRoom?'active':''}" data-room="${r.id}">
+        ${r.kind==='dm'?'@':'#'} ${this.escapeHtml(r.name)}</li>`).join('')}
+        async switchRoom(roomId){if(roomId===this.currentRoom)return;this.stopStream();this.currentRoom=roomId;
+        this.messages=[];this.messageIds=new Set();this.hasMore=true;this.displayRooms();await this.loadMessages();this.startStream()}
+        stopStream(){this.generation++;if(this.socket){const ws=this.socket;this.socket=null;ws.onclose=null;ws.close()}
+        if(this.stream){this.stream.close();this.stream=null}this.pollTimer=null}
+        async search(more){const container=document.getElementById('searchResults');
+        const q=document.getElementById('searchInput').value.trim();if(!container)return;
+        if(!q){container.innerHTML='';this.searchCursor=null;return}
+        const params=new URLSearchParams({q});if(more&&this.searchCursor){params.set('cursor',this.searchCursor)}
+        try{const response=await fetch(`/api/search?${params}`);const data=await response.json();
+        if(!data.success){this.showError(data.error);return}this.searchCursor=data.next_cursor;
+        const names=new Map(this.rooms.map(r=>[r.id,r.name]));
+        const html=data.results.map(r=>`<div class="search-result" data-room="${r.room_id}">
+        <div class="message-header">${this.escapeHtml(r.username)} · ${this.escapeHtml(names.get(r.room_id)||'')}
+        · ${new Date(r.timestamp).toLocaleDateString()}</div><div>${r.snippet}</div></div>`).join('');
+        const moreButton=data.next_cursor?'<button type="button" id="searchMore" class="btn btn-small">Ещё</button>':'';
+        if(!more){container.innerHTML=''}const oldButton=document.getElementById('searchMore');if(oldButton){oldButton.remove()}
+        container.insertAdjacentHTML('beforeend',(html||(more?'':'<div class="search-result">Ничего не найдено</div>'))+moreButton)}
+        catch(error){console.error('Ошибка поиска:',error)}}
+        async postRoom(url,data){try{const response=await fetch(url,{method:'POST',headers:{
+        'Content-Type':'application/x-www-form-urlencoded'},body:new URLSearchParams(data)});
+        if(!response.ok){this.showError('Нет доступа');return null}const result=await response.json();
+        if(!result.success){this.showError(result.error);return null}return result}
+        catch(error){this.showError('Ошибка соединения');return null}}
+        async createRoom(){const name=prompt('Название комнаты');if(!name)return;
+        const members=prompt('Участники через запятую')||'';const result=await this.postRoom('/api/rooms',{name,members});
+        if(result){await this.loadRooms();this.switchRoom(result.room.id)}}
+        async openDirect(){const username=prompt('Имя собеседника');if(!username)return;
+        const result=await this.postRoom('/api/rooms/dm',{username});if(result){await this.loadRooms();this.switchRoom(result.room.id)}}
+        async inviteMember(){const username=prompt('Кого пригласить в текущую комнату');if(!username)return;
+        await this.postRoom(`/api/rooms/members?${this.roomQuery()}`,{username})}
+        lastMessageId(){return this.messages.length?this.messages[this.messages.length-1].id:''}
+        startStream(){if(window.WebSocket){this.startSocket()}else{this.startEventSource()}}
+        startSocket(){const proto=location.protocol==='https:'?'wss:':'ws:';let opened=false;const generation=this.generation;
+        const ws=new WebSocket(`${proto}//${location.host}/ws?${this.roomQuery()}&last_id=${this.lastMessageId()}`);
+        ws.onopen=()=>{opened=true;this.socket=ws};
+        ws.onmessage=(e)=>this.addMessage(JSON.parse(e.data));
+        ws.onclose=()=>{this.socket=null;if(generation!==this.generation)return;
+        if(opened){setTimeout(()=>{if(generation===this.generation){this.startSocket()}},3000)}
+        else{this.startEventSource()}}}
+        startEventSource(){if(!window.EventSource){this.startPolling();return}
+        this.stream=new EventSource(`/api/stream?${this.roomQuery()}&last_id=${this.lastMessageId()}`);
+        this.stream.onmessage=(e)=>this.addMessage(JSON.parse(e.data));
+        this.stream.onerror=()=>{if(this.stream&&this.stream.readyState===EventSource.CLOSED){
+        this.stream=null;this.startPolling()}}}
+        startPolling(){if(!this.pollTimer){this.pollTimer=true;this.pollLoop()}}
+        async pollLoop(){const generation=this.generation;
+        while(!this.socket&&!this.stream&&generation===this.generation){const started=Date.now();let data={messages:[]};
+        try{const response=await fetch(`/api/messages?${this.roomQuery()}&since=${this.lastMessageId()||0}&timeout=25`);
+        if(generation!==this.generation)break;
+        if(response.ok){data=await response.json();this.addMessages(data.messages)}}
+        catch(error){console.error('Ошибка загрузки сообщений:',error)}
+        if(!data.messages.length&&Date.now()-started<1000){await new Promise(r=>setTimeout(r,2000))}}
+        if(generation===this.generation){this.pollTimer=null}}
+        addMessage(msg){this.addMessages([msg])}
+        addMessages(messages){const fresh=messages.filter(m=>m.room_id===this.currentRoom&&!this.messageIds.has(m.id));
+        if(!fresh.length)return;
+        fresh.forEach(m=>{this.messageIds.add(m.id);this.messages.push(m)});
+        const container=document.getElementById('messages');if(!container)return;
+        container.insertAdjacentHTML('beforeend',fresh.map(msg=>this.renderMessage(msg)).join(''));this.scrollToBottom()}
         displayMessages(messages){const container=document.getElementById('messages');if(!container)return;
-        container.innerHTML=messages.map(msg=>{let content=msg.message_type==='file'?
+        container.innerHTML=messages.map(msg=>this.renderMessage(msg)).join('');this.scrollToBottom()}
+        renderMessage(msg){let content=msg.message_type==='file'?
         `<div class="message-file"><a href="/download/${msg.file_name}" class="file-link" download>📎 ${this.escapeHtml(msg.file_name.split('_',2)[1])}</a>
         <div class="file-size">${this.formatFileSize(msg.file_size)}</div>${msg.message?`<div>${this.escapeHtml(msg.message)}</div>`:''}</div>`:
         `<div class="message-text">${this.escapeHtml(msg.message)}</div>`;
         return `<div class="message ${msg.username===this.currentUser?'own':'other'}">
         <div class="message-header">${this.escapeHtml(msg.username)}</div>${content}
-        <div class="message-time">${new Date(msg.timestamp).toLocaleTimeString()}</div></div>`}).join('');
-        const messagesContainer=document.getElementById('messagesContainer');if(messagesContainer){
+        <div class="message-time">${new Date(msg.timestamp).toLocaleTimeString()}</div></div>`}
+        scrollToBottom(){const messagesContainer=document.getElementById('messagesContainer');if(messagesContainer){
         messagesContainer.scrollTop=messagesContainer.scrollHeight}}checkAuth(){
         if(window.location.pathname==='/messenger'){this.startMessenger()}}
         async startMessenger(){try{const userResponse=await fetch('/api/userinfo');
         if(userResponse.ok){const userData=await userResponse.json();this.currentUser=userData.username;
         document.getElementById('usernameDisplay').textContent=userData.username;}
-        await this.loadMessages();setInterval(()=>this.loadMessages(),2000);}catch(error){
+        await this.loadRooms();await this.loadMessages();this.startStream();}catch(error){
         console.error('Ошибка запуска мессенджера:',error);window.location.href='/login'}}
         showError(message){const errorDiv=document.getElementById('error');if(errorDiv){
-        errorDiv.textContent=message;setTimeout(()=>{errorDiv.textContent=''},3000)}}
+        errorDiv.textContent=message;setTimeout(()=>{errorDiv.textContent=''},3000)}else{alert(message)}}
         escapeHtml(text){const div=document.createElement('div');div.textContent=text;return div.innerHTML}}
         document.addEventListener('DOMContentLoaded',()=>{window.bigAkoClient=new BigAkoClient()});'''
 
-def run_server():
-    PORT = 8000
-    with socketserver.TCPServer(("", PORT), BigAkoHandler) as httpd:
-        print(f"BigAko server running on port {PORT}")
-        print(f"Open http://localhost:{PORT} in your browser")
+class BufferedBigAkoHandler(BigAkoHandler):
+    """Обрабатывает один уже прочитанный запрос из памяти и пишет ответ в буфер.
+
+    Используется asyncio-движком: маршруты, сессии и шаблоны остаются общими с BigAkoHandler.
+    """
+    def __init__(self, raw_request: bytes, client_address, handled_requests: int = 0):
+        self.raw_request = raw_request
+        self.handled_requests = handled_requests
+        super().__init__(None, client_address, None)
+    
+    def setup(self):
+        self.rfile = io.BytesIO(self.raw_request)
+        self.wfile = io.BytesIO()
+    
+    def handle(self):
+        self.handle_one_request()
+    
+    def finish(self):
+        pass
+
+class AsyncSubscription:
+    """Подписка на хаб для корутин: ожидание через asyncio.Event, догрузка из базы - в пуле потоков"""
+    def __init__(self, hub: MessageHub, last_id: int, executor: ThreadPoolExecutor,
+                 policy: Optional[str] = None, room_id: int = GENERAL_ROOM_ID):
+        self.hub = hub
+        self.executor = executor
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        # Хаб вызывает waker из потока, опубликовавшего сообщение
+        self.subscription = hub.subscribe(last_id, waker=self.wake, policy=policy, room_id=room_id)
+    
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+    
+    async def take(self) -> List[HubEvent]:
+        if self.subscription.needs_fetch:
+            return await self.loop.run_in_executor(self.executor, self.subscription.take)
+        return self.subscription.take()
+    
+    async def get(self, timeout: float) -> List[HubEvent]:
+        deadline = self.loop.time() + timeout
+        while True:
+            self.wakeup.clear()
+            events = await self.take()
+            remaining = deadline - self.loop.time()
+            if events or remaining <= 0:
+                return events
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    
+    def close(self):
+        self.hub.unsubscribe(self.subscription)
+        self.subscription.close()
+
+class AsyncWebSocketConnection:
+    """WebSocket для asyncio-движка: прием и отправка - две корутины одного соединения"""
+    ping_interval = WebSocketConnection.ping_interval
+    
+    def __init__(self, engine: 'AsyncBigAkoServer', reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, username: str, room_id: int = GENERAL_ROOM_ID,
+                 session: Optional[str] = None):
+        self.engine = engine
+        self.reader = reader
+        self.writer = writer
+        self.username = username
+        self.room_id = room_id
+        self.session = session
+        self.loop = asyncio.get_running_loop()
+        self.subscription: Optional[AsyncSubscription] = None
+        self.assembler = WebSocketMessageAssembler()
+        self.closed = False
+    
+    def disconnect(self, code: int = 1000):
+        """Закрывает соединение из потока пула (например, при выходе пользователя)"""
+        asyncio.run_coroutine_threadsafe(self.shutdown(code), self.loop)
+    
+    async def shutdown(self, code: int):
+        await self.close(code)
+        self.writer.transport.abort()
+    
+    async def send_frame(self, opcode: int, payload: bytes = b''):
+        self.writer.write(encode_ws_frame(opcode, payload))
+        await self.writer.drain()
+    
+    async def read_frame(self) -> Tuple[bool, int, bytes]:
+        fin, opcode, masked, length = parse_ws_header(await self.reader.readexactly(2))
+        if length == 126:
+            length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+        self.assembler.check_header(fin, opcode, masked, length)
+        mask = await self.reader.readexactly(4)
+        return fin, opcode, unmask_ws_payload(await self.reader.readexactly(length), mask)
+    
+    async def run(self, last_id: int):
+        server_instance = self.engine.server_instance
+        server_instance.register_connection(self.username, self)
+        self.subscription = AsyncSubscription(server_instance.hub, last_id, self.engine.executor,
+                                              room_id=self.room_id)
+        sender = asyncio.create_task(self.send_loop())
+        try:
+            await self.receive_loop()
+        except WebSocketProtocolError as e:
+            await self.close(e.code)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.closed = True
+            server_instance.unregister_connection(self.username, self)
+            self.subscription.close()
+            sender.cancel()
+    
+    async def receive_loop(self):
+        while not self.closed:
+            fin, opcode, payload = await asyncio.wait_for(self.read_frame(), self.ping_interval * 2)
+            message = self.assembler.feed(fin, opcode, payload)
+            if message is None:
+                continue
+            opcode, payload = message
+            if opcode == WS_OP_CLOSE:
+                await self.close(1000)
+                return
+            if opcode == WS_OP_PING:
+                await self.send_frame(WS_OP_PONG, payload)
+            elif opcode == WS_OP_TEXT:
+                text = parse_ws_chat_message(payload)
+                if text:
+                    await self.loop.run_in_executor(
+                        self.engine.executor,
+                        partial(self.engine.server_instance.add_message, self.username, text, room_id=self.room_id)
+                    )
+            elif opcode == WS_OP_BINARY:
+                raise WebSocketProtocolError(1003, 'Binary messages are not supported')
+    
+    async def send_loop(self):
+        try:
+            events = await self.subscription.take()
+            while not self.closed:
+                if events:
+                    self.writer.write(b''.join(event.ws_frame for event in events))
+                    await self.writer.drain()
+                events = await self.subscription.get(self.ping_interval)
+                if not events and not self.closed:
+                    await self.send_frame(WS_OP_PING)
+        except SlowConsumerError:
+            await self.close(1008)
+            self.writer.transport.abort()
+        except ConnectionError:
+            self.writer.transport.abort()
+    
+    async def close(self, code: int):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self.send_frame(WS_OP_CLOSE, ws_close_payload(code))
+        except ConnectionError:
+            pass
+
+class AsyncBigAkoServer:
+    """Движок на asyncio streams: каждое соединение - корутина, а работа с SQLite
+    и файлами выполняется в пуле потоков, чтобы не блокировать цикл событий.
+    """
+    max_header_size = 64 * 1024
+    max_body_size = 64 * 1024 * 1024
+    keepalive_timeout = BigAkoHandler.timeout
+    
+    def __init__(self, port: int = 8000, workers: int = 16):
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bigako-async')
+        self.server_instance = BigAkoHandler.server_instance
+        # Долгоживущие маршруты обслуживаются корутинами, а не потоками пула
+        self.native_routes = {
+            ('GET', '/api/stream'): self.stream_events,
+            ('GET', '/ws'): self.websocket,
+            ('GET', '/api/messages'): self.long_poll,
+        }
+    
+    @staticmethod
+    def parse_head(raw_request: bytes):
+        request_line, _, rest = raw_request.partition(b'\r\n')
+        parts = request_line.decode('latin-1').split()
+        method, target = (parts[0], parts[1]) if len(parts) >= 2 else ('', '')
+        headers = http.client.parse_headers(io.BytesIO(rest))
+        return method, target, headers
+    
+    async def get_session_user(self, headers) -> Optional[str]:
+        token = session_token_from_cookie(headers.get('Cookie', ''))
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.server_instance.get_session_user, token)
+    
+    async def authorize_room(self, target: str, headers,
+                             writer: asyncio.StreamWriter) -> Optional[Tuple[str, int]]:
+        """Пользователь сессии и комната из ?room=. Если доступа нет - пишет 401/403 и возвращает None"""
+        username = await self.get_session_user(headers)
+        if not username:
+            writer.write(b'HTTP/1.1 401 Unauthorized\r\nContent-Length: 0\r\n\r\n')
+            return None
+        room = parse_qs(urlparse(target).query).get('room', [''])[0]
+        room_id = int(room) if room.isdigit() else GENERAL_ROOM_ID
+        allowed = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.server_instance.can_access_room, username, room_id
+        )
+        if not allowed:
+            writer.write(b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\n\r\n')
+            return None
+        return username, room_id
+    
+    def get_stream_start_id(self, target: str, headers) -> int:
+        last_event_id = headers.get('Last-Event-ID') or parse_qs(urlparse(target).query).get('last_id', [''])[0]
+        return int(last_event_id) if last_event_id.isdigit() else self.server_instance.last_message_id
+    
+    async def websocket(self, target: str, headers, writer: asyncio.StreamWriter, reader: asyncio.StreamReader) -> bool:
+        if not is_websocket_upgrade(headers):
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            return False
+        access = await self.authorize_room(target, headers, writer)
+        if access is None:
+            return True
+        username, room_id = access
+        writer.write(websocket_handshake_response(headers['Sec-WebSocket-Key']))
+        await writer.drain()
+        session = session_token_from_cookie(headers.get('Cookie', ''))
+        await AsyncWebSocketConnection(self, reader, writer, username, room_id, session).run(
+            self.get_stream_start_id(target, headers)
+        )
+        return False
+    
+    async def long_poll(self, target: str, headers, writer: asyncio.StreamWriter,
+                        reader: asyncio.StreamReader) -> Optional[bool]:
+        poll = long_poll_params(parse_qs(urlparse(target).query))
+        if poll is None:
+            # Обычный запрос истории обслуживает BigAkoHandler в пуле потоков
+            return None
+        access = await self.authorize_room(target, headers, writer)
+        if access is None:
+            return True
+        
+        since, timeout = poll
+        subscription = AsyncSubscription(self.server_instance.hub, since, self.executor,
+                                         policy='coalesce', room_id=access[1])
+        try:
+            events = await subscription.get(timeout)
+        finally:
+            subscription.close()
+        messages = [event.message for event in events]
+        
+        body = json.dumps({'messages': messages, 'last_id': messages[-1]['id'] if messages else since}).encode()
+        writer.write(
+            b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+            + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body
+        )
+        return True
+    
+    async def stream_events(self, target: str, headers, writer: asyncio.StreamWriter, reader: asyncio.StreamReader) -> bool:
+        access = await self.authorize_room(target, headers, writer)
+        if access is None:
+            return True
+        
+        last_id = self.get_stream_start_id(target, headers)
+        
+        head = 'HTTP/1.1 200 OK\r\n' + ''.join(f'{name}: {value}\r\n' for name, value in SSE_HEADERS.items())
+        writer.write(head.encode() + b'\r\nretry: 3000\n\n')
+        subscription = AsyncSubscription(self.server_instance.hub, last_id, self.executor, room_id=access[1])
+        try:
+            events = await subscription.take()
+            while True:
+                writer.write(b''.join(event.sse for event in events) if events else b': ping\n\n')
+                await writer.drain()
+                events = await subscription.get(BigAkoHandler.stream_heartbeat)
+        except SlowConsumerError:
+            return False
+        finally:
+            subscription.close()
+    
+    def dispatch(self, raw_request: bytes, client_address, handled_requests: int) -> Tuple[bytes, bool]:
+        handler = BufferedBigAkoHandler(raw_request, client_address, handled_requests)
+        return handler.wfile.getvalue(), handler.close_connection
+    
+    async def read_request(self, reader: asyncio.StreamReader) -> Optional[bytes]:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return None
+        content_length = 0
+        for line in head.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                content_length = int(value.strip() or 0)
+        if content_length > self.max_body_size:
+            raise ValueError('Request body too large')
+        body = await reader.readexactly(content_length) if content_length > 0 else b''
+        return head + body
+    
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info('peername')
+        try:
+            for handled_requests in range(BigAkoHandler.max_keepalive_requests):
+                raw_request = await self.read_request(reader)
+                if not raw_request:
+                    break
+                method, target, headers = self.parse_head(raw_request)
+                native_handler = self.native_routes.get((method, urlparse(target).path))
+                if native_handler is not None:
+                    keep_alive = await native_handler(target, headers, writer, reader)
+                    if keep_alive is not None:
+                        await writer.drain()
+                        if not keep_alive:
+                            break
+                        continue
+                response, close_connection = await loop.run_in_executor(
+                    self.executor, self.dispatch, raw_request, client_address, handled_requests
+                )
+                writer.write(response)
+                await writer.drain()
+                if close_connection:
+                    break
+        except ValueError:
+            writer.write(b'HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        except (asyncio.LimitOverrunError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            print(f"Async connection error: {e}")
+        finally:
+            writer.close()
+    
+    async def serve_forever(self, sock: Optional[socket.socket] = None):
+        loop = asyncio.get_running_loop()
+        if sock is not None:
+            server = await asyncio.start_server(self.handle_connection, sock=sock, limit=self.max_header_size)
+            # Супервизор останавливает рабочий процесс сигналом SIGTERM
+            loop.add_signal_handler(signal.SIGTERM, server.close)
+        else:
+            server = await asyncio.start_server(self.handle_connection, '', self.port, limit=self.max_header_size)
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+    
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+class BigAkoThreadPoolServer(socketserver.TCPServer):
+    """TCP-сервер с фиксированным пулом рабочих потоков и ограниченной очередью соединений.
+
+    Если очередь переполнена, клиент сразу получает 503 с заголовком Retry-After,
+    а не ждет, пока освободится один из потоков.
+    """
+    allow_reuse_address = True
+    
+    def __init__(self, server_address, handler_class, workers: int = 16,
+                 queue_size: int = 64, retry_after: int = 1, bind_and_activate: bool = True):
+        self.workers = workers
+        self.retry_after = retry_after
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.worker_threads: List[threading.Thread] = []
+        super().__init__(server_address, handler_class, bind_and_activate)
+        for i in range(workers):
+            thread = threading.Thread(target=self.worker_loop, name=f'bigako-worker-{i}', daemon=True)
+            thread.start()
+            self.worker_threads.append(thread)
+    
+    def process_request(self, request, client_address):
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            self.reject_request(request)
+    
+    def reject_request(self, request):
+        body = b'Server is busy, please retry later'
+        response = (
+            'HTTP/1.1 503 Service Unavailable\r\n'
+            f'Retry-After: {self.retry_after}\r\n'
+            'Content-Type: text/plain; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'
+        ).encode() + body
+        try:
+            # Медленный клиент не должен задерживать цикл accept
+            request.settimeout(1)
+            request.sendall(response)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+    
+    def worker_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+    
+    def server_close(self):
+        super().server_close()
+        for _ in self.worker_threads:
+            try:
+                self.pending.put(None, timeout=1)
+            except queue.Full:
+                break
+
+def make_server(port: int, mode: str, workers: int, queue_size: int, bind_and_activate: bool = True):
+    # Однопоточный сервер не может держать поток открытым, а пулу нужны потоки для обычных запросов
+    BigAkoHandler.max_streams = workers // 2 if mode == 'threads' else 0
+    if mode != 'threads':
+        # Единственный поток не должен простаивать на keep-alive соединении одного клиента
+        BigAkoHandler.max_keepalive_requests = 1
+    if mode == 'threads':
+        return BigAkoThreadPoolServer(("", port), BigAkoHandler, workers=workers, queue_size=queue_size,
+                                      bind_and_activate=bind_and_activate)
+    return socketserver.TCPServer(("", port), BigAkoHandler, bind_and_activate)
+
+class PreforkSupervisor:
+    """Pre-fork режим: родительский процесс открывает слушающий сокет и запускает N рабочих
+    процессов, которые принимают соединения на нем же. Упавшие процессы перезапускаются,
+    SIGINT/SIGTERM супервизора аккуратно останавливает всех.
+    """
+    restart_delay = 1.0
+    shutdown_timeout = 10.0
+    
+    def __init__(self, port: int, processes: int, mode: str = 'single', workers: int = 16, queue_size: int = 64,
+                 bus_socket: Optional[str] = None):
+        self.port = port
+        self.processes = processes
+        self.mode = mode
+        self.workers = workers
+        self.queue_size = queue_size
+        self.bus_socket = bus_socket or default_bus_socket(port)
+        self.broker_pid = None
+        self.children: Dict[int, float] = {}
+        self.stopping = False
+        self.sock = None
+    
+    def run(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("", self.port))
+        self.sock.listen(socketserver.TCPServer.request_queue_size * self.processes)
+        
+        # Сессии должны быть видны всем процессам
+        BigAkoHandler.server_instance.enable_shared_state()
+        # Рабочие откроют свои соединения, унаследованные от супервизора им не нужны
+        BigAkoHandler.server_instance.db.close()
+        
+        signal.signal(signal.SIGINT, self.handle_stop_signal)
+        signal.signal(signal.SIGTERM, self.handle_stop_signal)
+        
+        self.spawn_broker()
+        for _ in range(self.processes):
+            self.spawn()
+        print(f"Prefork supervisor {os.getpid()}: {self.processes} worker processes ({self.mode})")
+        print(f"Message bus: {self.bus_socket}")
+        
+        try:
+            while not self.stopping:
+                self.reap_children(restart=True)
+                time.sleep(0.5)
+        finally:
+            self.stop_children()
+            self.sock.close()
+    
+    def handle_stop_signal(self, signum, frame):
+        self.stopping = True
+    
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self.worker_main()
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+    
+    def spawn_broker(self):
+        """Брокер шины - отдельный дочерний процесс; рабочие подключаются к нему сами и переживают его перезапуск"""
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                self.sock.close()
+                broker = BusBroker(self.bus_socket)
+                broker.bind()
+                
+                def stop(signum, frame):
+                    broker.running = False
+                
+                signal.signal(signal.SIGTERM, stop)
+                try:
+                    broker.serve_forever()
+                finally:
+                    broker.close()
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.broker_pid = pid
+        self.children[pid] = time.monotonic()
+    
+    def worker_main(self):
+        # Ctrl+C получает вся группа процессов, но останавливает рабочих только супервизор
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        server_instance = BigAkoHandler.server_instance
+        server_instance.start_sync()
+        server_instance.start_archiver()
+        server_instance.use_bus(SocketBus(self.bus_socket, on_reconnect=server_instance.sync_wakeup.set))
+        
+        if self.mode == 'async':
+            server = AsyncBigAkoServer(self.port, workers=self.workers)
+            try:
+                asyncio.run(server.serve_forever(self.sock))
+            finally:
+                server.close()
+            return
+        
+        httpd = make_server(self.port, self.mode, self.workers, self.queue_size, bind_and_activate=False)
+        httpd.socket.close()
+        httpd.socket = self.sock
+        
+        def stop(signum, frame):
+            # shutdown() ждет выхода из serve_forever, поэтому вызываем его из другого потока
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+        
+        signal.signal(signal.SIGTERM, stop)
+        httpd.serve_forever()
+        httpd.server_close()
+        for thread in getattr(httpd, 'worker_threads', []):
+            thread.join(self.shutdown_timeout)
+    
+    def reap_children(self, restart: bool):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+            if restart and not self.stopping:
+                role = 'Bus broker' if pid == self.broker_pid else 'Worker'
+                print(f"{role} {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+                # Не перезапускаем в бесконечном цикле процесс, который падает сразу после старта
+                if time.monotonic() - started < self.restart_delay:
+                    time.sleep(self.restart_delay)
+                if pid == self.broker_pid:
+                    self.spawn_broker()
+                else:
+                    self.spawn()
+    
+    def stop_children(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.shutdown_timeout
+        while self.children and time.monotonic() < deadline:
+            self.reap_children(restart=False)
+            time.sleep(0.1)
+        for pid in list(self.children):
+            print(f"Worker {pid} did not stop in time, killing")
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.children.clear()
+
+def default_bus_socket(port: int) -> str:
+    return os.path.join(tempfile.gettempdir(), f'bigako-{port}.sock')
+
+def run_server(port: int = 8000, mode: str = 'single', workers: int = 16, queue_size: int = 64,
+               processes: int = 1, bus_socket: Optional[str] = None):
+    print(BigAkoHandler.server_instance.db.describe())
+    
+    if processes > 1:
+        print(f"BigAko server running on port {port}")
+        print(f"Open http://localhost:{port} in your browser")
+        PreforkSupervisor(port, processes, mode, workers, queue_size, bus_socket).run()
+        print("\nServer stopped")
+        return
+    
+    if bus_socket:
+        # Несколько независимо запущенных серверов с общей базой и внешним брокером (python bus.py)
+        server_instance = BigAkoHandler.server_instance
+        server_instance.enable_shared_state()
+        server_instance.start_sync()
+        server_instance.use_bus(SocketBus(bus_socket, on_reconnect=server_instance.sync_wakeup.set))
+        print(f"Message bus: {bus_socket}")
+    BigAkoHandler.server_instance.start_archiver()
+    
+    if mode == 'async':
+        server = AsyncBigAkoServer(port, workers=workers)
+        print(f"Asyncio engine: {workers} executor threads")
+        print(f"BigAko server running on port {port}")
+        print(f"Open http://localhost:{port} in your browser")
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            print("\nServer stopped")
+        finally:
+            server.close()
+        return
+    
+    httpd = make_server(port, mode, workers, queue_size)
+    if mode == 'threads':
+        print(f"Thread pool: {workers} workers, accept queue {queue_size}")
+    with httpd:
+        print(f"BigAko server running on port {port}")
+        print(f"Open http://localhost:{port} in your browser")
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             print("\nServer stopped")
 
 if __name__ == "__main__":
-    run_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='BigAko messenger server')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--mode', choices=['single', 'threads', 'async'], default='single')
+    parser.add_argument('--workers', type=int, default=16, help='размер пула потоков (для async - потоки для SQLite и файлов)')
+    parser.add_argument('--queue-size', type=int, default=64, help='длина очереди ожидающих соединений')
+    parser.add_argument('--processes', type=int, default=1, help='число рабочих процессов (pre-fork)')
+    parser.add_argument('--db-profile', choices=list(PRAGMA_PROFILES), default=DEFAULT_PROFILE,
+                        help='настройки SQLite: durable - fsync на каждый коммит, balanced - WAL + synchronous=NORMAL, fast - без fsync')
+    parser.add_argument('--db-readers', type=int, help='читающих соединений SQLite в пуле (по умолчанию = --workers)')
+    parser.add_argument('--statement-cache', type=int, default=256, help='кэш подготовленных запросов на соединение')
+    parser.add_argument('--group-commit', action='store_true', help='коммитить add_message пачками из отдельного потока')
+    parser.add_argument('--group-commit-size', type=int, default=256, help='максимум сообщений в одной транзакции')
+    parser.add_argument('--group-commit-delay', type=float, default=0.0, help='сколько миллисекунд дополнительно копить пачку (0 - брать накопившееся за прошлый коммит)')
+    parser.add_argument('--bus-socket', help='Unix-сокет брокера шины (по умолчанию для pre-fork - во временном каталоге)')
+    parser.add_argument('--stream-queue', type=int, default=256, help='очередь событий на одного подписчика (SSE, WebSocket)')
+    parser.add_argument('--stream-policy', choices=Subscription.POLICIES, default='coalesce',
+                        help='что делать с переполненной очередью медленного клиента')
+    parser.add_argument('--archive-after', type=float, help='переносить в архив сообщения старше стольких дней')
+    parser.add_argument('--archive-interval', type=float, default=3600.0, help='как часто (в секундах) запускать перенос в архив')
+    parser.add_argument('--storage', choices=list(STORAGE_BACKENDS), default='sqlite',
+                        help='хранилище: sqlite - users.db, memory - в памяти процесса (для замеров, данные не сохраняются), '
+                             'log - сообщения в журнале messages/, остальное в users.db')
+    parser.add_argument('--history-size', type=int, default=HISTORY_SIZE,
+                        help='сколько последних сообщений держать в памяти для истории и дельт')
+    parser.add_argument('--log-fsync', action='store_true', help='для --storage log: fsync журнала на каждое сообщение')
+    args = parser.parse_args()
+    if args.storage != 'sqlite':
+        # Процессы, групповой коммит и архив держатся на общей базе SQLite
+        if args.processes > 1 or args.bus_socket or args.group_commit or args.archive_after:
+            parser.error(f'--storage {args.storage} works only in a single process without --group-commit and --archive-after')
+        if args.storage == 'log':
+            BigAkoHandler.server_instance.use_storage(LogStorage(SQLiteStorage('users.db'), fsync=args.log_fsync))
+        else:
+            BigAkoHandler.server_instance.use_storage(STORAGE_BACKENDS[args.storage]())
+    if args.history_size != HISTORY_SIZE:
+        BigAkoHandler.server_instance.message_history = MessageCache(args.history_size)
+        BigAkoHandler.server_instance.fill_history()
+    hub = BigAkoHandler.server_instance.hub
+    hub.queue_size = args.stream_queue
+    hub.policy = args.stream_policy
+    db = BigAkoHandler.server_instance.db
+    sqlite = db.rest if isinstance(db, LogStorage) else db
+    if isinstance(sqlite, SQLiteStorage):
+        sqlite.pool.max_readers = args.db_readers or args.workers
+        sqlite.pool.cached_statements = args.statement_cache
+        sqlite.pool.profile = args.db_profile
+    db.close()
+    BigAkoHandler.server_instance.archive_after = args.archive_after
+    BigAkoHandler.server_instance.archive_interval = args.archive_interval
+    if args.group_commit:
+        BigAkoHandler.server_instance.enable_group_commit(args.group_commit_size, args.group_commit_delay / 1000)
+    run_server(args.port, args.mode, args.workers, args.queue_size, args.processes, args.bus_socket)
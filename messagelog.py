@@ -0,0 +1,546 @@
+# messagelog.py
+"""Журнал сообщений: сегментированный файл, в который только дописывают, и индекс id -> смещение.
+
+Для очень частых записей вместо таблицы messages: добавление сообщения - одна запись в конец
+файла и одно число в индексе, без B-дерева, журнала транзакций и вторичных индексов.
+
+Сегмент NNNNNNNNNNNN.log (имя - id первой записи) - подряд идущие записи: заголовок RECORD
+(длина, crc32, id, комната, флаги) и JSON сообщения. NNNNNNNNNNNN.idx - массив из
+segment_records чисел по 8 байт, отображенный в память: в ячейке id - base лежит конец записи
+этого id в сегменте. Начало записи - конец предыдущей, поэтому чтение по id, хвоста и диапазона
+стоит одного обращения к индексу и одного среза mmap сегмента, без поиска и копирования.
+Пропущенные id (импорт, сжатие) занимают ячейку с тем же концом, что у предыдущей, - записи
+нулевой длины.
+
+Запись сначала дописывается в сегмент, потом попадает в индекс. После сбоя последний сегмент
+проверяется с хвоста: записи индекса дальше конца файла или с неверной crc отбрасываются,
+целые записи после последней проиндексированной индексируются заново, оборванный хвост
+обрезается. Сегмент закрывается (seal), когда кончаются ячейки индекса или он вырастает
+до segment_bytes; compact() удаляет или переписывает закрытые сегменты старше заданного id.
+
+Индекс по комнатам и имена файлов держатся в памяти и строятся при открытии по заголовкам записей.
+
+Замер против SQLite:
+    python messagelog.py --bench --count 200000
+"""
+import argparse
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from database import epoch_ms, now_ms
+
+LOG_DIR = 'messages'
+SEGMENT_RECORDS = 1 << 18
+SEGMENT_BYTES = 256 * 1024 * 1024
+
+# Длина JSON, crc32 JSON, id, комната, флаги
+RECORD = struct.Struct('<IIqiB')
+FLAG_FILE = 1
+
+def encode_record(message_id: int, message: Dict) -> bytes:
+    payload = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode()
+    flags = FLAG_FILE if message.get('file_name') else 0
+    return RECORD.pack(len(payload), zlib.crc32(payload), message_id, message['room_id'], flags) + payload
+
+def decode_record(view: memoryview, pos: int = 0) -> Tuple[Dict, int, int]:
+    """Сообщение из записи по смещению pos, id его отправителя и смещение следующей записи.
+    JSON разбирается прямо из среза mmap, без промежуточной копии в bytes"""
+    size, _, message_id, _, _ = RECORD.unpack_from(view, pos)
+    start = pos + RECORD.size
+    message = json.loads(str(view[start:start + size], 'utf-8'))
+    message['id'] = message_id
+    if isinstance(message['timestamp'], str):
+        # Записи до перехода на миллисекунды
+        message['timestamp'] = epoch_ms(message['timestamp'])
+    return message, message.pop('user_id', None), start + size
+
+class LogSegment:
+    def __init__(self, directory: str, base_id: int, capacity: int, suffix: str = ''):
+        self.base_id = base_id
+        self.capacity = capacity
+        self.log_path = os.path.join(directory, f'{base_id:012d}.log{suffix}')
+        self.idx_path = os.path.join(directory, f'{base_id:012d}.idx{suffix}')
+        self.lock = threading.Lock()
+        # Без буфера Python: каждая запись сразу уходит в файл одним write; '+' нужен для mmap на чтение
+        self.file = open(self.log_path, 'a+b', buffering=0)
+        self.size = os.fstat(self.file.fileno()).st_size
+        with open(self.idx_path, 'ab') as f:
+            if f.tell() < capacity * 8:
+                f.truncate(capacity * 8)
+        self.idx_file = open(self.idx_path, 'r+b')
+        self.index_map = mmap.mmap(self.idx_file.fileno(), capacity * 8)
+        self.ends = memoryview(self.index_map).cast('Q')
+        self.count = self.indexed_count()
+        self.data: Optional[mmap.mmap] = None
+        self.mapped = 0
+
+    def indexed_count(self) -> int:
+        # Занятые ячейки - префикс индекса: первая запись сегмента всегда в ячейке 0, концы не убывают
+        low, high = 0, self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            if self.ends[middle]:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @property
+    def last_id(self) -> int:
+        return self.base_id + self.count - 1
+
+    def start_of(self, slot: int) -> int:
+        return self.ends[slot - 1] if slot else 0
+
+    def view(self, start: int, end: int) -> memoryview:
+        if end > self.mapped:
+            with self.lock:
+                if end > self.mapped:
+                    # Старое отображение закроется само, когда на него не останется ссылок
+                    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.mapped = len(self.data)
+        return memoryview(self.data)[start:end]
+
+    def full(self, segment_bytes: int, message_id: int) -> bool:
+        return message_id - self.base_id >= self.capacity or self.size >= segment_bytes
+
+    def write(self, message_id: int, record: bytes):
+        slot = message_id - self.base_id
+        previous_end = self.start_of(self.count)
+        for gap in range(self.count, slot):
+            self.ends[gap] = previous_end
+        self.file.write(record)
+        self.size += len(record)
+        self.ends[slot] = self.size
+        self.count = slot + 1
+
+    def valid_record(self, slot: int) -> bool:
+        start, end = self.start_of(slot), self.ends[slot]
+        if end - start < RECORD.size or end > self.size:
+            return False
+        view = self.view(start, end)
+        size, crc, message_id, _, _ = RECORD.unpack_from(view)
+        return (RECORD.size + size == end - start and message_id == self.base_id + slot
+                and zlib.crc32(view[RECORD.size:]) == crc)
+
+    def recover(self) -> int:
+        """Сверяет хвост сегмента с индексом; возвращает число отброшенных байт"""
+        count = self.count
+        # Ячейки нулевой длины - пропуски id; последняя настоящая запись должна быть целой
+        while count and (self.ends[count - 1] > self.size or self.start_of(count - 1) == self.ends[count - 1]
+                         or not self.valid_record(count - 1)):
+            count -= 1
+        self.count = count
+        pos = self.start_of(count)
+        with open(self.log_path, 'rb') as f:
+            f.seek(pos)
+            tail = f.read()
+        offset = 0
+        while len(tail) - offset >= RECORD.size:
+            size, crc, message_id, _, _ = RECORD.unpack_from(tail, offset)
+            end = offset + RECORD.size + size
+            slot = message_id - self.base_id
+            if (end > len(tail) or slot < self.count or slot >= self.capacity
+                    or zlib.crc32(tail[offset + RECORD.size:end]) != crc):
+                break
+            previous_end = self.start_of(self.count)
+            for gap in range(self.count, slot):
+                self.ends[gap] = previous_end
+            self.ends[slot] = pos + end
+            self.count = slot + 1
+            offset = end
+        dropped = len(tail) - offset
+        if dropped:
+            self.file.truncate(pos + offset)
+            # Страницы старого отображения за новым концом файла читать нельзя (SIGBUS)
+            self.data, self.mapped = None, 0
+        self.size = pos + offset
+        # Ячейки, указывающие на обрезанный хвост
+        if self.count < self.capacity:
+            self.index_map[self.count * 8:] = bytes((self.capacity - self.count) * 8)
+        return dropped
+
+    def records(self, first_slot: int, last_slot: int) -> Iterator[Tuple[Dict, int]]:
+        """Записи ячеек [first_slot, last_slot] одним срезом: они лежат в файле подряд"""
+        start, end = self.start_of(first_slot), self.ends[last_slot]
+        if start == end:
+            return
+        view = self.view(start, end)
+        pos = 0
+        while pos < len(view):
+            message, user_id, pos = decode_record(view, pos)
+            yield message, user_id
+
+    def headers(self) -> Iterator[Tuple[int, int, int, int, int]]:
+        """(id, комната, флаги, начало, конец) всех записей - без разбора JSON"""
+        if not self.count:
+            return
+        view = self.view(0, self.ends[self.count - 1])
+        pos = 0
+        while pos < len(view):
+            size, _, message_id, room_id, flags = RECORD.unpack_from(view, pos)
+            end = pos + RECORD.size + size
+            yield message_id, room_id, flags, pos, end
+            pos = end
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+
+    def seal(self):
+        self.sync()
+        self.index_map.flush()
+
+    def close(self):
+        self.ends.release()
+        self.index_map.close()
+        self.idx_file.close()
+        self.file.close()
+        if self.data is not None:
+            try:
+                self.data.close()
+            except BufferError:
+                # Читатель еще держит срез; отображение освободится вместе с ним
+                pass
+
+    def remove(self):
+        self.close()
+        os.remove(self.log_path)
+        os.remove(self.idx_path)
+
+class MessageLog:
+    """Журнал сообщений. id выдает журнал (или вызывающий - по возрастанию, с пропусками);
+    пишет и сжимает под self.lock, читать можно из любого потока."""
+
+    def __init__(self, path: str = LOG_DIR, segment_records: int = SEGMENT_RECORDS,
+                 segment_bytes: int = SEGMENT_BYTES, fsync: bool = False):
+        self.path = path
+        self.segment_records = segment_records
+        self.segment_bytes = segment_bytes
+        # fsync после каждой записи (пачки) - как synchronous=FULL у SQLite
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.segments: List[LogSegment] = []
+        self.bases: List[int] = []
+        self.room_ids: Dict[int, array] = {}
+        self.files: Dict[str, Tuple[int, int]] = {}
+        self.appends = 0
+        self.syncs = 0
+        self.recovered_bytes = 0
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        names = os.listdir(self.path)
+        for name in names:
+            # Недописанные файлы сжатия и индекс без сегмента (сжатие прервалось между переименованиями)
+            if name.endswith('.tmp') or (name.endswith('.idx') and name[:-4] + '.log' not in names):
+                os.remove(os.path.join(self.path, name))
+        segments = [LogSegment(self.path, int(name[:-4]), self.segment_records)
+                    for name in sorted(names) if name.endswith('.log')]
+        # Сжатый сегмент с большим base уже полностью записан; исходник мог не успеть удалиться
+        kept = []
+        for segment in segments:
+            while kept and kept[-1].last_id >= segment.base_id:
+                kept.pop().remove()
+            kept.append(segment)
+        if kept:
+            self.recovered_bytes = kept[-1].recover()
+            if self.recovered_bytes:
+                print(f"Message log: dropped {self.recovered_bytes} bytes of an unfinished record")
+        self.segments = kept
+        self.bases = [segment.base_id for segment in kept]
+        self.build_indexes()
+
+    def build_indexes(self):
+        self.room_ids = {}
+        self.files = {}
+        for segment in self.segments:
+            for message_id, room_id, flags, start, end in segment.headers():
+                self.room_ids.setdefault(room_id, array('q')).append(message_id)
+                if flags & FLAG_FILE:
+                    message, _, _ = decode_record(segment.view(start, end))
+                    self.files[message['file_name']] = (room_id, message_id)
+
+    def close(self):
+        with self.lock:
+            if self.segments:
+                self.segments[-1].seal()
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+            self.bases = []
+
+    @property
+    def last_id(self) -> int:
+        return self.segments[-1].last_id if self.segments else 0
+
+    @property
+    def first_id(self) -> int:
+        return self.segments[0].base_id if self.segments else 0
+
+    def append(self, message: Dict, message_id: Optional[int] = None) -> int:
+        return self.append_many([message], None if message_id is None else [message_id])[0]
+
+    def append_many(self, messages: List[Dict], message_ids: Optional[List[int]] = None) -> List[int]:
+        """Дописывает сообщения (поля без id, user_id - отправитель) и возвращает их id.
+        При fsync одна синхронизация на всю пачку"""
+        with self.lock:
+            ids = []
+            for n, message in enumerate(messages):
+                message_id = message_ids[n] if message_ids else self.last_id + 1
+                if message_id <= self.last_id:
+                    raise ValueError(f'Message id {message_id} is not above {self.last_id}')
+                record = encode_record(message_id, {k: v for k, v in message.items() if k != 'id'})
+                segment = self.segments[-1] if self.segments else None
+                if segment is None or segment.full(self.segment_bytes, message_id):
+                    if segment is not None:
+                        segment.seal()
+                    segment = LogSegment(self.path, message_id, self.segment_records)
+                    self.segments.append(segment)
+                    self.bases.append(message_id)
+                segment.write(message_id, record)
+                self.room_ids.setdefault(message['room_id'], array('q')).append(message_id)
+                if message.get('file_name'):
+                    self.files[message['file_name']] = (message['room_id'], message_id)
+                ids.append(message_id)
+            if self.fsync and ids:
+                self.segments[-1].sync()
+                self.syncs += 1
+            self.appends += len(ids)
+            return ids
+
+    def segment_for(self, message_id: int) -> Optional[LogSegment]:
+        n = bisect.bisect_right(self.bases, message_id) - 1
+        return self.segments[n] if n >= 0 else None
+
+    def get(self, message_id: int) -> Optional[Dict]:
+        segment = self.segment_for(message_id)
+        if segment is None or message_id > segment.last_id:
+            return None
+        slot = message_id - segment.base_id
+        start, end = segment.start_of(slot), segment.ends[slot]
+        if start == end:
+            return None
+        return decode_record(segment.view(start, end))[0]
+
+    def read_range(self, first_id: int, last_id: int) -> List[Dict]:
+        """Все сообщения с id из [first_id, last_id] - по одному срезу на сегмент"""
+        with self.lock:
+            segments = list(self.segments)
+        messages = []
+        for segment in segments:
+            low, high = max(first_id, segment.base_id), min(last_id, segment.last_id)
+            if low <= high:
+                messages.extend(m for m, _ in segment.records(low - segment.base_id, high - segment.base_id))
+        return messages
+
+    def room_slice(self, room_id: int, low: int, high: int, limit: int, newest: bool) -> List[int]:
+        with self.lock:
+            ids = self.room_ids.get(room_id)
+            if not ids:
+                return []
+            start, end = bisect.bisect_left(ids, low), bisect.bisect_right(ids, high)
+            if newest:
+                start = max(start, end - limit)
+            else:
+                end = min(end, start + limit)
+            return ids[start:end].tolist()
+
+    def since(self, after_id: int, limit: int, room_id: Optional[int] = None) -> List[Dict]:
+        """Первые limit сообщений новее after_id"""
+        if room_id is None:
+            # Обычно id идут подряд и хватает одного диапазона; пропуски добираются следующими
+            messages: List[Dict] = []
+            low = after_id + 1
+            while len(messages) < limit and low <= self.last_id:
+                high = low + limit - len(messages) - 1
+                messages.extend(self.read_range(low, high))
+                low = high + 1
+            return messages
+        return [self.get(i) for i in self.room_slice(room_id, after_id + 1, self.last_id, limit, newest=False)]
+
+    def before(self, before_id: int, limit: int, room_id: Optional[int] = None) -> List[Dict]:
+        """Последние limit сообщений старше before_id"""
+        if room_id is None:
+            messages: List[Dict] = []
+            high = min(before_id, self.last_id + 1) - 1
+            while len(messages) < limit and high >= self.first_id:
+                low = high - (limit - len(messages)) + 1
+                messages[:0] = self.read_range(low, high)
+                high = low - 1
+            return messages
+        return [self.get(i) for i in self.room_slice(room_id, 0, before_id - 1, limit, newest=True)]
+
+    def tail(self, limit: int, room_id: Optional[int] = None) -> List[Dict]:
+        return self.before(self.last_id + 1, limit, room_id)
+
+    def newest_first(self) -> Iterator[Tuple[Dict, int]]:
+        """Все сообщения с id отправителя, от новых к старым - для поиска перебором"""
+        with self.lock:
+            segments = list(self.segments)
+        for segment in reversed(segments):
+            if segment.count:
+                yield from reversed(list(segment.records(0, segment.count - 1)))
+
+    def file_room(self, file_name: str) -> Optional[int]:
+        entry = self.files.get(file_name)
+        return entry[0] if entry else None
+
+    def compact(self, before_id: int) -> int:
+        """Убирает сообщения с id < before_id из закрытых сегментов: целиком старые сегменты
+        удаляются, сегмент на границе переписывается с новым base. Последний (открытый)
+        сегмент не трогается. Возвращает число удаленных сегментов и переписанных."""
+        changed = 0
+        with self.lock:
+            for n, segment in enumerate(self.segments[:-1]):
+                if segment.base_id >= before_id:
+                    break
+                if segment.last_id < before_id:
+                    segment.remove()
+                    self.segments[n] = None
+                    changed += 1
+                    continue
+                first = next((i for i in range(before_id, segment.last_id + 1)
+                              if segment.ends[i - segment.base_id] > segment.start_of(i - segment.base_id)), None)
+                # Копия пишется во временные файлы и переименовывается, только когда целиком на диске:
+                # до этого при сбое остается исходный сегмент
+                copy = LogSegment(self.path, first, self.segment_records, suffix='.tmp')
+                for message_id, _, _, start, end in segment.headers():
+                    if message_id >= first:
+                        copy.write(message_id, bytes(segment.view(start, end)))
+                copy.seal()
+                copy.close()
+                os.replace(copy.idx_path, copy.idx_path[:-4])
+                os.replace(copy.log_path, copy.log_path[:-4])
+                segment.remove()
+                self.segments[n] = LogSegment(self.path, first, self.segment_records)
+                changed += 1
+            self.segments = [segment for segment in self.segments if segment is not None]
+            self.bases = [segment.base_id for segment in self.segments]
+            if not self.segments:
+                return changed
+            # Закрытые сегменты покрывают все id до начала открытого
+            cut = min(before_id, self.segments[-1].base_id)
+            for room_id, ids in self.room_ids.items():
+                self.room_ids[room_id] = ids[bisect.bisect_left(ids, cut):]
+            self.files = {name: entry for name, entry in self.files.items() if entry[1] >= cut}
+        return changed
+
+    def describe(self) -> str:
+        return (f"Message log {self.path}: {len(self.segments)} segments, last id {self.last_id}, "
+                f"fsync={'on' if self.fsync else 'off'}")
+
+    def stats(self) -> Dict:
+        with self.lock:
+            segments = list(self.segments)
+        return {
+            'segments': len(segments),
+            'first_id': self.first_id,
+            'last_id': self.last_id,
+            'bytes': sum(segment.size for segment in segments),
+            'rooms': len(self.room_ids),
+            'appends': self.appends,
+            'syncs': self.syncs,
+            'recovered_bytes': self.recovered_bytes
+        }
+
+def bench_message(n: int, rooms: int) -> Dict:
+    return {
+        'username': f'user{n % 50}',
+        'user_id': n % 50 + 1,
+        'message': f'сообщение номер {n} для замера журнала',
+        'message_type': 'text',
+        'file_name': None,
+        'file_size': None,
+        'timestamp': now_ms(),
+        'room_id': n % rooms + 1
+    }
+
+def timed(func, repeat: int = 1000) -> float:
+    """Среднее время вызова в микросекундах"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+def run_bench(count: int, fsync: bool, rooms: int = 20):
+    # storage импортирует этот модуль, поэтому SQLite для сравнения подключается только здесь
+    from storage import SQLiteStorage
+
+    workdir = tempfile.mkdtemp(prefix='bigako-log-')
+    try:
+        log = MessageLog(os.path.join(workdir, 'messages'), fsync=fsync)
+        log.open()
+        started = time.perf_counter()
+        for n in range(count):
+            log.append(bench_message(n, rooms))
+        elapsed = time.perf_counter() - started
+        print(f"log     append one by one: {count / elapsed:10.0f} msg/s")
+        started = time.perf_counter()
+        for n in range(0, count, 100):
+            log.append_many([bench_message(n + k, rooms) for k in range(100)])
+        elapsed = time.perf_counter() - started
+        print(f"log     append by 100:     {count / elapsed:10.0f} msg/s")
+        last = log.last_id
+        print(f"log     tail 50:           {timed(lambda: log.tail(50)):10.1f} us")
+        print(f"log     since last-50:     {timed(lambda: log.since(last - 50, 50)):10.1f} us")
+        print(f"log     room tail 50:      {timed(lambda: log.tail(50, 3)):10.1f} us")
+        print(f"log     room page deep:    {timed(lambda: log.before(last // 3, 50, 3)):10.1f} us")
+        log.close()
+        started = time.perf_counter()
+        log.open()
+        print(f"log     reopen + indexes:  {(time.perf_counter() - started) * 1000:10.1f} ms "
+              f"({log.last_id} messages, {len(log.segments)} segments)")
+        log.close()
+
+        db = SQLiteStorage(os.path.join(workdir, 'users.db'), os.path.join(workdir, 'archive'),
+                           log=lambda line: None)
+        db.pool.profile = 'durable' if fsync else 'balanced'
+        db.init()
+        with db.pool.writer() as conn:
+            conn.executemany("INSERT INTO users (username, password_hash, salt) VALUES (?, '', '')",
+                             [(f'user{n}',) for n in range(50)])
+            conn.executemany("INSERT INTO rooms (name) VALUES (?)", [(f'room{n}',) for n in range(2, rooms + 1)])
+        started = time.perf_counter()
+        for n in range(count):
+            message = bench_message(n, rooms)
+            db.add_message(message.pop('user_id'), message)
+        elapsed = time.perf_counter() - started
+        print(f"sqlite  append one by one: {count / elapsed:10.0f} msg/s")
+        last = db.last_message_id()
+        print(f"sqlite  tail 50:           {timed(lambda: db.messages_after(last - 50, 50)):10.1f} us")
+        print(f"sqlite  room tail 50:      {timed(lambda: db.recent_messages(3, 50)):10.1f} us")
+        print(f"sqlite  room page deep:    {timed(lambda: db.messages_before(3, last // 3, 50)):10.1f} us")
+        db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BigAko message log')
+    parser.add_argument('--dir', default=LOG_DIR, help='каталог сегментов журнала')
+    parser.add_argument('--bench', action='store_true', help='замер записи и чтения против SQLite')
+    parser.add_argument('--count', type=int, default=100000, help='сообщений в замере')
+    parser.add_argument('--fsync', action='store_true', help='fsync на каждую запись (и synchronous=FULL у SQLite)')
+    parser.add_argument('--compact-before', type=int, help='удалить из закрытых сегментов сообщения с меньшим id')
+    args = parser.parse_args()
+
+    if args.bench:
+        run_bench(args.count, args.fsync)
+        raise SystemExit(0)
+    message_log = MessageLog(args.dir)
+    message_log.open()
+    try:
+        if args.compact_before is not None:
+            print(f"Compacted {message_log.compact(args.compact_before)} segments")
+        print(json.dumps(message_log.stats(), indent=2))
+    finally:
+        message_log.close()
@@ -0,0 +1,340 @@
+# migrations.py
+"""Версионированные миграции схемы users.db.
+
+Каждая миграция - функция с декоратором @migration(версия, название). Номер последней
+примененной версии хранится в таблице schema_version. migrate() применяет недостающие
+миграции по порядку, каждую в своей транзакции вместе с записью в schema_version:
+упавшая миграция откатывается целиком, база остается на предыдущей версии.
+
+Запуск вручную:
+    python migrations.py              # применить недостающие миграции
+    python migrations.py --dry-run    # выполнить и откатить, показав, что изменится
+    python migrations.py --status     # текущая версия и список ожидающих миграций
+"""
+import argparse
+import sqlite3
+from typing import Callable, List, Optional
+
+class Migration:
+    def __init__(self, version: int, name: str, apply: Callable[[sqlite3.Connection], None]):
+        self.version = version
+        self.name = name
+        self.apply = apply
+
+    def __repr__(self):
+        return f'{self.version:03d} {self.name}'
+
+MIGRATIONS: List[Migration] = []
+
+def migration(version: int, name: str):
+    def register(func: Callable[[sqlite3.Connection], None]):
+        if MIGRATIONS and version <= MIGRATIONS[-1].version:
+            raise ValueError(f'Migration {version} is out of order')
+        MIGRATIONS.append(Migration(version, name, func))
+        return func
+    return register
+
+class MigrationError(Exception):
+    pass
+
+# Базы, созданные до появления миграций, уже содержат часть таблиц,
+# поэтому первые шаги написаны через IF NOT EXISTS
+
+@migration(1, 'users and messages tables')
+def create_base_tables(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            salt TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            message TEXT NOT NULL,
+            message_type TEXT DEFAULT 'text',
+            file_name TEXT,
+            file_size INTEGER,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+@migration(2, 'sessions table')
+def create_sessions(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+@migration(3, 'messages.user_id instead of username')
+def messages_user_id(conn: sqlite3.Connection):
+    # Отправители, которых нет в users (например, удаленные вручную), получают
+    # заблокированную учетную запись: пустой хэш не совпадет ни с одним паролем
+    conn.execute('''
+        INSERT INTO users (username, password_hash, salt)
+        SELECT DISTINCT username, '', '' FROM messages
+        WHERE username NOT IN (SELECT username FROM users)
+    ''')
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+    # SQLite не меняет тип столбца на месте: пересобираем таблицу, id сохраняются
+    conn.execute('''
+        CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            message TEXT NOT NULL,
+            message_type TEXT DEFAULT 'text',
+            file_name TEXT,
+            file_size INTEGER,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO messages_new (id, user_id, message, message_type, file_name, file_size, timestamp)
+        SELECT m.id, u.id, m.message, m.message_type, m.file_name, m.file_size, m.timestamp
+        FROM messages m JOIN users u ON u.username = m.username
+    ''')
+    conn.execute("DROP TABLE messages")
+    conn.execute("ALTER TABLE messages_new RENAME TO messages")
+    if seq:
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'messages'", (seq[0],))
+    conn.execute("CREATE INDEX idx_messages_user ON messages (user_id, id)")
+
+@migration(4, 'rooms, room members and messages.room_id')
+def rooms(conn: sqlite3.Connection):
+    # kind: public - открытая комната для всех (общий чат), group - по приглашению, dm - личный диалог.
+    # dm_key - "меньший_id:больший_id" участников, чтобы у пары был ровно один диалог
+    conn.execute('''
+        CREATE TABLE rooms (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'group' CHECK (kind IN ('public', 'group', 'dm')),
+            dm_key TEXT UNIQUE,
+            created_by INTEGER REFERENCES users(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE room_members (
+            room_id INTEGER NOT NULL REFERENCES rooms(id),
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (room_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX idx_room_members_user ON room_members (user_id, room_id)")
+    # Вся прежняя переписка становится общей комнатой с id 1
+    conn.execute("INSERT INTO rooms (id, name, kind) VALUES (1, 'general', 'public')")
+    conn.execute("ALTER TABLE messages ADD COLUMN room_id INTEGER NOT NULL DEFAULT 1 REFERENCES rooms(id)")
+    conn.execute("CREATE INDEX idx_messages_room ON messages (room_id, id)")
+    # Проверка доступа к файлу при скачивании ищет сообщение по имени файла
+    conn.execute("CREATE INDEX idx_messages_file ON messages (file_name) WHERE file_name IS NOT NULL")
+
+@migration(5, 'full-text index messages_fts')
+def messages_fts(conn: sqlite3.Connection):
+    # External content: FTS5 хранит только индекс, текст читается из messages по rowid = id.
+    # Триггеры держат индекс в согласии с таблицей; миграция, которая пересоберет messages,
+    # должна пересоздать и их. prefix: отдельный индекс префиксов из 2 и 3 символов, иначе
+    # короткий запрос 'сл*' сливал бы списки документов всех слов на 'сл'
+    conn.execute('''
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            message, content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    ''')
+    # Заполняем индекс уже накопленной историей
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    # Фильтр поиска по датам находит по этому индексу границы диапазона id
+    conn.execute("CREATE INDEX idx_messages_timestamp ON messages (timestamp)")
+
+@migration(6, 'archived_files for messages moved to the archive')
+def archived_files(conn: sqlite3.Connection):
+    # Сообщения старше порога уходят в archive/ (archive.py); проверке доступа
+    # к их файлам нужна комната, поэтому она остается здесь
+    conn.execute('''
+        CREATE TABLE archived_files (
+            file_name TEXT PRIMARY KEY,
+            room_id INTEGER NOT NULL REFERENCES rooms(id)
+        ) WITHOUT ROWID
+    ''')
+
+@migration(7, 'integer epoch milliseconds in messages.timestamp')
+def timestamp_ms(conn: sqlite3.Connection):
+    # Метка становится числом: строки короче, фильтр по датам - сравнение чисел. Таблица
+    # пересобирается ради нового DEFAULT, id (и вместе с ними индекс messages_fts) сохраняются.
+    # strftime('%s') понимает и 'YYYY-MM-DD HH:MM:SS', и ISO-формат; дробная часть отбрасывается
+    # Нераспознанную метку нельзя молча заменить на 1970 год: миграция откатывается, строки нужно поправить
+    bad = [row[0] for row in conn.execute(
+        "SELECT id FROM messages WHERE strftime('%s', timestamp) IS NULL ORDER BY id")]
+    if bad:
+        ids = ', '.join(map(str, bad[:10])) + (', ...' if len(bad) > 10 else '')
+        raise MigrationError(f'{len(bad)} messages have unparseable timestamps (ids {ids})')
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+    conn.execute('''
+        CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            message TEXT NOT NULL,
+            message_type TEXT DEFAULT 'text',
+            file_name TEXT,
+            file_size INTEGER,
+            timestamp INTEGER NOT NULL DEFAULT (CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)),
+            room_id INTEGER NOT NULL DEFAULT 1 REFERENCES rooms(id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO messages_new (id, user_id, message, message_type, file_name, file_size, timestamp, room_id)
+        SELECT id, user_id, message, message_type, file_name, file_size,
+               CAST(strftime('%s', timestamp) AS INTEGER) * 1000, room_id
+        FROM messages
+    ''')
+    # Вместе с таблицей удаляются ее индексы и триггеры messages_fts
+    conn.execute("DROP TABLE messages")
+    conn.execute("ALTER TABLE messages_new RENAME TO messages")
+    if seq:
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'messages'", (seq[0],))
+    conn.execute("CREATE INDEX idx_messages_user ON messages (user_id, id)")
+    conn.execute("CREATE INDEX idx_messages_room ON messages (room_id, id)")
+    conn.execute("CREATE INDEX idx_messages_file ON messages (file_name) WHERE file_name IS NOT NULL")
+    conn.execute("CREATE INDEX idx_messages_timestamp ON messages (timestamp)")
+    conn.execute('''
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    ''')
+
+@migration(8, 'archive_state: how far messages were moved to the archive')
+def archive_state(conn: sqlite3.Connection):
+    # Привязка архива к базе: в archive/ могут лежать только id, которые эта база сама туда
+    # отдала (archive.check_archive). У существующей базы граница - все уже выданные id
+    conn.execute('''
+        CREATE TABLE archive_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_id INTEGER NOT NULL
+        )
+    ''')
+    conn.execute(
+        "INSERT INTO archive_state (id, last_id) "
+        "SELECT 1, COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'messages'), 0)"
+    )
+
+def ensure_version_table(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def current_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='schema_version'"
+    ).fetchone()
+    if not row:
+        return 0
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def pending_migrations(conn: sqlite3.Connection, target: Optional[int] = None) -> List[Migration]:
+    version = current_version(conn)
+    return [m for m in MIGRATIONS if m.version > version and (target is None or m.version <= target)]
+
+def migrate(conn: sqlite3.Connection, dry_run: bool = False, target: Optional[int] = None,
+            log: Callable[[str], None] = print) -> List[Migration]:
+    """Применяет недостающие миграции и возвращает их список.
+
+    dry_run=True выполняет все ожидающие миграции в одной транзакции и откатывает ее:
+    так проверяется, что они действительно применятся к этой базе, но сама база не меняется.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    applied = []
+    latest = MIGRATIONS[-1].version
+    version = current_version(conn)
+    if version > latest:
+        log(f"Schema version {version} is newer than this code knows ({latest})")
+        return applied
+    if dry_run:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        for step in pending_migrations(conn, target):
+            if not dry_run:
+                # IMMEDIATE сразу берет блокировку записи: два процесса не применят одну миграцию дважды
+                conn.execute("BEGIN IMMEDIATE")
+                if current_version(conn) >= step.version:
+                    conn.rollback()
+                    continue
+            try:
+                ensure_version_table(conn)
+                step.apply(conn)
+                conn.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (step.version, step.name))
+            except Exception as e:
+                conn.rollback()
+                raise MigrationError(f'Migration {step} failed: {e}') from e
+            if dry_run:
+                log(f"[dry run] migration {step} applies cleanly")
+            else:
+                conn.commit()
+                log(f"Applied migration {step}")
+            applied.append(step)
+    finally:
+        if dry_run and conn.in_transaction:
+            conn.rollback()
+    return applied
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BigAko schema migrations')
+    parser.add_argument('--db', default='users.db')
+    parser.add_argument('--dry-run', action='store_true', help='выполнить миграции и откатить их')
+    parser.add_argument('--status', action='store_true', help='показать текущую версию и ожидающие миграции')
+    parser.add_argument('--target', type=int, help='остановиться на этой версии')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.status:
+            print(f"Schema version: {current_version(conn)}")
+            for step in pending_migrations(conn, args.target):
+                print(f"  pending: {step}")
+        else:
+            applied = migrate(conn, dry_run=args.dry_run, target=args.target)
+            if not applied:
+                print(f"Schema is up to date (version {current_version(conn)})")
+    except MigrationError as e:
+        print(e)
+        raise SystemExit(1)
+    finally:
+        conn.close()
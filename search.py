@@ -0,0 +1,343 @@
+# search.py
+"""Полнотекстовый поиск по сообщениям на FTS5 (таблица messages_fts, миграция 5).
+
+Индекс FTS5 только находит совпадения - от новых к старым, по rowid. Фильтры (комнаты,
+отправитель, даты), оценка релевантности и фрагменты с подсветкой считаются здесь же по
+тексту найденных строк. Так цена запроса ограничена сверху: просмотр совпадений
+останавливается по SCAN_BUDGET, и клиент продолжает по курсору. Встроенный bm25() для
+этого не годится - перед первой строкой он проходит весь список документов слова,
+чтобы посчитать IDF, а у частого слова это миллионы строк.
+
+Два порядка выдачи:
+    recent - сначала новые. Курсор - rowid, с которого продолжать просмотр.
+    rank   - по релевантности внутри окна из RANK_WINDOW самых новых подходящих совпадений.
+             Курсор "верх:низ:оценка:id" листает одно окно; когда окно исчерпано,
+             курсор из одного числа открывает следующее, более старое.
+
+Замер на синтетической базе:
+    python search.py --bench --rows 3000000
+"""
+import argparse
+import html
+import itertools
+import os
+import random
+import re
+import sqlite3
+import statistics
+import time
+import unicodedata
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+from database import apply_pragmas, epoch_ms
+from migrations import migrate
+
+RANK_WINDOW = 1000
+MAX_RESULTS = 50
+SCAN_BUDGET = 0.02
+DATE_SLACK = timedelta(hours=1)
+SORT_ORDERS = ('rank', 'recent')
+SNIPPET_WORDS = 16
+# Параметры BM25: насыщение частоты слова и вес нормализации по длине сообщения
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_RE = re.compile(r'\w+')
+
+MESSAGE_COLUMNS = (
+    "SELECT m.id, u.username, m.message, m.message_type, m.file_name, m.file_size, m.timestamp, m.room_id "
+    "FROM messages m JOIN users u ON u.id = m.user_id"
+)
+
+def fold(word: str) -> str:
+    """Нижний регистр без диакритики - примерно так слова нормализует токенизатор unicode61"""
+    return ''.join(ch for ch in unicodedata.normalize('NFKD', word.lower()) if not unicodedata.combining(ch))
+
+def query_terms(text: str) -> List[Tuple[str, bool]]:
+    """Слова запроса: (слово, поиск по префиксу). 'слово*' ищет по префиксу"""
+    return [(fold(word), star == '*') for word, star in re.findall(r'(\w+)(\*?)', text)]
+
+def fts_query(terms: List[Tuple[str, bool]]) -> str:
+    # Слова в кавычках: синтаксис FTS5 из ввода пользователя не исполняется
+    return ' '.join(f'"{word}"' + ('*' if prefix else '') for word, prefix in terms)
+
+def term_matches(token: str, terms: List[Tuple[str, bool]]) -> bool:
+    return any(token.startswith(word) if prefix else token == word for word, prefix in terms)
+
+def relevance(tokens: List[str], terms: List[Tuple[str, bool]], average_length: float) -> float:
+    """BM25 без IDF: все кандидаты содержат все слова запроса, так что IDF лишь придал бы
+    словам постоянные веса. Остаются частота слов и поправка на длину сообщения"""
+    if not tokens:
+        return 0.0
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * len(tokens) / average_length)
+    score = 0.0
+    for word, prefix in terms:
+        tf = sum(1 for token in tokens if token.startswith(word)) if prefix else tokens.count(word)
+        score += tf * (BM25_K1 + 1) / (tf + norm)
+    return score
+
+def snippet_html(message: str, terms: List[Tuple[str, bool]]) -> str:
+    """До SNIPPET_WORDS слов вокруг первого совпадения; совпадения обернуты в <mark>"""
+    words = list(TOKEN_RE.finditer(message))
+    if not words:
+        return html.escape(message)
+    hits = {i for i, word in enumerate(words) if term_matches(fold(word.group()), terms)}
+    first = min(hits) if hits else 0
+    start = max(0, min(first - SNIPPET_WORDS // 4, len(words) - SNIPPET_WORDS))
+    end = min(len(words), start + SNIPPET_WORDS)
+    parts = ['…' if start > 0 else html.escape(message[:words[0].start()])]
+    for i in range(start, end):
+        word = html.escape(words[i].group())
+        parts.append(f'<mark>{word}</mark>' if i in hits else word)
+        tail = message[words[i].end():words[i + 1].start()] if i + 1 < len(words) else message[words[i].end():]
+        parts.append(html.escape(tail) if i + 1 < end or end == len(words) else '…')
+    return ''.join(parts)
+
+def parse_cursor(cursor: str, types: Tuple) -> List:
+    values = cursor.split(':')
+    try:
+        if len(values) != len(types):
+            raise ValueError
+        return [kind(value) for kind, value in zip(types, values)]
+    except ValueError:
+        raise ValueError('Invalid search cursor') from None
+
+def first_id_at(conn: sqlite3.Connection, moment: datetime) -> Optional[int]:
+    """id первого сообщения не раньше moment - по индексу idx_messages_timestamp"""
+    row = conn.execute(
+        "SELECT id FROM messages WHERE timestamp >= ? ORDER BY timestamp LIMIT 1",
+        (epoch_ms(moment),)
+    ).fetchone()
+    return row[0] if row else None
+
+def scan_matches(conn: sqlite3.Connection, match: str, high: int, low: int, condition: str, params: List,
+                 count: int, deadline: Optional[float]) -> Tuple[List[Tuple[int, str]], Optional[int]]:
+    """Совпадения с rowid из [low, high] от новых к старым, подходящие под condition, пока их не станет
+    count или не наступит deadline. Возвращает пары (id, текст) и rowid, с которого продолжать
+    (None - совпадений больше нет)"""
+    # Условие вычисляется в SQL, но строка возвращается в любом случае (без текста, если не подошла):
+    # так видно, докуда дошел просмотр, и его можно прервать по времени.
+    # CROSS JOIN закрепляет порядок: индекс FTS5 ведет, строки messages берутся по первичному ключу
+    rows = conn.execute(
+        f"SELECT m.id, CASE WHEN {condition} THEN m.message END "
+        "FROM messages_fts CROSS JOIN messages m ON m.id = messages_fts.rowid "
+        "WHERE messages_fts MATCH ? AND messages_fts.rowid BETWEEN ? AND ? ORDER BY messages_fts.rowid DESC",
+        params + [match, low, high]
+    )
+    found = []
+    for row in rows:
+        if row[1] is not None:
+            found.append(row)
+            if len(found) >= count:
+                return found, row[0] - 1 if row[0] > low else None
+        if deadline is not None and time.perf_counter() > deadline:
+            return found, row[0] - 1 if row[0] > low else None
+    return found, None
+
+def search_messages(conn: sqlite3.Connection, text: str, user_id: int, room_id: Optional[int] = None,
+                    sender_id: Optional[int] = None, date_from: Optional[date] = None,
+                    date_to: Optional[date] = None, sort: str = 'rank', cursor: Optional[str] = None,
+                    limit: int = 20) -> Tuple[List[Tuple[Tuple, str]], Optional[str]]:
+    """Ищет сообщения в комнатах, доступных user_id (или только в room_id - доступ к ней
+    проверяет вызывающий). Возвращает пары (строка сообщения, фрагмент с подсветкой в HTML)
+    и курсор следующей страницы. Страница может быть короче limit, если просмотр уперся
+    в SCAN_BUDGET, - тогда курсор продолжит с того же места.
+    ValueError - пустой запрос, неизвестный sort или битый курсор.
+    """
+    terms = query_terms(text)
+    if not terms:
+        raise ValueError('Empty search query')
+    if sort not in SORT_ORDERS:
+        raise ValueError(f'Unknown sort order: {sort}')
+    limit = max(1, min(limit, MAX_RESULTS))
+    deadline = time.perf_counter() + SCAN_BUDGET
+
+    conditions, params = [], []
+    if room_id is not None:
+        conditions.append("m.room_id = ?")
+        params.append(room_id)
+    else:
+        conditions.append(
+            "m.room_id IN (SELECT id FROM rooms WHERE kind = 'public' "
+            "UNION ALL SELECT room_id FROM room_members WHERE user_id = ?)"
+        )
+        params.append(user_id)
+    if sender_id is not None:
+        conditions.append("m.user_id = ?")
+        params.append(sender_id)
+    # Даты - дни по UTC, date_to включительно. id растут вместе со временем отправки, поэтому
+    # даты сужают еще и диапазон rowid: поиск за старую неделю не перебирает все более новые
+    # совпадения. Точную границу проверяет сравнение timestamp, а запас DATE_SLACK покрывает
+    # сообщения, записанные с задержкой после своей метки времени
+    low, high = 0, conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    if date_from is not None:
+        start = datetime.combine(date_from, datetime.min.time())
+        conditions.append("m.timestamp >= ?")
+        params.append(epoch_ms(start))
+        low = first_id_at(conn, start - DATE_SLACK)
+        if low is None:
+            return [], None
+    if date_to is not None:
+        end = datetime.combine(date_to + timedelta(days=1), datetime.min.time())
+        conditions.append("m.timestamp < ?")
+        params.append(epoch_ms(end))
+        bound = first_id_at(conn, end + DATE_SLACK)
+        if bound is not None:
+            high = bound - 1
+    condition = ' AND '.join(conditions)
+
+    match = fts_query(terms)
+    if sort == 'recent':
+        if cursor:
+            high = min(high, parse_cursor(cursor, (int,))[0])
+        found, resume = scan_matches(conn, match, high, low, condition, params, limit, deadline)
+        page = found
+        next_cursor = str(resume) if resume is not None else None
+    else:
+        after = None
+        if cursor and ':' in cursor:
+            high, floor, score, last_id = parse_cursor(cursor, (int, int, float, int))
+            # Окно уже было построено первой страницей: те же строки, без ограничения по времени
+            found, _ = scan_matches(conn, match, high, floor, condition, params, RANK_WINDOW, None)
+            resume = floor - 1 if floor > low else None
+            after = (-score, -last_id)
+        else:
+            if cursor:
+                high = min(high, parse_cursor(cursor, (int,))[0])
+            found, resume = scan_matches(conn, match, high, low, condition, params, RANK_WINDOW, deadline)
+            floor = resume + 1 if resume is not None else low
+        tokens = [TOKEN_RE.findall(fold(row[1])) for row in found]
+        average_length = sum(map(len, tokens)) / len(tokens) if tokens else 1.0
+        ranked = sorted(((-relevance(words, terms, average_length), -row[0]), row) for words, row in zip(tokens, found))
+        if after is not None:
+            ranked = [item for item in ranked if item[0] > after]
+        page = [row for _, row in ranked[:limit]]
+        if len(ranked) > limit:
+            score, message_id = ranked[limit - 1][0]
+            next_cursor = f'{high}:{floor}:{-score!r}:{-message_id}'
+        else:
+            # Окно исчерпано - следующая страница начнет окно постарше
+            next_cursor = str(resume) if resume is not None else None
+
+    if not page:
+        return [], next_cursor
+    snippets = {row[0]: snippet_html(row[1], terms) for row in page}
+    rows = conn.execute(
+        f"{MESSAGE_COLUMNS} WHERE m.id IN ({','.join('?' * len(page))})", [row[0] for row in page]
+    ).fetchall()
+    rows_by_id = {row[0]: row for row in rows}
+    return [(rows_by_id[row[0]], snippets[row[0]]) for row in page if row[0] in rows_by_id], next_cursor
+
+# Синтетическая база для замеров: слова из слогов, частоты по закону Ципфа,
+# как в живой переписке - несколько очень частых слов и длинный хвост редких
+
+BENCH_SYLLABLES = ['ка', 'ро', 'ми', 'на', 'то', 'ле', 'су', 'ви', 'да', 'по', 'ре', 'зо', 'ты', 'шу', 'го', 'бе']
+
+def bench_vocabulary(size: int, rng: random.Random) -> List[str]:
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(BENCH_SYLLABLES) for _ in range(rng.randint(2, 4))))
+    # set перебирается в порядке хэшей, который меняется между запусками: сортируем до перемешивания
+    vocabulary = sorted(words)
+    rng.shuffle(vocabulary)
+    return vocabulary
+
+def build_bench_db(path: str, rows: int, users: int = 200, rooms: int = 50, seed: int = 1) -> List[str]:
+    """Создает базу с rows сообщениями и возвращает словарь, отсортированный по частоте"""
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    rng = random.Random(seed)
+    vocabulary = bench_vocabulary(20000, rng)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    conn = sqlite3.connect(path)
+    apply_pragmas(conn, 'fast')
+    migrate(conn, log=lambda _: None)
+    conn.executemany("INSERT INTO users (username, password_hash, salt) VALUES (?, '', '')",
+                     [(f'user{i}',) for i in range(1, users + 1)])
+    conn.executemany("INSERT INTO rooms (name, kind) VALUES (?, 'group')", [(f'room{i}',) for i in range(2, rooms + 1)])
+    # user1 состоит в половине комнат - поиск без room_id фильтрует по членству
+    conn.executemany("INSERT INTO room_members (room_id, user_id) VALUES (?, 1)", [(i,) for i in range(2, rooms + 1, 2)])
+    conn.commit()
+
+    start = time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, 0))
+    step = 2 * 365 * 86400 / rows
+    batch_size = 50000
+    began = time.perf_counter()
+    for first in range(0, rows, batch_size):
+        batch = []
+        for i in range(first, min(first + batch_size, rows)):
+            text = ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(3, 15)))
+            timestamp = int((start + i * step) * 1000)
+            batch.append((rng.randint(1, users), text, timestamp, rng.randint(1, rooms)))
+        conn.executemany("INSERT INTO messages (user_id, message, timestamp, room_id) VALUES (?, ?, ?, ?)", batch)
+        conn.commit()
+        print(f"\r  {min(first + batch_size, rows):,} / {rows:,} messages", end='', flush=True)
+    print(f"\n  built in {time.perf_counter() - began:.1f}s")
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    return vocabulary
+
+def run_bench(path: str, vocabulary: List[str], repeat: int = 20, budget_ms: float = 50.0) -> bool:
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    apply_pragmas(conn, 'balanced', read_only=True)
+    common, frequent, medium, rare = vocabulary[0], vocabulary[9], vocabulary[199], vocabulary[9999]
+    cases = [
+        ('most common word', dict(text=common)),
+        ('10th word', dict(text=frequent)),
+        ('200th word', dict(text=medium)),
+        ('rare word', dict(text=rare)),
+        ('two words', dict(text=f'{frequent} {medium}')),
+        ('prefix', dict(text=medium[:3] + '*')),
+        ('in one room', dict(text=frequent, room_id=2)),
+        ('by sender', dict(text=frequent, sender_id=7)),
+        ('one week', dict(text=frequent, date_from=date(2025, 3, 1), date_to=date(2025, 3, 7))),
+        ('rare + sender', dict(text=rare, sender_id=7)),
+    ]
+    ok = True
+    print(f"{'query':<18}{'sort':<8}{'page':>5}{'rows':>6}{'median ms':>11}{'p95 ms':>9}")
+    for name, kwargs in cases:
+        for sort in SORT_ORDERS:
+            for page in (1, 3):
+                # До нужной страницы доходим по курсорам, как клиент
+                cursor = None
+                for _ in range(page - 1):
+                    _, cursor = search_messages(conn, user_id=1, sort=sort, cursor=cursor, **kwargs)
+                    if cursor is None:
+                        break
+                if page > 1 and cursor is None:
+                    continue
+                timings = []
+                for _ in range(repeat):
+                    began = time.perf_counter()
+                    results, _ = search_messages(conn, user_id=1, sort=sort, cursor=cursor, **kwargs)
+                    timings.append((time.perf_counter() - began) * 1000)
+                timings.sort()
+                median, p95 = statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+                ok = ok and p95 < budget_ms
+                flag = '' if p95 < budget_ms else '  > budget'
+                print(f"{name:<18}{sort:<8}{page:>5}{len(results):>6}{median:>11.2f}{p95:>9.2f}{flag}")
+    conn.close()
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BigAko full-text search benchmark')
+    parser.add_argument('--bench', action='store_true', help='замерить поиск на синтетической базе')
+    parser.add_argument('--rows', type=int, default=3000000)
+    parser.add_argument('--db', default='search-bench.db', help='путь к синтетической базе')
+    parser.add_argument('--reuse', action='store_true', help='не пересоздавать базу, если она уже есть')
+    parser.add_argument('--budget', type=float, default=50.0, help='порог p95 в миллисекундах')
+    args = parser.parse_args()
+    if not args.bench:
+        parser.print_help()
+        raise SystemExit(2)
+
+    if args.reuse and os.path.exists(args.db):
+        vocabulary = bench_vocabulary(20000, random.Random(1))
+    else:
+        print(f"Building {args.db} with {args.rows:,} messages...")
+        vocabulary = build_bench_db(args.db, args.rows)
+    raise SystemExit(0 if run_bench(args.db, vocabulary, budget_ms=args.budget) else 1)
@@ -0,0 +1,852 @@
+# storage.py
+"""Хранилище данных BigAkoServer: пользователи, сессии, сообщения, комнаты и файлы.
+
+Storage - интерфейс, через который сервер работает с данными; BigAkoHandler и движки
+о нем не знают. Реализации:
+    SQLiteStorage - users.db через ConnectionPool, со схемой из migrations.py, полнотекстовым
+                    поиском (search.py) и архивом старых сообщений (archive.py);
+    MemoryStorage - все в памяти процесса: для быстрых проверок и замеров, данные пропадают
+                    с перезапуском, несколько процессов общих данных не видят;
+    LogStorage    - сообщения в журнале messagelog.py (для очень частых записей), остальное
+                    в SQLite; работает в одном процессе.
+
+Каждая реализация должна проходить набор проверок совместимости:
+    python storage.py                    # все реализации
+    python storage.py --backend memory   # одна
+"""
+import argparse
+import bisect
+import itertools
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import traceback
+from datetime import date, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from archive import ARCHIVE_DIR, MessageArchive, check_archive
+from database import DB_PATH, ConnectionPool, epoch_ms, now_ms
+from messagelog import LOG_DIR, MessageLog
+from migrations import migrate
+from search import (MAX_RESULTS, SORT_ORDERS, TOKEN_RE, fold, parse_cursor, query_terms, relevance,
+                    search_messages, snippet_html, term_matches)
+
+# Общая комната, в которую миграция перенесла всю прежнюю переписку
+GENERAL_ROOM_ID = 1
+
+# Имя отправителя хранится только в users, сообщения ссылаются на него по user_id
+MESSAGE_SELECT = (
+    "SELECT m.id, u.username, m.message, m.message_type, m.file_name, m.file_size, m.timestamp, m.room_id "
+    "FROM messages m JOIN users u ON u.id = m.user_id"
+)
+
+INSERT_MESSAGE = (
+    "INSERT INTO messages (user_id, message, message_type, file_name, file_size, timestamp, room_id) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+
+def row_to_message(row) -> Dict:
+    return {
+        'id': row[0],
+        'username': row[1],
+        'message': row[2],
+        'message_type': row[3],
+        'file_name': row[4],
+        'file_size': row[5],
+        'timestamp': row[6],
+        'room_id': row[7]
+    }
+
+def dm_key(user_id: int, other_id: int) -> str:
+    """Ключ личного диалога: "меньший_id:больший_id", у пары ровно один диалог"""
+    return f'{min(user_id, other_id)}:{max(user_id, other_id)}'
+
+def scan_search(candidates: Iterable[Tuple[Dict, int]], rooms: Set[int], text: str, sender_id: Optional[int],
+                date_from: Optional[date], date_to: Optional[date], sort: str, cursor: Optional[str],
+                limit: int) -> Tuple[List[Dict], Optional[str]]:
+    """Поиск перебором для хранилищ без полнотекстового индекса - для тестов и замеров, не для
+    больших объемов. candidates - пары (сообщение, id отправителя) от новых к старым.
+    Курсор recent - id, с которого продолжать вниз; rank - "оценка:id" последнего выданного"""
+    terms = query_terms(text)
+    if not terms:
+        raise ValueError('Empty search query')
+    if sort not in SORT_ORDERS:
+        raise ValueError(f'Unknown sort order: {sort}')
+    limit = max(1, min(limit, MAX_RESULTS))
+    start = epoch_ms(date_from) if date_from else 0
+    end = epoch_ms(date_to + timedelta(days=1)) if date_to else None
+    high = parse_cursor(cursor, (int,))[0] if cursor and sort == 'recent' else None
+    found = []
+    for message, sender in candidates:
+        if high is not None and message['id'] > high:
+            continue
+        if (message['room_id'] not in rooms or message['timestamp'] < start
+                or (end is not None and message['timestamp'] >= end)
+                or (sender_id is not None and sender != sender_id)):
+            continue
+        tokens = TOKEN_RE.findall(fold(message['message']))
+        # Как у FTS5: в сообщении должны встретиться все слова запроса
+        if all(any(term_matches(token, [term]) for token in tokens) for term in terms):
+            found.append((tokens, dict(message)))
+    if sort == 'recent':
+        page = [message for _, message in found[:limit]]
+        next_cursor = str(page[-1]['id'] - 1) if len(found) > limit else None
+    else:
+        average_length = sum(len(tokens) for tokens, _ in found) / len(found) if found else 1.0
+        ranked = sorted(((-relevance(tokens, terms, average_length), -m['id']), m) for tokens, m in found)
+        if cursor:
+            score, last_id = parse_cursor(cursor, (float, int))
+            ranked = [item for item in ranked if item[0] > (-score, -last_id)]
+        page = [message for _, message in ranked[:limit]]
+        next_cursor = None
+        if len(ranked) > limit:
+            score, message_id = ranked[limit - 1][0]
+            next_cursor = f'{-score!r}:{-message_id}'
+    return [dict(message, snippet=snippet_html(message['message'], terms)) for message in page], next_cursor
+
+class Storage:
+    """Интерфейс хранилища. Сообщение - словарь с полями row_to_message; id выдает хранилище,
+    по возрастанию. Списки сообщений всегда упорядочены по возрастанию id.
+    Проверка прав (кто может писать в комнату) - дело вызывающего, хранилище только отвечает
+    на вопросы о членстве."""
+
+    def init(self):
+        """Готовит хранилище к работе (создает или обновляет схему)"""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    @property
+    def durable(self) -> bool:
+        """Переживает ли подтвержденная запись сбой питания"""
+        raise NotImplementedError
+
+    def describe(self) -> str:
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        raise NotImplementedError
+
+    # Пользователи
+
+    def add_user(self, username: str, password_hash: str, salt: str) -> bool:
+        """False - имя уже занято"""
+        raise NotImplementedError
+
+    def find_user(self, username: str) -> Optional[Tuple[int, str, str]]:
+        """(id, хэш пароля, соль) или None"""
+        raise NotImplementedError
+
+    # Сессии
+
+    def add_session(self, token: str, username: str):
+        raise NotImplementedError
+
+    def session_user(self, token: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def delete_session(self, token: str):
+        raise NotImplementedError
+
+    # Сообщения
+
+    def add_message(self, user_id: int, entry: Dict) -> int:
+        """Сохраняет сообщение (все поля entry, кроме id) и возвращает его id"""
+        raise NotImplementedError
+
+    def last_message_id(self) -> int:
+        raise NotImplementedError
+
+    def recent_messages(self, room_id: int, limit: int) -> List[Dict]:
+        raise NotImplementedError
+
+    def messages_before(self, room_id: int, before_id: int, limit: int) -> List[Dict]:
+        """limit сообщений комнаты, ближайших к before_id снизу"""
+        raise NotImplementedError
+
+    def messages_after(self, after_id: int, limit: int, room_id: Optional[int] = None) -> List[Dict]:
+        """Первые limit сообщений новее after_id; без room_id - из всех комнат"""
+        raise NotImplementedError
+
+    def search(self, user_id: int, text: str, room_id: Optional[int] = None, sender_id: Optional[int] = None,
+               date_from: Optional[date] = None, date_to: Optional[date] = None, sort: str = 'rank',
+               cursor: Optional[str] = None, limit: int = 20) -> Tuple[List[Dict], Optional[str]]:
+        """Поиск по тексту (слова через пробел, 'слово*' - префикс) в комнатах, доступных user_id,
+        или только в room_id. Сообщения дополнены полем snippet; второй элемент - курсор
+        следующей страницы. ValueError - пустой запрос, неизвестный sort или битый курсор."""
+        raise NotImplementedError
+
+    # Комнаты
+
+    def room_access(self, user_id: int, room_id: int) -> bool:
+        """Комната открытая или user_id в ней участник"""
+        raise NotImplementedError
+
+    def list_rooms(self, user_id: int) -> List[Dict]:
+        """Открытые комнаты и комнаты пользователя по возрастанию id: {'id', 'kind', 'name'};
+        у личного диалога name - имя собеседника"""
+        raise NotImplementedError
+
+    def add_group_room(self, name: str, created_by: int, member_ids: List[int]) -> int:
+        raise NotImplementedError
+
+    def direct_room(self, user_id: int, other_id: int) -> int:
+        """id личного диалога двух пользователей; создает его, если еще нет"""
+        raise NotImplementedError
+
+    def add_room_member(self, room_id: int, user_id: int) -> bool:
+        """Добавляет в групповую комнату; False - комнаты нет или она не групповая"""
+        raise NotImplementedError
+
+    # Файлы
+
+    def file_room(self, file_name: str) -> Optional[int]:
+        """Комната сообщения, к которому приложен файл"""
+        raise NotImplementedError
+
+class SQLiteStorage(Storage):
+    def __init__(self, path: str = DB_PATH, archive_dir: str = ARCHIVE_DIR, log: Callable[[str], None] = print):
+        self.path = path
+        self.log = log
+        self.pool = ConnectionPool(path)
+        # Старые сообщения, перенесенные из messages в сжатые сегменты (archive.py)
+        self.archive = MessageArchive(archive_dir)
+
+    def init(self):
+        with self.pool.writer() as conn:
+            migrate(conn, log=self.log)
+            # ArchiveMismatch: архив остался от другой базы
+            check_archive(conn, self.archive)
+
+    def close(self):
+        self.pool.close()
+
+    @property
+    def durable(self) -> bool:
+        return self.pool.durable
+
+    def describe(self) -> str:
+        return self.pool.describe()
+
+    def stats(self) -> Dict:
+        return dict(self.pool.stats(), archive=self.archive.stats())
+
+    def add_user(self, username: str, password_hash: str, salt: str) -> bool:
+        try:
+            with self.pool.writer() as conn:
+                conn.execute(
+                    "INSERT INTO users (username, password_hash, salt) VALUES (?, ?, ?)",
+                    (username, password_hash, salt)
+                )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def find_user(self, username: str) -> Optional[Tuple[int, str, str]]:
+        with self.pool.reader() as conn:
+            row = conn.execute(
+                "SELECT id, password_hash, salt FROM users WHERE username = ?", (username,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def add_session(self, token: str, username: str):
+        with self.pool.writer() as conn:
+            conn.execute("INSERT INTO sessions (token, username) VALUES (?, ?)", (token, username))
+
+    def session_user(self, token: str) -> Optional[str]:
+        with self.pool.reader() as conn:
+            row = conn.execute("SELECT username FROM sessions WHERE token = ?", (token,)).fetchone()
+        return row[0] if row else None
+
+    def delete_session(self, token: str):
+        with self.pool.writer() as conn:
+            conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
+
+    def message_insert(self, user_id: int, entry: Dict) -> Tuple[str, tuple]:
+        """SQL и параметры вставки - их же отдают групповому коммиту, который пишет сам"""
+        return INSERT_MESSAGE, (user_id, entry['message'], entry['message_type'], entry['file_name'],
+                                entry['file_size'], entry['timestamp'], entry['room_id'])
+
+    def add_message(self, user_id: int, entry: Dict) -> int:
+        with self.pool.writer() as conn:
+            return conn.execute(*self.message_insert(user_id, entry)).lastrowid
+
+    def last_message_id(self) -> int:
+        with self.pool.reader() as conn:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+    def recent_messages(self, room_id: int, limit: int) -> List[Dict]:
+        # Диапазон по индексу (room_id, id): стоимость не зависит от трафика в других комнатах
+        with self.pool.reader() as conn:
+            rows = conn.execute(
+                f"{MESSAGE_SELECT} WHERE m.room_id = ? ORDER BY m.id DESC LIMIT ?",
+                (room_id, limit)
+            ).fetchall()
+        messages = [row_to_message(row) for row in reversed(rows)]
+        return self.with_archived_before(messages, None, limit, room_id)
+
+    def messages_before(self, room_id: int, before_id: int, limit: int) -> List[Dict]:
+        # Поиск в индексе (room_id, id) и чтение limit строк назад - цена страницы
+        # не зависит от того, насколько глубоко в истории она лежит
+        with self.pool.reader() as conn:
+            rows = conn.execute(
+                f"{MESSAGE_SELECT} WHERE m.room_id = ? AND m.id < ? ORDER BY m.id DESC LIMIT ?",
+                (room_id, before_id, limit)
+            ).fetchall()
+        messages = [row_to_message(row) for row in reversed(rows)]
+        return self.with_archived_before(messages, before_id, limit, room_id)
+
+    def with_archived_before(self, messages: List[Dict], before_id: Optional[int], limit: int,
+                             room_id: int) -> List[Dict]:
+        """Дополняет неполную страницу из базы более старыми сообщениями из архива"""
+        if len(messages) >= limit:
+            return messages
+        # Пока пачка переносится, она есть и в базе, и в архиве: из архива берем только то, что старше
+        if messages:
+            before_id = messages[0]['id']
+        elif before_id is None:
+            before_id = self.archive.last_id + 1
+        return self.archive.read_before(before_id, limit - len(messages), room_id) + messages
+
+    def messages_after(self, after_id: int, limit: int, room_id: Optional[int] = None) -> List[Dict]:
+        with self.pool.reader() as conn:
+            # Граница archive_state и строки читаются одним снимком. Граница поднимается до записи
+            # в архив и удаления из базы: если after_id не ниже ее и уже прочитанного архива, ничего
+            # новее after_id из базы не ушло, и каталог archive/ не перечитывается на каждый вызов
+            conn.execute("BEGIN")
+            try:
+                mark = conn.execute("SELECT last_id FROM archive_state").fetchone()[0]
+                archived = []
+                if after_id < max(mark, self.archive.last_id):
+                    # Клиент, давно не заходивший в чат, может продолжать с id, который уже в архиве
+                    archived = self.archive.read_after(after_id, limit, room_id)
+                    if len(archived) >= limit:
+                        return archived
+                    if archived:
+                        after_id = archived[-1]['id']
+                        limit -= len(archived)
+                if room_id is None:
+                    rows = conn.execute(
+                        f"{MESSAGE_SELECT} WHERE m.id > ? ORDER BY m.id LIMIT ?",
+                        (after_id, limit)
+                    ).fetchall()
+                else:
+                    rows = conn.execute(
+                        f"{MESSAGE_SELECT} WHERE m.room_id = ? AND m.id > ? ORDER BY m.id LIMIT ?",
+                        (room_id, after_id, limit)
+                    ).fetchall()
+            finally:
+                conn.rollback()
+        return archived + [row_to_message(row) for row in rows]
+
+    def search(self, user_id: int, text: str, room_id: Optional[int] = None, sender_id: Optional[int] = None,
+               date_from: Optional[date] = None, date_to: Optional[date] = None, sort: str = 'rank',
+               cursor: Optional[str] = None, limit: int = 20) -> Tuple[List[Dict], Optional[str]]:
+        with self.pool.reader() as conn:
+            results, next_cursor = search_messages(
+                conn, text, user_id, room_id, sender_id, date_from, date_to, sort, cursor, limit
+            )
+        return [dict(row_to_message(row), snippet=snippet) for row, snippet in results], next_cursor
+
+    def room_access(self, user_id: int, room_id: int) -> bool:
+        with self.pool.reader() as conn:
+            row = conn.execute(
+                "SELECT r.kind = 'public' OR EXISTS("
+                "SELECT 1 FROM room_members WHERE room_id = r.id AND user_id = ?) "
+                "FROM rooms r WHERE r.id = ?",
+                (user_id, room_id)
+            ).fetchone()
+        return bool(row and row[0])
+
+    def list_rooms(self, user_id: int) -> List[Dict]:
+        with self.pool.reader() as conn:
+            rows = conn.execute(
+                "SELECT r.id, r.kind, CASE WHEN r.kind = 'dm' THEN ("
+                "SELECT u.username FROM room_members rm JOIN users u ON u.id = rm.user_id "
+                "WHERE rm.room_id = r.id AND rm.user_id != ?) ELSE r.name END "
+                "FROM rooms r WHERE r.kind = 'public' "
+                "OR r.id IN (SELECT room_id FROM room_members WHERE user_id = ?) ORDER BY r.id",
+                (user_id, user_id)
+            ).fetchall()
+        return [{'id': row[0], 'kind': row[1], 'name': row[2]} for row in rows]
+
+    def add_group_room(self, name: str, created_by: int, member_ids: List[int]) -> int:
+        with self.pool.writer() as conn:
+            room_id = conn.execute(
+                "INSERT INTO rooms (name, kind, created_by) VALUES (?, 'group', ?)", (name, created_by)
+            ).lastrowid
+            conn.executemany(
+                "INSERT OR IGNORE INTO room_members (room_id, user_id) VALUES (?, ?)",
+                [(room_id, member_id) for member_id in member_ids]
+            )
+        return room_id
+
+    def direct_room(self, user_id: int, other_id: int) -> int:
+        key = dm_key(user_id, other_id)
+        with self.pool.writer() as conn:
+            row = conn.execute("SELECT id FROM rooms WHERE dm_key = ?", (key,)).fetchone()
+            if row:
+                return row[0]
+            room_id = conn.execute(
+                "INSERT INTO rooms (name, kind, dm_key, created_by) VALUES (?, 'dm', ?, ?)",
+                (key, key, user_id)
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO room_members (room_id, user_id) VALUES (?, ?)",
+                [(room_id, user_id), (room_id, other_id)]
+            )
+        return room_id
+
+    def add_room_member(self, room_id: int, user_id: int) -> bool:
+        with self.pool.writer() as conn:
+            row = conn.execute("SELECT kind FROM rooms WHERE id = ?", (room_id,)).fetchone()
+            if not row or row[0] != 'group':
+                return False
+            conn.execute("INSERT OR IGNORE INTO room_members (room_id, user_id) VALUES (?, ?)", (room_id, user_id))
+        return True
+
+    def file_room(self, file_name: str) -> Optional[int]:
+        # Файлы перенесенных в архив сообщений помнит archived_files
+        with self.pool.reader() as conn:
+            row = conn.execute(
+                "SELECT room_id FROM messages WHERE file_name = ? "
+                "UNION ALL SELECT room_id FROM archived_files WHERE file_name = ? LIMIT 1",
+                (file_name, file_name)
+            ).fetchone()
+        return row[0] if row else None
+
+class MemoryStorage(Storage):
+    """Все данные в словарях и списках под одной блокировкой. Сообщения хранятся списками
+    по возрастанию id - общим и по комнатам, страницы находятся бинарным поиском."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.user_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.room_ids = itertools.count(GENERAL_ROOM_ID + 1)
+        self.users: Dict[str, Tuple[int, str, str]] = {}
+        self.usernames: Dict[int, str] = {}
+        self.sessions: Dict[str, str] = {}
+        self.messages: List[Dict] = []
+        self.message_index: List[int] = []
+        self.senders: Dict[int, int] = {}
+        self.room_messages: Dict[int, List[Dict]] = {}
+        self.room_index: Dict[int, List[int]] = {}
+        self.rooms: Dict[int, Dict] = {GENERAL_ROOM_ID: {'name': 'general', 'kind': 'public'}}
+        self.members: Dict[int, set] = {GENERAL_ROOM_ID: set()}
+        self.dm_rooms: Dict[str, int] = {}
+        self.files: Dict[str, int] = {}
+
+    def init(self):
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def durable(self) -> bool:
+        return False
+
+    def describe(self) -> str:
+        return "Storage: in memory (data is lost on restart)"
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'backend': 'memory',
+                'users': len(self.users),
+                'sessions': len(self.sessions),
+                'messages': len(self.messages),
+                'rooms': len(self.rooms)
+            }
+
+    def add_user(self, username: str, password_hash: str, salt: str) -> bool:
+        with self.lock:
+            if username in self.users:
+                return False
+            user_id = next(self.user_ids)
+            self.users[username] = (user_id, password_hash, salt)
+            self.usernames[user_id] = username
+        return True
+
+    def find_user(self, username: str) -> Optional[Tuple[int, str, str]]:
+        with self.lock:
+            return self.users.get(username)
+
+    def add_session(self, token: str, username: str):
+        with self.lock:
+            self.sessions[token] = username
+
+    def session_user(self, token: str) -> Optional[str]:
+        with self.lock:
+            return self.sessions.get(token)
+
+    def delete_session(self, token: str):
+        with self.lock:
+            self.sessions.pop(token, None)
+
+    def add_message(self, user_id: int, entry: Dict) -> int:
+        with self.lock:
+            message = dict(entry, id=next(self.message_ids), username=self.usernames.get(user_id))
+            room_id = message['room_id']
+            self.messages.append(message)
+            self.message_index.append(message['id'])
+            self.room_messages.setdefault(room_id, []).append(message)
+            self.room_index.setdefault(room_id, []).append(message['id'])
+            self.senders[message['id']] = user_id
+            if message['file_name']:
+                self.files[message['file_name']] = room_id
+        return message['id']
+
+    def last_message_id(self) -> int:
+        with self.lock:
+            return self.message_index[-1] if self.message_index else 0
+
+    def recent_messages(self, room_id: int, limit: int) -> List[Dict]:
+        with self.lock:
+            return [dict(m) for m in self.room_messages.get(room_id, [])[-limit:]]
+
+    def messages_before(self, room_id: int, before_id: int, limit: int) -> List[Dict]:
+        with self.lock:
+            end = bisect.bisect_left(self.room_index.get(room_id, []), before_id)
+            return [dict(m) for m in self.room_messages.get(room_id, [])[max(end - limit, 0):end]]
+
+    def messages_after(self, after_id: int, limit: int, room_id: Optional[int] = None) -> List[Dict]:
+        with self.lock:
+            if room_id is None:
+                messages, index = self.messages, self.message_index
+            else:
+                messages, index = self.room_messages.get(room_id, []), self.room_index.get(room_id, [])
+            start = bisect.bisect_right(index, after_id)
+            return [dict(m) for m in messages[start:start + limit]]
+
+    def search(self, user_id: int, text: str, room_id: Optional[int] = None, sender_id: Optional[int] = None,
+               date_from: Optional[date] = None, date_to: Optional[date] = None, sort: str = 'rank',
+               cursor: Optional[str] = None, limit: int = 20) -> Tuple[List[Dict], Optional[str]]:
+        with self.lock:
+            if room_id is not None:
+                rooms = {room_id}
+            else:
+                rooms = {r for r, room in self.rooms.items() if room['kind'] == 'public' or user_id in self.members[r]}
+            candidates = [(message, self.senders[message['id']]) for message in reversed(self.messages)]
+        return scan_search(candidates, rooms, text, sender_id, date_from, date_to, sort, cursor, limit)
+
+    def room_access(self, user_id: int, room_id: int) -> bool:
+        with self.lock:
+            room = self.rooms.get(room_id)
+            return bool(room) and (room['kind'] == 'public' or user_id in self.members[room_id])
+
+    def list_rooms(self, user_id: int) -> List[Dict]:
+        with self.lock:
+            rooms = []
+            for room_id in sorted(self.rooms):
+                room = self.rooms[room_id]
+                if room['kind'] != 'public' and user_id not in self.members[room_id]:
+                    continue
+                name = room['name']
+                if room['kind'] == 'dm':
+                    others = [self.usernames[m] for m in self.members[room_id] if m != user_id]
+                    name = others[0] if others else None
+                rooms.append({'id': room_id, 'kind': room['kind'], 'name': name})
+            return rooms
+
+    def add_group_room(self, name: str, created_by: int, member_ids: List[int]) -> int:
+        with self.lock:
+            room_id = next(self.room_ids)
+            self.rooms[room_id] = {'name': name, 'kind': 'group'}
+            self.members[room_id] = set(member_ids)
+        return room_id
+
+    def direct_room(self, user_id: int, other_id: int) -> int:
+        key = dm_key(user_id, other_id)
+        with self.lock:
+            room_id = self.dm_rooms.get(key)
+            if room_id is None:
+                room_id = self.dm_rooms[key] = next(self.room_ids)
+                self.rooms[room_id] = {'name': key, 'kind': 'dm'}
+                self.members[room_id] = {user_id, other_id}
+        return room_id
+
+    def add_room_member(self, room_id: int, user_id: int) -> bool:
+        with self.lock:
+            room = self.rooms.get(room_id)
+            if not room or room['kind'] != 'group':
+                return False
+            self.members[room_id].add(user_id)
+        return True
+
+    def file_room(self, file_name: str) -> Optional[int]:
+        with self.lock:
+            return self.files.get(file_name)
+
+class LogStorage(Storage):
+    """Сообщения - в журнале MessageLog (messagelog.py), остальное - во вложенном хранилище.
+    id сообщений выдает журнал, история из таблицы messages в него не переносится."""
+
+    def __init__(self, rest: Optional[Storage] = None, path: str = LOG_DIR, fsync: bool = False):
+        self.rest = rest if rest is not None else SQLiteStorage()
+        self.log = MessageLog(path, fsync=fsync)
+
+    def init(self):
+        self.rest.init()
+        if not self.log.segments:
+            self.log.open()
+
+    def close(self):
+        self.log.close()
+        self.rest.close()
+
+    @property
+    def durable(self) -> bool:
+        return self.log.fsync and self.rest.durable
+
+    def describe(self) -> str:
+        return f"{self.rest.describe()}\n{self.log.describe()}"
+
+    def stats(self) -> Dict:
+        return dict(self.rest.stats(), log=self.log.stats())
+
+    def add_user(self, username: str, password_hash: str, salt: str) -> bool:
+        return self.rest.add_user(username, password_hash, salt)
+
+    def find_user(self, username: str) -> Optional[Tuple[int, str, str]]:
+        return self.rest.find_user(username)
+
+    def add_session(self, token: str, username: str):
+        self.rest.add_session(token, username)
+
+    def session_user(self, token: str) -> Optional[str]:
+        return self.rest.session_user(token)
+
+    def delete_session(self, token: str):
+        self.rest.delete_session(token)
+
+    def add_message(self, user_id: int, entry: Dict) -> int:
+        return self.log.append(dict(entry, user_id=user_id))
+
+    def last_message_id(self) -> int:
+        return self.log.last_id
+
+    def recent_messages(self, room_id: int, limit: int) -> List[Dict]:
+        return self.log.tail(limit, room_id)
+
+    def messages_before(self, room_id: int, before_id: int, limit: int) -> List[Dict]:
+        return self.log.before(before_id, limit, room_id)
+
+    def messages_after(self, after_id: int, limit: int, room_id: Optional[int] = None) -> List[Dict]:
+        return self.log.since(after_id, limit, room_id)
+
+    def search(self, user_id: int, text: str, room_id: Optional[int] = None, sender_id: Optional[int] = None,
+               date_from: Optional[date] = None, date_to: Optional[date] = None, sort: str = 'rank',
+               cursor: Optional[str] = None, limit: int = 20) -> Tuple[List[Dict], Optional[str]]:
+        # Полнотекстового индекса у журнала нет - перебор, как у MemoryStorage
+        rooms = {room_id} if room_id is not None else {room['id'] for room in self.rest.list_rooms(user_id)}
+        return scan_search(self.log.newest_first(), rooms, text, sender_id, date_from, date_to, sort, cursor, limit)
+
+    def room_access(self, user_id: int, room_id: int) -> bool:
+        return self.rest.room_access(user_id, room_id)
+
+    def list_rooms(self, user_id: int) -> List[Dict]:
+        return self.rest.list_rooms(user_id)
+
+    def add_group_room(self, name: str, created_by: int, member_ids: List[int]) -> int:
+        return self.rest.add_group_room(name, created_by, member_ids)
+
+    def direct_room(self, user_id: int, other_id: int) -> int:
+        return self.rest.direct_room(user_id, other_id)
+
+    def add_room_member(self, room_id: int, user_id: int) -> bool:
+        return self.rest.add_room_member(room_id, user_id)
+
+    def file_room(self, file_name: str) -> Optional[int]:
+        return self.log.file_room(file_name)
+
+STORAGE_BACKENDS: Dict[str, Callable[..., Storage]] = {
+    'sqlite': SQLiteStorage,
+    'memory': MemoryStorage,
+    'log': LogStorage
+}
+
+# Проверки совместимости: каждая получает новое пустое хранилище после init()
+
+class ConformanceError(Exception):
+    pass
+
+CONFORMANCE_CHECKS: List[Tuple[str, Callable[[Storage], None]]] = []
+
+def conformance(name: str):
+    def register(func: Callable[[Storage], None]):
+        CONFORMANCE_CHECKS.append((name, func))
+        return func
+    return register
+
+def expect(condition, message: str):
+    if not condition:
+        raise ConformanceError(message)
+
+def make_users(storage: Storage, *names: str) -> List[int]:
+    for name in names:
+        storage.add_user(name, f'hash-{name}', f'salt-{name}')
+    return [storage.find_user(name)[0] for name in names]
+
+def post(storage: Storage, user_id: int, username: str, text: str, room_id: int = GENERAL_ROOM_ID,
+         file_name: Optional[str] = None, timestamp: Optional[int] = None) -> int:
+    return storage.add_message(user_id, {
+        'id': None,
+        'username': username,
+        'message': text,
+        'message_type': 'file' if file_name else 'text',
+        'file_name': file_name,
+        'file_size': 10 if file_name else None,
+        'timestamp': timestamp or now_ms(),
+        'room_id': room_id
+    })
+
+@conformance('users')
+def check_users(storage: Storage):
+    expect(storage.add_user('alice', 'h1', 's1'), 'new user is not created')
+    expect(not storage.add_user('alice', 'h2', 's2'), 'duplicate username is accepted')
+    user = storage.find_user('alice')
+    expect(user is not None and tuple(user[1:]) == ('h1', 's1'), f'find_user returned {user}')
+    expect(storage.find_user('nobody') is None, 'unknown user is found')
+
+@conformance('sessions')
+def check_sessions(storage: Storage):
+    make_users(storage, 'alice')
+    storage.add_session('token1', 'alice')
+    expect(storage.session_user('token1') == 'alice', 'session is not found')
+    expect(storage.session_user('token2') is None, 'unknown session is found')
+    storage.delete_session('token1')
+    expect(storage.session_user('token1') is None, 'deleted session is still found')
+
+@conformance('messages')
+def check_messages(storage: Storage):
+    alice, = make_users(storage, 'alice')
+    room = storage.add_group_room('team', alice, [alice])
+    ids = [post(storage, alice, 'alice', f'm{i}', GENERAL_ROOM_ID if i % 3 else room) for i in range(30)]
+    expect(ids == sorted(set(ids)), 'message ids do not increase')
+    expect(storage.last_message_id() == ids[-1], 'last_message_id is not the newest id')
+    general = [i for n, i in enumerate(ids) if n % 3]
+    recent = storage.recent_messages(GENERAL_ROOM_ID, 5)
+    expect([m['id'] for m in recent] == general[-5:], 'recent_messages is not the room tail in id order')
+    expect(recent[-1]['username'] == 'alice' and recent[-1]['message'] == 'm29', f'bad message {recent[-1]}')
+    expect(set(recent[-1]) >= {'id', 'username', 'message', 'message_type', 'file_name', 'file_size',
+                               'timestamp', 'room_id'}, 'message fields are missing')
+    before = storage.messages_before(GENERAL_ROOM_ID, general[-5], 4)
+    expect([m['id'] for m in before] == general[-9:-5], 'messages_before is not the page below before_id')
+    expect(storage.messages_before(GENERAL_ROOM_ID, general[0], 10) == [], 'history goes below the first message')
+    after = storage.messages_after(ids[10], 5)
+    expect([m['id'] for m in after] == ids[11:16], 'messages_after over all rooms is wrong')
+    after = storage.messages_after(0, 100, room)
+    expect([m['id'] for m in after] == ids[::3], 'messages_after in a room is wrong')
+    recent[-1]['message'] = 'changed'
+    expect(storage.recent_messages(GENERAL_ROOM_ID, 1)[0]['message'] == 'm29', 'returned dicts share stored state')
+
+@conformance('rooms')
+def check_rooms(storage: Storage):
+    alice, bob, carol = make_users(storage, 'alice', 'bob', 'carol')
+    expect(storage.room_access(carol, GENERAL_ROOM_ID), 'general room is not public')
+    room = storage.add_group_room('team', alice, [alice, bob])
+    expect(storage.room_access(bob, room) and not storage.room_access(carol, room), 'group membership is wrong')
+    expect(not storage.room_access(alice, 9999), 'missing room is accessible')
+    expect(storage.add_room_member(room, carol) and storage.room_access(carol, room), 'member is not added')
+    dm = storage.direct_room(alice, bob)
+    expect(storage.direct_room(bob, alice) == dm, 'direct room is not unique per pair')
+    expect(not storage.room_access(carol, dm), 'direct room is visible to a third user')
+    expect(not storage.add_room_member(dm, carol), 'third user is added to a direct room')
+    expect(not storage.add_room_member(GENERAL_ROOM_ID, carol), 'member is added to a public room')
+    rooms = storage.list_rooms(alice)
+    expect([r['id'] for r in rooms] == [GENERAL_ROOM_ID, room, dm], f'list_rooms returned {rooms}')
+    expect(rooms[2] == {'id': dm, 'kind': 'dm', 'name': 'bob'}, f'direct room is listed as {rooms[2]}')
+    expect([r['id'] for r in storage.list_rooms(carol)] == [GENERAL_ROOM_ID, room], 'list_rooms shows foreign rooms')
+
+@conformance('files')
+def check_files(storage: Storage):
+    alice, = make_users(storage, 'alice')
+    room = storage.add_group_room('team', alice, [alice])
+    post(storage, alice, 'alice', 'report', room, file_name='report.pdf')
+    expect(storage.file_room('report.pdf') == room, 'file is not linked to its room')
+    expect(storage.file_room('missing.pdf') is None, 'unknown file is found')
+
+@conformance('search')
+def check_search(storage: Storage):
+    alice, bob = make_users(storage, 'alice', 'bob')
+    secret = storage.add_group_room('secret', alice, [alice])
+    post(storage, alice, 'alice', 'Привет, мир', timestamp=epoch_ms('2024-01-01 10:00:00'))
+    post(storage, bob, 'bob', 'привет привет всем', timestamp=epoch_ms('2024-01-02 10:00:00'))
+    post(storage, alice, 'alice', 'привет из секретной комнаты', secret, timestamp=epoch_ms('2024-01-03 10:00:00'))
+    post(storage, alice, 'alice', 'что-то другое', timestamp=epoch_ms('2024-01-04 10:00:00'))
+    for sort in SORT_ORDERS:
+        results, _ = storage.search(bob, 'привет', sort=sort)
+        expect(sorted(m['message'] for m in results) == ['Привет, мир', 'привет привет всем'],
+               f'{sort}: search ignores room access or misses matches: {results}')
+        expect(all('<mark>' in m['snippet'] for m in results), f'{sort}: snippet has no highlight')
+    results, _ = storage.search(alice, 'прив*', room_id=secret)
+    expect([m['room_id'] for m in results] == [secret], 'prefix search in a room is wrong')
+    results, _ = storage.search(alice, 'привет', sender_id=bob, sort='recent')
+    expect([m['username'] for m in results] == ['bob'], 'sender filter is wrong')
+    results, _ = storage.search(alice, 'привет', date_from=date(2024, 1, 2), date_to=date(2024, 1, 2), sort='recent')
+    expect([m['timestamp'] for m in results] == [epoch_ms('2024-01-02 10:00:00')], 'date filter is wrong')
+    seen = []
+    cursor = None
+    for _ in range(10):
+        results, cursor = storage.search(alice, 'привет', sort='recent', cursor=cursor, limit=1)
+        seen += [m['id'] for m in results]
+        if cursor is None:
+            break
+    expect(len(seen) == 3 and seen == sorted(seen, reverse=True), f'recent pages are wrong: {seen}')
+    for query, sort in (('', 'rank'), ('привет', 'oldest')):
+        try:
+            storage.search(alice, query, sort=sort)
+        except ValueError:
+            continue
+        raise ConformanceError(f'search({query!r}, sort={sort!r}) did not raise ValueError')
+
+def run_conformance(factory: Callable[[], Storage], log: Callable[[str], None] = print) -> bool:
+    """Прогоняет все проверки на новых хранилищах из factory; True - все прошли"""
+    passed = True
+    for name, check in CONFORMANCE_CHECKS:
+        storage = factory()
+        try:
+            storage.init()
+            check(storage)
+            log(f"  ok      {name}")
+        except Exception as e:
+            passed = False
+            log(f"  FAILED  {name}: {e}")
+            if not isinstance(e, ConformanceError):
+                traceback.print_exc()
+        finally:
+            storage.close()
+    return passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BigAko storage conformance checks')
+    parser.add_argument('--backend', choices=list(STORAGE_BACKENDS), action='append',
+                        help='какие хранилища проверять (по умолчанию все)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bigako-storage-')
+    counter = itertools.count()
+
+    def temporary_sqlite() -> Storage:
+        path = os.path.join(workdir, str(next(counter)))
+        os.makedirs(path)
+        return SQLiteStorage(os.path.join(path, 'users.db'), os.path.join(path, 'archive'), log=lambda line: None)
+
+    def temporary_log() -> Storage:
+        sqlite = temporary_sqlite()
+        return LogStorage(sqlite, os.path.join(os.path.dirname(sqlite.path), 'messages'))
+
+    factories = {'sqlite': temporary_sqlite, 'memory': MemoryStorage, 'log': temporary_log}
+    ok = True
+    try:
+        for backend in args.backend or list(STORAGE_BACKENDS):
+            print(f"{backend}:")
+            ok = run_conformance(factories[backend]) and ok
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    raise SystemExit(0 if ok else 1)